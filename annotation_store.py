@@ -0,0 +1,142 @@
+'''
+Columnar store for the annotation items of T3DataSet.load_data. Instead of one dict with lists of
+small numpy arrays per image, all items live in a few flat numpy columns: string pools (utf-8 bytes +
+offsets), per-image line offsets and one value array for all polygons/colors. Forked dataloader
+workers then only read shared pages instead of touching the refcounts of millions of python objects,
+which copies the whole data_list into every worker over time. Items are built on access and are
+equal to the dicts of load_data (fresh objects, changes in __getitem__ are not kept).
+The store is filled one item at a time from any iterable (e.g. T3DataSet.iter_data streaming the
+manifest) into growable byte buffers, so the list of dicts never exists during loading either.
+Usage:
+    store = AnnotationStore(items)  # items: iterable of load_data() dicts
+    info = store[0]
+'''
+import json
+from array import array
+import numpy as np
+
+
+# filled by append(), readable after freeze()
+class StringPool(object):
+    def __init__(self):
+        self.buf = bytearray()
+        self.ends = array('q', [0])
+
+    def append(self, s):
+        self.buf += s.encode('utf-8')
+        self.ends.append(len(self.buf))
+
+    def freeze(self):
+        self.offsets = np.frombuffer(self.ends, dtype=np.int64)
+        self.data = np.frombuffer(self.buf, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def nbytes(self):
+        return self.offsets.nbytes + self.data.nbytes
+
+
+# list of small numeric arrays (ndim <= 2) as one float64 value array + shapes and dtypes, same append/freeze
+class RaggedArrays(object):
+    def __init__(self):
+        self.dtype_names = []
+        self.dtype_ids = array('B')
+        self.shape_buf = array('q')
+        self.ends = array('q', [0])
+        self.value_buf = array('d')
+
+    def append(self, a):
+        a = np.asarray(a)
+        assert a.ndim <= 2
+        if a.dtype.str not in self.dtype_names:
+            self.dtype_names += [a.dtype.str]
+        self.dtype_ids.append(self.dtype_names.index(a.dtype.str))
+        self.shape_buf.extend((a.shape + (-1, -1))[:2])
+        self.value_buf.frombytes(a.ravel().astype(np.float64).tobytes())
+        self.ends.append(len(self.value_buf))
+
+    def freeze(self):
+        self.dtypes = np.frombuffer(self.dtype_ids, dtype=np.uint8)
+        self.shapes = np.frombuffer(self.shape_buf, dtype=np.int64).reshape(-1, 2)
+        self.offsets = np.frombuffer(self.ends, dtype=np.int64)
+        self.values = np.frombuffer(self.value_buf, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        shape = tuple([int(d) for d in self.shapes[i] if d >= 0])
+        value = self.values[self.offsets[i]:self.offsets[i+1]].reshape(shape)
+        return value.astype(self.dtype_names[self.dtypes[i]])
+
+    def nbytes(self):
+        return self.dtypes.nbytes + self.shapes.nbytes + self.offsets.nbytes + self.values.nbytes
+
+
+class AnnotationStore(object):
+    def __init__(self, items=()):
+        self.img_path = StringPool()
+        self.caption = StringPool()
+        self.texts = StringPool()
+        self.language = StringPool()
+        self.pos = StringPool()
+        self.color = RaggedArrays()
+        self.polygons = RaggedArrays()
+        self.invalid_polygons = RaggedArrays()
+        has_ann = array('B')  # json item without 'annotations'
+        line_offsets = array('q', [0])
+        invalid_offsets = array('q', [0])
+        for d in items:
+            self.img_path.append(d['img_path'])
+            self.caption.append(d['caption'])
+            has_ann.append('texts' in d)
+            lines = d if 'texts' in d else {}
+            for t in lines.get('texts', []):
+                self.texts.append(t)
+            for t in lines.get('language', []):
+                self.language.append(t)
+            for c in lines.get('color', []):
+                self.color.append(c)
+            for p in lines.get('polygons', []):
+                self.polygons.append(p)
+            for p in lines.get('invalid_polygons', []):
+                self.invalid_polygons.append(p)
+            self.pos.append(json.dumps(lines.get('pos', [])))
+            line_offsets.append(line_offsets[-1] + len(lines.get('texts', [])))
+            invalid_offsets.append(invalid_offsets[-1] + len(lines.get('invalid_polygons', [])))
+        for column in [self.img_path, self.caption, self.texts, self.language, self.pos, self.color, self.polygons, self.invalid_polygons]:
+            column.freeze()
+        self.has_ann = np.frombuffer(has_ann, dtype=np.uint8).view(bool)
+        self.line_offsets = np.frombuffer(line_offsets, dtype=np.int64)
+        self.invalid_offsets = np.frombuffer(invalid_offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.img_path)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError(item)
+        info = {'img_path': self.img_path[item], 'caption': self.caption[item]}
+        if not self.has_ann[item]:
+            return info
+        l0, l1 = self.line_offsets[item], self.line_offsets[item+1]
+        i0, i1 = self.invalid_offsets[item], self.invalid_offsets[item+1]
+        info['polygons'] = np.array([self.polygons[i] for i in range(l0, l1)], dtype=np.int32)
+        info['invalid_polygons'] = [self.invalid_polygons[i] for i in range(i0, i1)]
+        info['texts'] = [self.texts[i] for i in range(l0, l1)]
+        info['language'] = [self.language[i] for i in range(l0, l1)]
+        info['pos'] = json.loads(self.pos[item])
+        info['color'] = [self.color[i] for i in range(l0, l1)]
+        return info
+
+    def nbytes(self):
+        columns = [self.img_path, self.caption, self.texts, self.language, self.color, self.polygons, self.invalid_polygons, self.pos]
+        return sum([c.nbytes() for c in columns]) + self.has_ann.nbytes + self.line_offsets.nbytes + self.invalid_offsets.nbytes
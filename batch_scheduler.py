@@ -0,0 +1,182 @@
+'''
+Dynamic request batching in front of AnyText2Model.
+
+Requests go through a two stage pipeline: num_prepare_workers threads run the CPU part of
+preprocessing (AnyText2Model.prepare: positions, glyph rendering, font hint) while the single
+GPU worker uploads, encodes and samples. Both stages are connected by bounded queues, so glyph
+rendering of request N+1 is hidden behind the denoising of request N. Compatible requests
+(same size, ddim_steps, cfg_scale, eta, strength, attnx_scale and weights, see
+AnyText2Model.batch_key) are coalesced into one DDIM batch and the results are split back.
+Usage:
+    scheduler = BatchScheduler(AnyText2Model(model_dir='./models').cuda(0), max_batch_size=8, max_wait_ms=20)
+    results, rtn_code, rtn_warning, debug_info = scheduler(input_data, **params)
+'''
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class BatchScheduler(object):
+    '''
+    max_batch_size: max number of images (sum of image_count) sampled in one batch
+    max_wait_ms: max time the first request of a batch waits for others to join,
+                 bounds the extra latency added by batching
+    num_prepare_workers: threads running the CPU stage, 0 runs it on the GPU worker. prepare() is
+                         thread-safe: fonts (font_pool) and the textbbox ImageDraw (glyph_metrics)
+                         are per thread, the translator runs under a lock
+    max_queue: max requests waiting for the CPU stage, submit() blocks when full
+    prefetch: max prepared jobs waiting for the GPU stage
+    '''
+    def __init__(self, model, max_batch_size=8, max_wait_ms=20, num_prepare_workers=2, max_queue=64, prefetch=4):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.prepared = queue.Queue(maxsize=prefetch)
+        self.pending = deque()  # preprocessed jobs that did not fit into the last batch
+        self.n_requests = 0
+        self.n_batches = 0
+        self.prepare_time = 0.
+        self._running = True
+        self._preparers = []
+        for i in range(num_prepare_workers):
+            t = threading.Thread(target=self._prepare_loop, name=f'BatchScheduler-prepare{i}', daemon=True)
+            t.start()
+            self._preparers += [t]
+        self._worker = threading.Thread(target=self._loop, name='BatchScheduler', daemon=True)
+        self._worker.start()
+
+    def __call__(self, input_tensor, **forward_params):
+        return self.submit(input_tensor, **forward_params).result()
+
+    def submit(self, input_tensor, **forward_params):
+        if not self._running:
+            raise RuntimeError('BatchScheduler closed')
+        future = Future()
+        self.requests.put((input_tensor, forward_params, future))
+        if not self._running:  # closed while waiting for a free slot
+            self._drain()
+        return future
+
+    def close(self):
+        self._running = False
+        for t in self._preparers:
+            t.join()
+        self._worker.join()
+        self._drain()
+
+    # fail the futures of all requests and jobs that will not run anymore
+    def _drain(self):
+        futures = []
+        for q in [self.requests, self.prepared]:
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                futures += [item[2] if isinstance(item, tuple) else item['future']]
+        while True:
+            try:
+                futures += [self.pending.popleft()['future']]
+            except IndexError:
+                break
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError('BatchScheduler closed'))
+
+    def stats(self):
+        return {'requests': self.n_requests, 'batches': self.n_batches,
+                'mean_batch': self.n_requests / max(self.n_batches, 1),
+                'queued': self.requests.qsize(), 'prepared': self.prepared.qsize(),
+                'mean_prepare_ms': 1000 * self.prepare_time / max(self.n_requests, 1)}
+
+    def _prepare(self, timeout):
+        try:
+            input_tensor, forward_params, future = self.requests.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return None
+        if not future.set_running_or_notify_cancel():
+            return None
+        tic = time.time()
+        try:
+            job = self.model.prepare(input_tensor, **forward_params)
+        except Exception as e:
+            future.set_exception(e)
+            return None
+        self.prepare_time += time.time() - tic
+        if isinstance(job, tuple):  # error, return as forward() does
+            future.set_result(job)
+            return None
+        job['future'] = future
+        return job
+
+    def _prepare_loop(self):
+        while self._running:
+            job = self._prepare(timeout=0.1)
+            while job is not None:
+                try:
+                    self.prepared.put(job, timeout=0.1)  # blocks while the GPU stage is behind
+                    break
+                except queue.Full:
+                    if not self._running:
+                        job['future'].set_exception(RuntimeError('BatchScheduler closed'))
+                        break
+
+    def _next_job(self, timeout):
+        deadline = time.time() + max(timeout, 0)
+        while True:
+            if self._preparers:
+                try:
+                    job = self.prepared.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    return None
+            else:
+                job = self._prepare(timeout=deadline - time.time())
+                if job is None:
+                    if time.time() >= deadline:
+                        return None
+                    continue
+            try:
+                return self.model.upload(job)
+            except Exception as e:
+                job['future'].set_exception(e)
+
+    def _loop(self):
+        while self._running:
+            job = self.pending.popleft() if self.pending else self._next_job(timeout=0.1)
+            if job is None:
+                continue
+            batch = [job]
+            key = self.model.batch_key(job)
+            n_imgs = job['img_count']
+            # compatible jobs left over from the last round go first
+            for _job in list(self.pending):
+                if n_imgs + _job['img_count'] <= self.max_batch_size and self.model.batch_key(_job) == key:
+                    self.pending.remove(_job)
+                    batch += [_job]
+                    n_imgs += _job['img_count']
+            deadline = time.time() + self.max_wait
+            while n_imgs < self.max_batch_size:
+                _job = self._next_job(timeout=deadline - time.time())
+                if _job is None:
+                    break
+                if n_imgs + _job['img_count'] <= self.max_batch_size and self.model.batch_key(_job) == key:
+                    batch += [_job]
+                    n_imgs += _job['img_count']
+                else:
+                    self.pending.append(_job)
+            self._run(batch)
+
+    def _run(self, batch):
+        self.n_requests += len(batch)
+        self.n_batches += 1
+        try:
+            outputs = self.model.sample_jobs(batch, seeded_noise=True)
+        except Exception as e:
+            for job in batch:
+                job['future'].set_exception(e)
+            return
+        for job, output in zip(batch, outputs):
+            job['future'].set_result(output)
@@ -10,6 +10,7 @@ from ldm.modules.diffusionmodules.util import (
     linear,
     zero_module,
     timestep_embedding,
+    is_batch_broadcast,
 )
 
 from einops import rearrange, repeat
@@ -22,6 +23,8 @@ from ldm.util import log_txt_as_img, exists, instantiate_from_config
 from cldm.ddim_hacked import DDIMSampler
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from .recognizer import TextRecognizer, create_predictor
+from glyph_roi import is_roi_batch, densify
+from packed_lines import is_packed, get_line, line_offsets, sum_lines
 from omegaconf.listconfig import ListConfig
 import cv2
 
@@ -33,6 +36,14 @@ def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
 
+# T3DataSet(compact_dtypes=True) arrays -> float in [0, 1]: uint8 images are in [0, 255], bool masks are 0/1.
+# x.float()/255 in fp32 equals the dataset's old fp64 x/255 cast to fp32 bit for bit (correctly rounded division)
+def decompact(x):
+    if x.dtype == torch.uint8:
+        return x.float() / 255.
+    return x.float()
+
+
 class ControlledUnetModel(UNetModel):
     def forward(self, x, timesteps=None, context=None, control=None, only_mid_control=False, attnx_scale=1.0, **kwargs):
         hs = []
@@ -355,12 +366,22 @@ class ControlNet(nn.Module):
         # guided_hint from text_info
         if self.fast_control:
             timesteps = torch.tensor([0]*hint.shape[0], device=hint.device).long()
-        glyphs = torch.sum(torch.stack(text_info['glyphs']), dim=0)
+        glyphs, positions, masked_x = text_info['glyphs'], text_info['positions'], text_info['masked_x']
+        packed = is_packed(text_info)
+        shared = not packed and all([is_batch_broadcast(i) for i in glyphs + positions + [masked_x]])
+        if shared:  # same text_info for every sample, encode once and broadcast
+            glyphs, positions, masked_x = [i[:1] for i in glyphs], [i[:1] for i in positions], masked_x[:1]
+        glyphs = torch.sum(torch.stack(glyphs), dim=0)
         glyphs = (torch.sum(glyphs, dim=1) != 0).to(glyphs.dtype).unsqueeze(1)
-        positions = torch.cat(text_info['positions'], dim=1).sum(dim=1, keepdim=True)
+        if packed:  # (L, 1, h, w) -> sum over the lines of every sample
+            positions = sum_lines(positions, text_info['line_index'], masked_x.shape[0])
+        else:
+            positions = torch.cat(positions, dim=1).sum(dim=1, keepdim=True)
         enc_glyph = self.glyph_block(glyphs, None, None)
         enc_pos = self.position_block(positions, None, None)
-        guided_hint = self.fuse_block_za(torch.cat([enc_glyph, enc_pos, text_info['masked_x']], dim=1))
+        guided_hint = self.fuse_block_za(torch.cat([enc_glyph, enc_pos, masked_x], dim=1))
+        if shared:
+            guided_hint = guided_hint.expand(x.shape[0], -1, -1, -1)
 
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
         if self.use_fp16:
@@ -412,7 +433,6 @@ class ControlLDM(LatentDiffusion):
         self.latin_weight = latin_weight
         self.control = None
         self.control_uncond = None
-        self.is_uncond = False
 ###修改3##############################################################
         if self.training_stage == 2:
             self.control_model = instantiate_from_config(control_stage_config)
@@ -458,14 +478,14 @@ class ControlLDM(LatentDiffusion):
             control = control[:bs]
         control = control.to(self.device)
         control = einops.rearrange(control, 'b h w c -> b c h w')
-        control = control.to(memory_format=torch.contiguous_format).float()
+        control = decompact(control.to(memory_format=torch.contiguous_format))
 
         inv_mask = batch['inv_mask']
         if bs is not None:
             inv_mask = inv_mask[:bs]
         inv_mask = inv_mask.to(self.device)
         inv_mask = einops.rearrange(inv_mask, 'b h w c -> b c h w')
-        inv_mask = inv_mask.to(memory_format=torch.contiguous_format).float()
+        inv_mask = decompact(inv_mask.to(memory_format=torch.contiguous_format))
 
         # glyphs = batch[self.glyph_key]
         # gly_line = batch['gly_line']
@@ -475,20 +495,34 @@ class ControlLDM(LatentDiffusion):
         # language = batch['language']
         # texts = batch['texts']
         # font_hint = batch['font_hint']
-        glyphs = copy.deepcopy(batch[self.glyph_key])
+        font_hint = copy.deepcopy(batch['font_hint'])
+        if bs is not None:
+            font_hint = font_hint[:bs]
+        font_hint = font_hint.to(self.device)
+        font_hint = einops.rearrange(font_hint, 'b h w c -> b c h w')
+        font_hint = decompact(font_hint.to(memory_format=torch.contiguous_format))
+        if is_packed(batch):  # real lines only, from t3_packed_collate
+            info = self.get_packed_lines(batch, bs)
+        else:
+            info = self.get_padded_lines(batch, bs)
+        info['img'] = batch['img']  # nhwc, (-1,1)
+        info['masked_x'] = mx
+        info['inv_mask'] = inv_mask
+        info['font_hint'] = font_hint
+        return x, dict(c_crossattn=[c], c_concat=[control], text_info=info)
+
+    # [line][sample] lists padded to max_lines, from t3_collate
+    def get_padded_lines(self, batch, bs=None):
+        if is_roi_batch(batch[self.glyph_key][0]):  # sparse glyph records from t3_collate, densify on device
+            glyphs = [densify(g[:bs] if bs is not None else g, device=self.device) for g in batch[self.glyph_key]]
+        else:
+            glyphs = copy.deepcopy(batch[self.glyph_key])
         gly_line = copy.deepcopy(batch['gly_line'])
         positions = copy.deepcopy(batch[self.position_key])
         colors = copy.deepcopy(batch['color'])
         n_lines = copy.deepcopy(batch['n_lines'])
         language = copy.deepcopy(batch['language'])
         texts = copy.deepcopy(batch['texts'])
-        font_hint = copy.deepcopy(batch['font_hint'])
-
-        if bs is not None:
-            font_hint = font_hint[:bs]
-        font_hint = font_hint.to(self.device)
-        font_hint = einops.rearrange(font_hint, 'b h w c -> b c h w')
-        font_hint = font_hint.to(memory_format=torch.contiguous_format).float()
         assert len(glyphs) == len(positions)
         for i in range(len(glyphs)):
             if bs is not None:
@@ -504,9 +538,9 @@ class ControlLDM(LatentDiffusion):
             glyphs[i] = einops.rearrange(glyphs[i], 'b h w c -> b c h w')
             gly_line[i] = einops.rearrange(gly_line[i], 'b h w c -> b c h w')
             positions[i] = einops.rearrange(positions[i], 'b h w c -> b c h w')
-            glyphs[i] = glyphs[i].to(memory_format=torch.contiguous_format).float()
-            gly_line[i] = gly_line[i].to(memory_format=torch.contiguous_format).float()
-            positions[i] = positions[i].to(memory_format=torch.contiguous_format).float()
+            glyphs[i] = decompact(glyphs[i].to(memory_format=torch.contiguous_format))
+            gly_line[i] = decompact(gly_line[i].to(memory_format=torch.contiguous_format))
+            positions[i] = decompact(positions[i].to(memory_format=torch.contiguous_format))
             colors[i] = colors[i].to(memory_format=torch.contiguous_format).float()/255.
 
         info = {}
@@ -516,12 +550,34 @@ class ControlLDM(LatentDiffusion):
         info['n_lines'] = n_lines
         info['language'] = language
         info['texts'] = texts
-        info['img'] = batch['img']  # nhwc, (-1,1)
-        info['masked_x'] = mx
         info['gly_line'] = gly_line
-        info['inv_mask'] = inv_mask
-        info['font_hint'] = font_hint
-        return x, dict(c_crossattn=[c], c_concat=[control], text_info=info)
+        return info
+
+    # lines of all samples concatenated into (L, ...) tensors with line_index (L, 2), one glyph canvas per sample
+    def get_packed_lines(self, batch, bs=None):
+        n_lines = batch['n_lines']
+        glyphs = batch[self.glyph_key][0]
+        if bs is not None:
+            n_lines = n_lines[:bs]
+            glyphs = glyphs[:bs]
+        n_keep = line_offsets(n_lines)[-1]  # lines are in sample order
+        if is_roi_batch(glyphs):
+            glyphs = densify(glyphs, device=self.device)
+        glyphs = einops.rearrange(glyphs.to(self.device), 'b h w c -> b c h w')
+        gly_line = einops.rearrange(batch['gly_line'][:n_keep].to(self.device), 'l h w c -> l c h w')
+        positions = einops.rearrange(batch[self.position_key][:n_keep].to(self.device), 'l h w c -> l c h w')
+        colors = batch['color'][:n_keep].to(self.device)
+
+        info = {}
+        info['glyphs'] = [decompact(glyphs.to(memory_format=torch.contiguous_format))]
+        info['positions'] = decompact(positions.to(memory_format=torch.contiguous_format))
+        info['colors'] = colors.to(memory_format=torch.contiguous_format).float()/255.
+        info['n_lines'] = n_lines
+        info['language'] = batch['language'][:n_keep]
+        info['texts'] = batch['texts'][:n_keep]
+        info['gly_line'] = decompact(gly_line.to(memory_format=torch.contiguous_format))
+        info['line_index'] = batch['line_index'][:n_keep].to(self.device)
+        return info
 
     def copy_tokens(self, all_embs, flag, init_vector):
         row_sums = flag.sum(dim=1)
@@ -535,7 +591,21 @@ class ControlLDM(LatentDiffusion):
                 canvas[i, :len(true_indices), :] = all_embs[i, true_indices, :].clone()
         return canvas
 
-    def apply_model(self, x_noisy, t, cond, *args, **kwargs):
+    def get_control(self, x_noisy, t, cond, uncond=False):
+        text_cond = cond['c_crossattn'][0][1]
+        if text_cond is None:
+            return None  # uncond
+        control = self.control_uncond if uncond else self.control
+        if control is None or text_cond.requires_grad or not self.control_model.fast_control:  # only infer 1 time when fast control
+            _hint = torch.cat(cond['c_concat'], 1)
+            control = self.control_model(x=x_noisy, timesteps=t, context=text_cond, hint=_hint, text_info=cond['text_info'])
+            if uncond:
+                self.control_uncond = control
+            else:
+                self.control = control
+        return [c.clone() for c in control]
+
+    def apply_model(self, x_noisy, t, cond, *args, uncond=False, **kwargs):
         assert isinstance(cond, dict)
         diffusion_model = self.model.diffusion_model
 ####修改4##############################################################
@@ -545,29 +615,12 @@ class ControlLDM(LatentDiffusion):
             return diffusion_model(x=x_noisy, timesteps=t, context=img_cond)
 ####修改4结束##########################################################      
         img_cond = cond['c_crossattn'][0][0]
-        text_cond = cond['c_crossattn'][0][1]
-        _hint = torch.cat(cond['c_concat'], 1)
         if self.use_fp16:
             x_noisy = x_noisy.half()
-        if text_cond is None:
-            control = None  # uncond
-        else:
-            if self.control is None or self.control_uncond is None or not self.control_model.fast_control:  # only infer 1 time when fast control
-                _control = self.control_model(x=x_noisy, timesteps=t, context=text_cond, hint=_hint, text_info=cond['text_info'])
-                if not text_cond.requires_grad and self.control is not None and self.control_uncond is None:  # uncond
-                    self.control_uncond = _control
-                else:
-                    self.control = _control
-            if not text_cond.requires_grad:
-                if self.is_uncond:
-                    control = [c.clone() for c in self.control_uncond]
-                    self.is_uncond = False
-                else:
-                    control = [c.clone() for c in self.control]
-                    self.is_uncond = True
-            else:
-                control = [c.clone() for c in self.control]
+        control = self.get_control(x_noisy, t, cond, uncond=uncond)
+        if control is not None:
             if PRINT_DEBUG and control[0].requires_grad:
+                _hint = torch.cat(cond['c_concat'], 1)
                 for i in range(3):
                     control[i].register_hook(get_print_grad_hook(f'input-grad{i}.jpg'))
                 for i in range(3):
@@ -583,6 +636,25 @@ class ControlLDM(LatentDiffusion):
 
         return eps
 
+    # classifier-free guidance in one unet forward: cond and uncond are stacked into a 2B batch, return (eps_cond, eps_uncond)
+    def apply_model_cfg(self, x_noisy, t, cond, uncond):
+        img_cond = cond['c_crossattn'][0][0]
+        img_uncond = uncond['c_crossattn'][0][0]
+        if self.training_stage == 1 or img_cond.shape[1:] != img_uncond.shape[1:]:  # e.g. prompts split to different number of chunks
+            return self.apply_model(x_noisy, t, cond), self.apply_model(x_noisy, t, uncond, uncond=True)
+        diffusion_model = self.model.diffusion_model
+        if self.use_fp16:
+            x_noisy = x_noisy.half()
+        control = self.get_control(x_noisy, t, cond)
+        control_uncond = self.get_control(x_noisy, t, uncond, uncond=True)
+        if (control is None) != (control_uncond is None):
+            return self.apply_model(x_noisy, t, cond), self.apply_model(x_noisy, t, uncond, uncond=True)
+        if control is not None:
+            control = [torch.cat([c, uc]) * scale for c, uc, scale in zip(control, control_uncond, self.control_scales[:len(control)])]
+        eps = diffusion_model(x=torch.cat([x_noisy] * 2), timesteps=torch.cat([t] * 2), context=torch.cat([img_cond, img_uncond]),
+                              control=control, only_mid_control=self.only_mid_control, attnx_scale=self.attnx_scale)
+        return eps.chunk(2)
+
     def instantiate_embedding_manager(self, config, embedder):
         model = instantiate_from_config(config, embedder=embedder)
         return model
@@ -617,11 +689,11 @@ class ControlLDM(LatentDiffusion):
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
         self.control = None
         self.control_uncond = None
-        self.is_uncond = False
         return c
 
     def fill_caption(self, batch, place_holder='*'):
         bs = len(batch['n_lines'])
+        offsets = line_offsets(batch['n_lines'])
         cond_list = copy.deepcopy(batch[self.cond_stage_key[1]])
         for i in range(bs):
             n_lines = batch['n_lines'][i]
@@ -629,7 +701,7 @@ class ControlLDM(LatentDiffusion):
                 continue
             cur_cap = cond_list[i]
             for j in range(n_lines):
-                r_txt = batch['texts'][j][i]
+                r_txt = get_line(batch, 'texts', i, j, offsets)
                 cur_cap = cur_cap.replace(place_holder, f'"{r_txt}"', 1)
             cond_list[i] = cur_cap
         batch[self.cond_stage_key[1]] = cond_list
@@ -651,8 +723,9 @@ class ControlLDM(LatentDiffusion):
         c_cat = c["c_concat"][0][:N]
         text_info = c["text_info"]
         text_info['glyphs'] = [i[:N] for i in text_info['glyphs']]
-        text_info['gly_line'] = [i[:N] for i in text_info['gly_line']]
-        text_info['positions'] = [i[:N] for i in text_info['positions']]
+        if not is_packed(text_info):  # packed lines are already cut to N samples by get_input
+            text_info['gly_line'] = [i[:N] for i in text_info['gly_line']]
+            text_info['positions'] = [i[:N] for i in text_info['positions']]
         text_info['n_lines'] = text_info['n_lines'][:N]
         text_info['masked_x'] = text_info['masked_x'][:N]
         text_info['img'] = text_info['img'][:N]
@@ -4,15 +4,22 @@ import torch
 import numpy as np
 from tqdm import tqdm
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, extract_into_tensor
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, extract_into_tensor, select_batch
+
+
+class SamplingCancelled(Exception):
+    def __init__(self, step):
+        super().__init__(f'DDIM sampling cancelled at step {step}')
+        self.step = step
 
 
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", batched_cfg=False, **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.batched_cfg = batched_cfg  # run cond and uncond in one 2B forward, needs model.apply_model_cfg
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -75,6 +82,7 @@ class DDIMSampler(object):
                unconditional_conditioning=None, # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
                dynamic_threshold=None,
                ucg_schedule=None,
+               cancel_token=None,
                **kwargs
                ):
         if conditioning is not None:
@@ -115,7 +123,8 @@ class DDIMSampler(object):
                                                     unconditional_guidance_scale=unconditional_guidance_scale,
                                                     unconditional_conditioning=unconditional_conditioning,
                                                     dynamic_threshold=dynamic_threshold,
-                                                    ucg_schedule=ucg_schedule
+                                                    ucg_schedule=ucg_schedule,
+                                                    cancel_token=cancel_token
                                                     )
         return samples, intermediates
 
@@ -126,7 +135,7 @@ class DDIMSampler(object):
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None, dynamic_threshold=None,
-                      ucg_schedule=None):
+                      ucg_schedule=None, cancel_token=None):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
@@ -148,6 +157,16 @@ class DDIMSampler(object):
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
 
         for i, step in enumerate(iterator):
+            if cancel_token is not None and cancel_token.is_set():  # checked between steps
+                iterator.close()
+                raise SamplingCancelled(i)
+            keep = cancel_token.keep_rows() if hasattr(cancel_token, 'keep_rows') else None
+            if keep is not None:  # part of the batch was cancelled, sample only the remaining rows
+                img, cond, unconditional_conditioning, mask, x0 = [select_batch(v, keep, b) for v in (img, cond, unconditional_conditioning, mask, x0)]
+                for name in ['control', 'control_uncond']:  # fast_control output cached by ControlLDM
+                    if getattr(self.model, name, None) is not None:
+                        setattr(self.model, name, [select_batch(c, keep, b) for c in getattr(self.model, name)])
+                b = img.shape[0]
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
 
@@ -186,9 +205,12 @@ class DDIMSampler(object):
 
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             model_output = self.model.apply_model(x, t, c)
+        elif self.batched_cfg and hasattr(self.model, 'apply_model_cfg'):
+            model_t, model_uncond = self.model.apply_model_cfg(x, t, c, unconditional_conditioning)
+            model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
         else:
             model_t = self.model.apply_model(x, t, c)
-            model_uncond = self.model.apply_model(x, t, unconditional_conditioning)
+            model_uncond = self.model.apply_model(x, t, unconditional_conditioning, uncond=True)
             model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
 
         if self.model.parameterization == "v":
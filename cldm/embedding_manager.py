@@ -5,9 +5,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from functools import partial
-from ldm.modules.diffusionmodules.util import conv_nd, linear, zero_module
+from ldm.modules.diffusionmodules.util import conv_nd, linear, zero_module, is_batch_broadcast
 import numpy as np
 from cldm.recognizer import crop_image, TextRecognizer, create_predictor
+from packed_lines import is_packed, get_line, line_offsets
 import math
 from easydict import EasyDict as edict
 from diffusers.models.embeddings import TimestepEmbedding, Timesteps
@@ -232,21 +233,25 @@ class EmbeddingManager(nn.Module):
         color_list = []
         style_flag = []
         color_flag = []
-        for i in range(len(text_info['n_lines'])):  # sample index in a batch
+        n_samples = len(text_info['n_lines'])
+        shared = self.is_shared(text_info)
+        offsets = line_offsets(text_info['n_lines'])  # rows of packed lines, see packed_lines.py
+        for i in range(1 if shared else n_samples):  # sample index in a batch
             n_lines = text_info['n_lines'][i]
             for j in range(n_lines):  # line
-                gline_list += [text_info['gly_line'][j][i:i+1]]
+                position = get_line(text_info, 'positions', i, j, offsets)
+                gline_list += [get_line(text_info, 'gly_line', i, j, offsets)[None]]
                 if self.add_pos:
-                    pos_list += [text_info['positions'][j][i:i+1]]
+                    pos_list += [position[None]]
                 if self.add_style_conv:
-                    np_pos = text_info['positions'][j][i].permute(1, 2, 0).cpu().numpy().astype(np.uint8) * 255  # hwc, numpy, 0-255
+                    np_pos = position.permute(1, 2, 0).cpu().numpy().astype(np.uint8) * 255  # hwc, numpy, 0-255
                     font_hint = (text_info['font_hint'][i]*255)  # 1hw, tensor, 0-255
                     style_line = crop_image(font_hint, np_pos)/255.  # 1hw, tensor, 0-1
                     style_line = resize_img(style_line, imgH=48, imgW=320)[None, ...]  # 11HW tensor 0-1  48x320
-                    style_line = style_line.to(text_info['positions'][j][i].dtype)
+                    style_line = style_line.to(position.dtype)
                     style_list += [style_line]
                 if self.add_style_ocr:
-                    np_pos = text_info['positions'][j][i].permute(1, 2, 0).cpu().numpy().astype(np.uint8) * 255  # hwc, numpy, 0-255
+                    np_pos = position.permute(1, 2, 0).cpu().numpy().astype(np.uint8) * 255  # hwc, numpy, 0-255
                     font_hint = (text_info['font_hint'][i]*255)
                     if font_hint.shape[0] == 1:
                         font_hint = font_hint.repeat(3, 1, 1)  # chw, tensor, 0-255
@@ -264,7 +269,7 @@ class EmbeddingManager(nn.Module):
                         style_flag += [1]
                     style_list += [style_line]
                 if self.add_color:
-                    _c = text_info['colors'][j][i:i+1]
+                    _c = get_line(text_info, 'colors', i, j, offsets)[None]
                     if _c.mean() > 1 or _c.mean() < 0:
                         color_flag += [0]
                     else:
@@ -308,15 +313,35 @@ class EmbeddingManager(nn.Module):
 
         self.text_embs_all = []
         n_idx = 0
-        for i in range(len(text_info['n_lines'])):  # sample index in a batch
+        for i in range(1 if shared else n_samples):  # sample index in a batch
             n_lines = text_info['n_lines'][i]
             text_embs = []
             for j in range(n_lines):  # line
                 text_embs += [enc_glyph[n_idx:n_idx+1]]
                 n_idx += 1
             self.text_embs_all += [text_embs]
+        if shared:
+            self.text_embs_all = self.text_embs_all * n_samples
         self.reset_start_idx()
 
+    # every sample of the batch has the same lines (broadcast text_info), so lines are encoded only once
+    def is_shared(self, text_info):
+        n_lines = text_info['n_lines']
+        if is_packed(text_info) or len(n_lines) <= 1 or len(set(n_lines)) > 1:
+            return False
+        tensors = text_info['gly_line'][:n_lines[0]]
+        if self.add_pos or self.add_style_conv or self.add_style_ocr:
+            tensors = tensors + text_info['positions'][:n_lines[0]]
+        if self.add_style_conv or self.add_style_ocr:
+            tensors = tensors + [text_info['font_hint']]
+        if self.add_color:
+            tensors = tensors + text_info['colors'][:n_lines[0]]
+        if not all([is_batch_broadcast(t) for t in tensors]):
+            return False
+        if self.add_style_ocr and self.font_hint_mimic_imgs is not None:
+            return all([m is self.font_hint_mimic_imgs[0] for m in self.font_hint_mimic_imgs])
+        return True
+
     def forward(
             self,
             tokenized_text,
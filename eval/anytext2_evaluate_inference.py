@@ -11,7 +11,8 @@ from pytorch_lightning import seed_everything
 from cldm.model import create_model, load_state_dict
 from cldm.ddim_hacked import DDIMSampler
 from t3_dataset import draw_glyph, draw_glyph2, get_text_caption
-from dataset_util import load
+from font_hint_bg import hollow_font_hint
+from manifest import iter_data_list
 from tqdm import tqdm
 import argparse
 import time
@@ -60,10 +61,9 @@ def arr2tensor(arr, bs):
     return _arr
 
 def load_data(input_path):
-    content = load(input_path)
     d = []
     count = 0
-    for gt in content['data_list']:
+    for gt in iter_data_list(input_path):  # streamed, see manifest.py
         info = {}
         info['img_name'] = gt['img_name']
         info['caption'] = gt['caption']
@@ -154,20 +154,7 @@ def get_item(data_list, item):
         font_hint_fg = cv2.resize(np.sum(np.stack(item_dict['glyphs']), axis=0).clip(0, 1), (512, 512))
         font_hint_fg = font_hint_fg[..., 0:1]*255
         if font_hint_fg.mean() > 0:
-            img = cv2.imread('font/bg_noise.png')
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            img = cv2.resize(img, (font_hint_fg.shape[1], font_hint_fg.shape[0]))
-            img[img < 230] = 0
-            font_hint_bg = cv2.adaptiveThreshold(img.astype(np.uint8), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-            kernel1 = np.ones((3, 3), dtype=np.uint8)
-            kernel2 = np.ones((5, 5), dtype=np.uint8)
-            dilate_img1 = cv2.dilate(font_hint_fg[..., 0].astype(np.uint8), kernel1, iterations=1)
-            dilate_img2 = cv2.dilate(font_hint_fg[..., 0].astype(np.uint8), kernel2, iterations=1)
-            dilate_text = dilate_img2 - dilate_img1
-            result = (font_hint_fg[..., 0]-font_hint_bg + dilate_text).clip(0, 255)
-            font_hint_bg[font_hint_fg[..., 0] > 0] = 0
-            result = (result + font_hint_bg).clip(0, 255)
-            font_hint_bg = result[..., None]
+            font_hint_bg = hollow_font_hint(font_hint_fg[..., 0], kernel_sizes=(3, 5))[..., None]
             item_dict['font_hint'] = font_hint_bg/255.
         else:
             item_dict['font_hint'] = np.zeros((512, 512, 3))
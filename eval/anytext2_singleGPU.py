@@ -12,7 +12,8 @@ from pytorch_lightning import seed_everything
 from cldm.model import create_model, load_state_dict
 from cldm.ddim_hacked import DDIMSampler
 from t3_dataset import draw_glyph, draw_glyph2, get_text_caption
-from dataset_util import load
+from font_hint_bg import hollow_font_hint
+from manifest import iter_data_list
 from tqdm import tqdm
 import argparse
 import time
@@ -58,15 +59,14 @@ def arr2tensor(arr, bs):
     _arr = torch.from_numpy(arr.copy()).float().cuda()
     if use_fp16:
         _arr = _arr.half()
-    _arr = torch.stack([_arr for _ in range(bs)], dim=0)
+    _arr = _arr[None].expand(bs, *_arr.shape)  # one copy broadcast to the batch
     return _arr
 
 
 def load_data(input_path):
-    content = load(input_path)
     d = []
     count = 0
-    for gt in content['data_list']:
+    for gt in iter_data_list(input_path):  # streamed, see manifest.py
         info = {}
         info['img_name'] = gt['img_name']
         info['caption'] = gt['caption']
@@ -159,20 +159,7 @@ def get_item(data_list, item):
         font_hint_fg = cv2.resize(np.sum(np.stack(item_dict['glyphs']), axis=0).clip(0, 1), (512, 512))
         font_hint_fg = font_hint_fg[..., 0:1]*255
         if font_hint_fg.mean() > 0:
-            img = cv2.imread('font/bg_noise.png')
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            img = cv2.resize(img, (font_hint_fg.shape[1], font_hint_fg.shape[0]))
-            img[img < 230] = 0
-            font_hint_bg = cv2.adaptiveThreshold(img.astype(np.uint8), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-            kernel1 = np.ones((3, 3), dtype=np.uint8)
-            kernel2 = np.ones((5, 5), dtype=np.uint8)
-            dilate_img1 = cv2.dilate(font_hint_fg[..., 0].astype(np.uint8), kernel1, iterations=1)
-            dilate_img2 = cv2.dilate(font_hint_fg[..., 0].astype(np.uint8), kernel2, iterations=1)
-            dilate_text = dilate_img2 - dilate_img1
-            result = (font_hint_fg[..., 0]-font_hint_bg + dilate_text).clip(0, 255)
-            font_hint_bg[font_hint_fg[..., 0] > 0] = 0
-            result = (result + font_hint_bg).clip(0, 255)
-            font_hint_bg = result[..., None]
+            font_hint_bg = hollow_font_hint(font_hint_fg[..., 0], kernel_sizes=(3, 5))[..., None]
             item_dict['font_hint'] = font_hint_bg/255.
         else:
             item_dict['font_hint'] = np.zeros((512, 512, 3))
@@ -208,7 +195,7 @@ def process(model, ddim_sampler, item_dict, a_prompt, n_prompt, num_samples, ima
             info['glyphs'] += [arr2tensor(glyph, num_samples)]
             info['gly_line'] += [arr2tensor(gline, num_samples)]
             info['positions'] += [arr2tensor(pos, num_samples)]
-            info['colors'][i] = arr2tensor(info['colors'][i], num_samples)/255.
+            info['colors'][i] = (arr2tensor(info['colors'][i], 1)/255.).expand(num_samples, -1)
         # get masked_x
         ref_img = np.zeros((H, W, 3))
         masked_img = ((ref_img.astype(np.float32) / 127.5) - 1.0 - hint*10).clip(-1, 1)
@@ -221,7 +208,7 @@ def process(model, ddim_sampler, item_dict, a_prompt, n_prompt, num_samples, ima
         masked_x = model.get_first_stage_encoding(encoder_posterior).detach()
         if use_fp16:
             masked_x = masked_x.half()
-        info['masked_x'] = torch.cat([masked_x for _ in range(num_samples)], dim=0)
+        info['masked_x'] = masked_x.expand(num_samples, -1, -1, -1)
 
         hint = arr2tensor(hint, num_samples)
         info['font_hint'] = arr2tensor(item_dict['font_hint'], num_samples)
@@ -0,0 +1,70 @@
+'''
+Pool of FreeType fonts keyed by (path, index, size), replaces repeated ImageFont.truetype /
+font.font_variant calls in glyph rendering. Fonts in the pool are shared, callers must not modify
+them. PIL FreeType fonts must not be used by several threads at once, so every thread (e.g. the
+prepare workers of BatchScheduler) has its own pool. Dataloader workers inherit the fonts loaded
+by the forking thread.
+Usage:
+    from font_pool import get_font
+    font = get_font('font/Arial_Unicode.ttf', 60)
+    new_font = get_font(font, 32)  # variant of a loaded font
+'''
+import os
+import threading
+from PIL import ImageFont
+from util import LRUCache
+
+_max_size = 512
+_pools = []  # pools of all threads, for set_max_size/stats
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def font_key(font, size=None):
+    if isinstance(font, str):
+        key = (os.path.abspath(font), 0)
+    elif isinstance(font, ImageFont.FreeTypeFont) and isinstance(font.path, str):
+        key = (os.path.abspath(font.path), font.index)
+    else:  # e.g. loaded from bytes
+        key = ('id', id(font))
+    return key if size is None else key + (int(size),)
+
+
+def _pool():
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = _local.pool = LRUCache(max_size=_max_size)
+        with _lock:
+            _pools.append(pool)
+    return pool
+
+
+def get_font(font, size=60):
+    key = font_key(font, size)
+    if key[0] == 'id':  # no stable identity, do not pool
+        return font.font_variant(size=int(size))
+    pool = _pool()
+    new_font = pool.get(key)
+    if new_font is None:
+        if isinstance(font, str):
+            new_font = ImageFont.truetype(font, size=int(size))
+        else:
+            new_font = font.font_variant(size=int(size))
+        pool.put(key, new_font)
+    return new_font
+
+
+def set_max_size(max_size):
+    global _max_size
+    with _lock:
+        _max_size = max_size
+        for pool in _pools:
+            pool.max_size = max_size
+
+
+def stats():
+    with _lock:
+        pools = [p.stats() for p in _pools]
+    hits, misses = sum([p['hits'] for p in pools]), sum([p['misses'] for p in pools])
+    return {'size': sum([p['size'] for p in pools]), 'pools': len(pools), 'hits': hits, 'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1)}
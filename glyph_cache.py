@@ -0,0 +1,192 @@
+'''
+Content-addressed cache for rendered glyph images (t3_dataset.draw_glyph / draw_glyph2 and the
+per-line layers draw_glyphs composes its canvas from).
+Renders are keyed by a hash of all the inputs (font file, text, polygon, color, scale, canvas size)
+and kept compact: only the uint8 bbox crop of the non-zero pixels (glyph_roi.to_roi) and its offset
+are stored, bitpacked for binary images. The memory LRU is capped by the bytes of the stored crops.
+An optional on-disk store under cache_dir is shared by dataloader workers and survives restarts,
+so training epochs after the first and repeated inference layouts skip PIL rasterisation.
+Usage:
+    import glyph_cache
+    glyph_cache.enable(max_mb=64, cache_dir='./cache/glyphs')
+    print(glyph_cache.stats())
+'''
+import os
+import hashlib
+import inspect
+import threading
+import functools
+import numpy as np
+from PIL import ImageFont
+from util import LRUCache
+from glyph_roi import GlyphROI, to_roi
+
+_cache = None
+ENTRY_OVERHEAD = 256  # rough python object bytes per entry, counted against max_mb
+
+
+def entry_nbytes(entry):
+    return entry[-1].nbytes + ENTRY_OVERHEAD
+
+
+class GlyphCache(object):
+    def __init__(self, max_mb=64, cache_dir=None):
+        self.mem = LRUCache(max_size=float('inf'), max_bytes=int(max_mb * 2**20), sizeof=entry_nbytes)
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.disk_hits = 0
+        self.renders = 0
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def fetch(self, key, render, binary, layer=False):
+        with self.lock:
+            entry = self.mem.get(key)
+        if entry is None and self.cache_dir:
+            entry = self._load(key)
+            if entry is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.mem.put(key, entry)
+        if entry is None:
+            img = render()
+            with self.lock:
+                self.renders += 1
+            entry = self._encode_layer(img) if layer else self._encode(img, binary)
+            if entry is None:  # not representable losslessly, do not cache
+                return img
+            with self.lock:
+                self.mem.put(key, entry)
+            if self.cache_dir:
+                self._save(key, entry)
+        return self._decode(entry)
+
+    def stats(self):
+        with self.lock:
+            total = max(self.mem.hits + self.mem.misses, 1)
+            return {'size': len(self.mem), 'mb': self.mem.nbytes / 2**20, 'mem_hits': self.mem.hits, 'disk_hits': self.disk_hits,
+                    'renders': self.renders, 'hit_rate': (self.mem.hits + self.disk_hits) / total}
+
+    def clear(self):
+        with self.lock:
+            self.mem.clear()
+
+    # (kind, canvas shape, dtype, (y, x) of the crop, crop shape, crop data), None if not lossless
+    @staticmethod
+    def _encode(img, binary):
+        if img.ndim != 3:
+            return None
+        if binary:
+            if not np.isin(img, (0, 1)).all():
+                return None
+            roi = to_roi(img.astype(np.uint8))
+            return ('bits', img.shape, img.dtype.str, (roi.y, roi.x), roi.crop.shape, np.packbits(roi.crop.astype(bool).ravel()))
+        u8 = np.round(img * 255).astype(np.uint8)
+        if not np.array_equal(u8.astype(img.dtype) / 255.0, img):
+            return None
+        roi = to_roi(u8)
+        return ('u8', img.shape, img.dtype.str, (roi.y, roi.x), roi.crop.shape, roi.crop)
+
+    # GlyphROI (e.g. an RGBA line layer) stored as is
+    @staticmethod
+    def _encode_layer(roi):
+        return ('roi', (roi.height, roi.width), roi.crop.dtype.str, (roi.y, roi.x), roi.crop.shape, roi.crop)
+
+    @staticmethod
+    def _decode(entry):
+        kind, shape, dtype, offset, crop_shape, data = entry
+        if kind == 'roi':
+            return GlyphROI(offset[0], offset[1], data.copy(), shape[0], shape[1])
+        img = np.zeros(shape, dtype)
+        if kind == 'bits':
+            crop = np.unpackbits(data, count=int(np.prod(crop_shape))).reshape(crop_shape).astype(dtype)
+        else:
+            crop = data.astype(dtype) / 255.0
+        (y, x), (h, w) = offset, crop_shape[:2]
+        img[y:y+h, x:x+w] = crop
+        return img
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.roi.npz')  # .npz files of the old full-canvas format are ignored
+
+    def _load(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as f:
+                return (str(f['kind']), tuple(f['shape']), str(f['dtype']), tuple(f['offset']), tuple(f['crop_shape']), f['data'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Broken glyph cache file {path}: {e}')
+            return None
+
+    def _save(self, key, entry):
+        path = self._path(key)
+        kind, shape, dtype, offset, crop_shape, data = entry
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, kind=kind, shape=np.array(shape), dtype=dtype, offset=np.array(offset), crop_shape=np.array(crop_shape), data=data)
+            os.replace(tmp_path, path)  # atomic, several workers may write the same key
+        except OSError as e:
+            print(f'Failed to save glyph cache file {path}: {e}')
+
+
+def enable(max_mb=64, cache_dir=None):
+    global _cache
+    _cache = GlyphCache(max_mb=max_mb, cache_dir=cache_dir)
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def stats():
+    return _cache.stats() if _cache is not None else {}
+
+
+def _hash_arg(h, value):
+    if isinstance(value, ImageFont.FreeTypeFont):
+        if not isinstance(value.path, str):  # font loaded from bytes, no stable identity
+            return False
+        h.update(f'font:{os.path.abspath(value.path)}:{value.index}:{value.size}'.encode())
+    elif isinstance(value, str):
+        h.update(f'str:{value}'.encode())
+    elif isinstance(value, (np.ndarray, list, tuple)):
+        arr = np.asarray(value)
+        if arr.dtype == object:
+            return False
+        h.update(f'arr:{arr.dtype.str}:{arr.shape}'.encode())
+        h.update(np.ascontiguousarray(arr).tobytes())
+    else:
+        h.update(f'{type(value).__name__}:{value!r}'.encode())
+    return True
+
+
+'''
+Decorator for deterministic glyph renderers, cached only while enable() is active.
+binary: the render only contains 0/1 values and is bitpacked
+layer: the render is a GlyphROI, kept as it is
+'''
+def cached_glyph(binary=False, layer=False):
+    def decorator(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = _cache
+            if cache is None:
+                return fn(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            h = hashlib.sha1(fn.__name__.encode())
+            for name, value in bound.arguments.items():
+                h.update(name.encode())
+                if not _hash_arg(h, value):
+                    return fn(*args, **kwargs)
+            return cache.fetch(h.hexdigest(), lambda: fn(*args, **kwargs), binary, layer)
+        return wrapper
+    return decorator
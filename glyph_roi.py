@@ -0,0 +1,46 @@
+'''
+Sparse glyph records: a rendered glyph canvas is kept as the uint8 crop of its non-zero bbox plus
+the canvas size, instead of a full (h*scale, w*scale, 3) float64 image. Used by T3DataSet
+(sparse_glyphs=True), t3_collate and ControlLDM.get_input, which densifies on device.
+'''
+from collections import namedtuple
+import numpy as np
+import torch
+
+GlyphROI = namedtuple('GlyphROI', ['y', 'x', 'crop', 'height', 'width'])
+
+
+# full canvas in [0, 1] (or uint8 in [0, 255]), hwc -> GlyphROI of its non-zero pixels
+def to_roi(img):
+    height, width, channels = img.shape
+    mask = img.any(axis=2)
+    ys = np.flatnonzero(mask.any(axis=1))
+    xs = np.flatnonzero(mask.any(axis=0))
+    if len(ys) == 0:
+        return empty_roi(height, width, channels)
+    y0, y1, x0, x1 = ys[0], ys[-1] + 1, xs[0], xs[-1] + 1
+    if img.dtype == np.uint8:
+        crop = img[y0:y1, x0:x1].copy()
+    else:
+        crop = np.round(img[y0:y1, x0:x1] * 255).astype(np.uint8)
+    return GlyphROI(int(y0), int(x0), crop, height, width)
+
+
+def empty_roi(height, width, channels=3):
+    return GlyphROI(0, 0, np.zeros((0, 0, channels), np.uint8), height, width)
+
+
+def is_roi_batch(value):
+    return isinstance(value, (list, tuple)) and len(value) > 0 and isinstance(value[0], GlyphROI)
+
+
+# list of GlyphROI (one per sample) -> bhwc float tensor in [0, 1], same layout as a dense batch
+def densify(records, device=None, dtype=torch.float32):
+    r0 = records[0]
+    out = torch.zeros((len(records), r0.height, r0.width, r0.crop.shape[2]), device=device, dtype=dtype)
+    for b, r in enumerate(records):
+        if r.crop.size == 0:
+            continue
+        crop = torch.from_numpy(r.crop).to(device, non_blocking=True)
+        out[b, r.y:r.y+crop.shape[0], r.x:r.x+crop.shape[1]] = crop.to(dtype) / 255.
+    return out
@@ -0,0 +1,72 @@
+'''
+Training image decoding for T3DataSet: RGB uint8 resized to (img_wh, img_wh).
+With fast_decode=True JPEGs are decoded with PIL draft mode, the DCT is scaled down by 1/2, 1/4 or 1/8 while both sides
+stay >= img_wh, so large photos skip most of the decode work before the final cv2.resize.
+An optional disk cache keeps the resized images (keyed by path, file size/mtime and decode args)
+and is shared by dataloader workers.
+Usage:
+    loader = ImageLoader(512, cache_dir='./cache/images', fast_decode=True)
+    img = loader.load('a.jpg')  # hwc uint8 RGB, 512x512
+'''
+import os
+import hashlib
+import threading
+import numpy as np
+import cv2
+from PIL import Image
+
+
+class ImageLoader(object):
+    def __init__(self, img_wh=512, cache_dir=None, fast_decode=False):
+        self.img_wh = img_wh
+        self.cache_dir = cache_dir
+        self.fast_decode = fast_decode
+        self.hits = 0
+        self.decodes = 0
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def decode(self, path):
+        img = Image.open(path)
+        if self.fast_decode and img.format == 'JPEG':
+            img.draft('RGB', (self.img_wh, self.img_wh))
+        img = np.array(img.convert('RGB'))
+        if img.shape[0] != self.img_wh or img.shape[1] != self.img_wh:
+            img = cv2.resize(img, (self.img_wh, self.img_wh))
+        return img
+
+    def load(self, path):
+        if not self.cache_dir:
+            self.decodes += 1
+            return self.decode(path)
+        cache_path = self._path(path)
+        if os.path.exists(cache_path):
+            try:
+                img = np.load(cache_path)
+                self.hits += 1
+                return img
+            except (OSError, ValueError) as e:
+                print(f'Broken image cache file {cache_path}: {e}')
+        img = self.decode(path)
+        self.decodes += 1
+        self._save(cache_path, img)
+        return img
+
+    def stats(self):
+        return {'hits': self.hits, 'decodes': self.decodes}
+
+    def _path(self, path):
+        st = os.stat(path)
+        key = f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}:{self.img_wh}:{self.fast_decode}'
+        key = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def _save(self, cache_path, img):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, cache_path)  # atomic, several workers may write the same image
+        except OSError as e:
+            print(f'Failed to save image cache file {cache_path}: {e}')
@@ -48,6 +48,10 @@ class AutoencoderKL(pl.LightningModule):
 
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys=ignore_keys)
+        # memory bounded inference, see encode()/decode(). tile_size and tile_overlap are in latent pixels
+        self.tile_size = None
+        self.tile_overlap = 16
+        self.decode_batch_size = None
 
     def init_from_ckpt(self, path, ignore_keys=list()):
         sd = torch.load(path, map_location="cpu")["state_dict"]
@@ -80,16 +84,69 @@ class AutoencoderKL(pl.LightningModule):
             self.model_ema(self)
 
     def encode(self, x):
-        h = self.encoder(x)
-        moments = self.quant_conv(h)
+        if self.tile_size and max(x.shape[-2:]) > self.tile_size * 8:
+            moments = self.tiled_forward(lambda t: self.quant_conv(self.encoder(t)), x,
+                                         self.tile_size * 8, self.tile_overlap * 8, 1 / 8)
+        else:
+            h = self.encoder(x)
+            moments = self.quant_conv(h)
         posterior = DiagonalGaussianDistribution(moments)
         return posterior
 
     def decode(self, z):
+        if self.decode_batch_size and z.shape[0] > self.decode_batch_size:
+            return torch.cat([self.decode(_z) for _z in z.split(self.decode_batch_size)], dim=0)
         z = self.post_quant_conv(z)
+        if self.tile_size and max(z.shape[-2:]) > self.tile_size:
+            return self.tiled_forward(self.decoder, z, self.tile_size, self.tile_overlap, 8)
         dec = self.decoder(z)
         return dec
 
+    '''
+    Run fn over overlapping tile x tile crops of x and blend the outputs with linear ramps in the
+    overlaps, so peak activation memory depends on the tile size instead of the image size.
+    scale: output/input resolution ratio of fn (8 for the decoder, 1/8 for the encoder)
+    '''
+    def tiled_forward(self, fn, x, tile, overlap, scale):
+        h, w = x.shape[-2:]
+        overlap = min(overlap, tile // 2)
+        ys = self._tile_starts(h, tile, tile - overlap)
+        xs = self._tile_starts(w, tile, tile - overlap)
+        out, weight = None, None
+        for y in ys:
+            for x0 in xs:
+                tile_out = fn(x[..., y:y+tile, x0:x0+tile])
+                if out is None:
+                    out = torch.zeros((x.shape[0], tile_out.shape[1], round(h*scale), round(w*scale)), device=tile_out.device, dtype=tile_out.dtype)
+                    weight = torch.zeros((1, 1) + out.shape[-2:], device=tile_out.device, dtype=tile_out.dtype)
+                th, tw = tile_out.shape[-2:]
+                oy, ox = round(y*scale), round(x0*scale)
+                mask = self._blend_mask(th, tw, round(overlap*scale), y > 0, y + tile < h, x0 > 0, x0 + tile < w, tile_out)
+                out[..., oy:oy+th, ox:ox+tw] += tile_out * mask
+                weight[..., oy:oy+th, ox:ox+tw] += mask
+        return out / weight
+
+    @staticmethod
+    def _tile_starts(size, tile, stride):
+        starts = list(range(0, max(size - tile, 0) + 1, stride))
+        if starts[-1] + tile < size:
+            starts += [size - tile]
+        return starts
+
+    @staticmethod
+    def _blend_mask(h, w, overlap, top, bottom, left, right, ref):
+        def ramp(n, start, end):
+            r = torch.ones(n, device=ref.device, dtype=ref.dtype)
+            k = min(overlap, n)
+            if k > 0:
+                line = torch.arange(1, k + 1, device=ref.device, dtype=ref.dtype) / (k + 1)
+                if start:
+                    r[:k] = line
+                if end:
+                    r[-k:] = torch.minimum(r[-k:], line.flip(0))
+            return r
+        return ramp(h, top, bottom)[:, None] * ramp(w, left, right)[None, :]
+
     def forward(self, input, sample_posterior=True):
         posterior = self.encode(input)
         if sample_posterior:
@@ -23,6 +23,7 @@ from ldm.models.autoencoder import IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from ldm.models.diffusion.ddim import DDIMSampler
 from cldm.recognizer import crop_image
+from packed_lines import is_packed, get_line, line_offsets
 import cv2
 
 
@@ -1006,20 +1007,28 @@ class LatentDiffusion(DDPM):
             x0_texts = []
             x0_texts_ori = []
 
+            text_info = cond['text_info']
+            offsets = line_offsets(text_info['n_lines'])  # rows of packed lines, see packed_lines.py
+            packed_pos = None
+            if is_packed(text_info):  # one device to host copy for all lines
+                packed_pos = rearrange(text_info['positions']*255., 'l c h w -> l h w c').detach().cpu().numpy().astype(np.uint8)
             for i in range(bsz):
-                n_lines = cond['text_info']['n_lines'][i]  # batch size
+                n_lines = text_info['n_lines'][i]  # batch size
                 for j in range(n_lines):  # line
-                    lang = cond['text_info']['language'][j][i]
+                    lang = get_line(text_info, 'language', i, j, offsets)
                     if lang == 'Chinese':
                         lang_weight += [1.0]
                     elif lang == 'Latin':
                         lang_weight += [self.latin_weight]
                     else:
                         lang_weight += [1.0]  # unsupport language, TODO
-                    gt_texts += [cond['text_info']['texts'][j][i]]
-                    pos = cond['text_info']['positions'][j][i]*255.
-                    pos = rearrange(pos, 'c h w -> h w c')
-                    np_pos = pos.detach().cpu().numpy().astype(np.uint8)
+                    gt_texts += [get_line(text_info, 'texts', i, j, offsets)]
+                    if packed_pos is not None:
+                        np_pos = packed_pos[offsets[i] + j]
+                    else:
+                        pos = get_line(text_info, 'positions', i, j, offsets)*255.
+                        pos = rearrange(pos, 'c h w -> h w c')
+                        np_pos = pos.detach().cpu().numpy().astype(np.uint8)
                     x0_text = crop_image(decode_x0[i], np_pos)
                     x0_texts += [x0_text]
                     x0_text_ori = crop_image(origin_x0[i], np_pos)
@@ -99,6 +99,31 @@ def extract_into_tensor(a, t, x_shape):
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
 
+def is_batch_broadcast(x):
+    """
+    True if x is a batch of one sample expanded along dim 0 (stride 0), e.g. text_info tensors
+    of a single request, so per-sample work can be done once and broadcast.
+    """
+    return torch.is_tensor(x) and x.dim() > 0 and (x.shape[0] == 1 or x.stride(0) == 0)
+
+
+def select_batch(x, index, batch_size):
+    """
+    Rows index (LongTensor) of every batch_size-long tensor or list of scalars in a nested
+    conditioning structure (dicts, lists, tuples, e.g. cond/text_info), other values are kept.
+    Returns new containers, x is not modified.
+    """
+    if torch.is_tensor(x):
+        return x.index_select(0, index.to(x.device)) if x.dim() > 0 and x.shape[0] == batch_size else x
+    if isinstance(x, dict):
+        return {k: select_batch(v, index, batch_size) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        if len(x) == batch_size and all([isinstance(v, (int, float, str)) for v in x]):  # e.g. n_lines
+            return type(x)([x[i] for i in index.tolist()])
+        return type(x)([select_batch(v, index, batch_size) for v in x])
+    return x
+
+
 def checkpoint(func, inputs, params, flag):
     """
     Evaluate a function without caching intermediate activations, allowing for
@@ -0,0 +1,231 @@
+'''
+Streaming reader for {"data_root": ..., "data_list": [...]} manifests. Records of data_list are
+parsed one at a time from a file buffer and yielded right away, so only a prefix is read when a
+limit is given and multi-GB manifests are read in bounded memory. A full pass also writes a sidecar
+index (<manifest>.index.npz: top level keys, byte offset/length of every record), later opens
+seek straight to the records and know the record count without parsing.
+A manifest path can also be a glob pattern or a directory of sharded manifest files.
+Cutting at a fraction of the records (T3DataSet percent < 1) needs len(), which is only cheap with
+an index: the first open of a manifest without one parses it fully once and writes the index.
+Usage:
+    from manifest import Manifest, iter_data_list
+    for gt in iter_data_list('poem_data/poem_data.json', limit=1000):
+        ...
+    m = Manifest('poem_data/poem_data.json')
+    print(len(m), m.get_meta('data_root'), m[0])
+'''
+import os
+import glob
+import json
+import ujson
+import numpy as np
+
+INDEX_SUFFIX = '.index.npz'
+CHUNK_SIZE = 1 << 20
+_WHITESPACE = ' \t\r\n'
+_NUMBER_CHARS = '0123456789.eE+-'
+_decoder = json.JSONDecoder()
+
+
+class _TextStream(object):
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.mark = 0  # byte offset of buf[mark] is mark_byte
+        self.mark_byte = 0
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.byte_offset(self.pos)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = self.mark = 0
+        return True
+
+    # byte offset in the file of buf[i], i must not go backwards
+    def byte_offset(self, i):
+        self.mark_byte += len(self.buf[self.mark:i].encode('utf-8'))
+        self.mark = i
+        return self.mark_byte
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos] if self.pos < len(self.buf) else ''
+
+    # consume one of chars, return it
+    def expect(self, chars):
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError(f'Bad manifest {self.f.name}: expected one of {chars!r}, got {c!r} near byte {self.byte_offset(self.pos)}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+                # a number cut by the end of the buffer (e.g. '1.' of '1.5') decodes as a shorter one
+                if self.eof or (end < len(self.buf) and self.buf[end] not in _NUMBER_CHARS):
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+        start, self.pos = self.pos, end
+        return obj, start, end
+
+
+'''
+Parse a manifest file incrementally.
+yield ('meta', key, value) for top level keys and ('record', obj, byte offset, byte length) for data_list items
+'''
+def scan_manifest(path, chunk_size=CHUNK_SIZE):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        s = _TextStream(f, chunk_size)
+        if s.peek() == '\ufeff':
+            s.pos += 1
+        s.expect('{')
+        if s.peek() == '}':
+            return
+        while True:
+            key, _, _ = s.value()
+            s.expect(':')
+            if key == 'data_list':
+                s.expect('[')
+                if s.peek() == ']':
+                    s.pos += 1
+                else:
+                    while True:
+                        obj, start, end = s.value()
+                        offset = s.byte_offset(start)
+                        yield 'record', obj, offset, s.byte_offset(end) - offset
+                        if s.expect(',]') == ']':
+                            break
+            else:
+                value, _, _ = s.value()
+                yield 'meta', key, value
+            if s.expect(',}') == '}':
+                break
+
+
+class Manifest(object):
+    def __init__(self, path, write_index=True):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.write_index = write_index
+        self.meta = {}
+        self.offsets = None  # (n, 2) int64 byte offset, length of every record
+        self.load_index()
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            st = os.stat(self.path)
+            with np.load(self.index_path) as f:
+                if int(f['size']) != st.st_size or int(f['mtime_ns']) != st.st_mtime_ns:
+                    print(f'Manifest {self.path} changed, rebuilding its index')
+                    return
+                self.meta = json.loads(str(f['meta']))
+                self.offsets = f['offsets']
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Broken manifest index {self.index_path}: {e}')
+
+    def save_index(self, meta, offsets):
+        st = os.stat(self.path)
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, meta=json.dumps(meta, ensure_ascii=False), offsets=offsets, size=st.st_size, mtime_ns=st.st_mtime_ns)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f'Failed to save manifest index {self.index_path}: {e}')
+
+    def build_index(self):
+        meta, offsets = {}, []
+        for item in scan_manifest(self.path):
+            if item[0] == 'meta':
+                meta[item[1]] = item[2]
+            else:
+                offsets += [item[2:]]
+        self.meta = meta
+        self.offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+        if self.write_index:
+            self.save_index(meta, self.offsets)
+
+    # top level value, e.g. data_root. Known once the stream has passed it, otherwise the index is built
+    def get_meta(self, key, default=None):
+        if key not in self.meta and self.offsets is None:
+            self.build_index()
+        return self.meta.get(key, default)
+
+    def __len__(self):
+        if self.offsets is None:
+            self.build_index()
+        return len(self.offsets)
+
+    def __getitem__(self, item):
+        if self.offsets is None:
+            self.build_index()
+        offset, length = self.offsets[item]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return ujson.loads(f.read(length))
+
+    # data_list records in order, stops after limit records
+    def records(self, limit=None):
+        if self.offsets is not None:
+            with open(self.path, 'rb') as f:
+                for offset, length in self.offsets[:limit]:
+                    f.seek(offset)
+                    yield ujson.loads(f.read(length))
+            return
+        meta, offsets = {}, []
+        for item in scan_manifest(self.path):
+            if item[0] == 'meta':
+                meta[item[1]] = item[2]
+                self.meta.setdefault(item[1], item[2])
+                continue
+            if limit is not None and len(offsets) >= limit:
+                return
+            offsets += [item[2:]]
+            yield item[1]
+        self.meta = meta
+        self.offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+        if self.write_index:
+            self.save_index(meta, self.offsets)
+
+
+# manifest paths, glob patterns or directories of *.json shards -> sorted manifest files
+def expand_manifest_paths(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files += sorted(glob.glob(os.path.join(p, '*.json')))
+        elif any([c in p for c in '*?[']):
+            files += sorted(glob.glob(p))
+        else:
+            files += [p]
+    return files
+
+
+# records of data_list of one or more manifests, stops after limit records in total
+def iter_data_list(paths, limit=None):
+    n = 0
+    for path in expand_manifest_paths(paths):
+        for gt in Manifest(path).records(None if limit is None else limit - n):
+            yield gt
+            n += 1
+        if limit is not None and n >= limit:
+            return
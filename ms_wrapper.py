@@ -12,12 +12,17 @@ import numpy as np
 import cv2
 import einops
 import time
-from PIL import ImageFont
+import threading
 from cldm.model import create_model, load_state_dict
-from cldm.ddim_hacked import DDIMSampler
-from t3_dataset import draw_glyph, draw_glyph2, draw_font_hint
+from cldm.ddim_hacked import DDIMSampler, SamplingCancelled
+from t3_dataset import draw_glyph, draw_glyph2, draw_glyphs, draw_font_hint
+import glyph_cache
+import font_pool
+from font_pool import get_font
 from cldm.recognizer import crop_image
-from util import check_channels, resize_image
+from font_hint_bg import hollow_font_hint
+import pos_analysis
+from util import check_channels, resize_image, LRUCache, PersistentLRUCache
 from safetensors import safe_open
 from modelscope.pipelines import pipeline
 from modelscope.utils.constant import Tasks
@@ -26,9 +31,20 @@ from lora_util import get_diffusers_unet, convert_unet_state_dict_to_sd
 from bert_tokenizer import BasicTokenizer
 checker = BasicTokenizer()
 PLACE_HOLDER = '*'
+# linear approximation of the SD1.5 vae decoder, maps the 4 latent channels to RGB in [-1, 1]
+LATENT_RGB_FACTORS = [[0.298, 0.207, 0.208],
+                      [0.187, 0.286, 0.173],
+                      [-0.158, 0.189, 0.264],
+                      [-0.184, -0.271, -0.473]]
 max_chars = 20
 
 
+# host copy for fast async uploads, pinned only when there is a GPU to upload to
+def to_host(t):
+    t = t.detach().to('cpu', copy=True)
+    return t.pin_memory() if torch.cuda.is_available() else t
+
+
 class AnyText2Model(TorchModel):
 
     def __init__(self, model_dir, *args, **kwargs):
@@ -38,7 +54,20 @@ class AnyText2Model(TorchModel):
         self.lora_ratios = []
         self.use_fp16 = kwargs.get('use_fp16', True)
         self.use_translator = kwargs.get('use_translator', True)
+        self.translator_mode = kwargs.get('translator_mode', 'lazy')  # lazy: load on first chinese prompt, background or eager
+        self.trans_pipe = None
+        self.trans_lock = threading.Lock()
+        self.trans_run_lock = threading.Lock()  # prepare() may run on several threads, the pipeline is not thread-safe
+        self.trans_cache = PersistentLRUCache(kwargs.get('translation_cache_path', os.path.join(model_dir, 'translation_cache.json')),
+                                              max_size=kwargs.get('translation_cache_size', 4096))  # normalized prompt -> translation
         self.unet = get_diffusers_unet()
+        self.uncond_cache = LRUCache(max_size=kwargs.get('uncond_cache_size', 16))  # n_prompt -> unconditional CLIP outputs
+        self.lora_cache = LRUCache(max_size=kwargs.get('lora_cache_size', 4))  # (base_model_path, loras) -> merged tensors
+        self.lora_base_weights = None
+        self.lora_merged_keys = []
+        if kwargs.get('glyph_cache_mb', 128) > 0:  # repeated layouts skip glyph rendering
+            glyph_cache.enable(max_mb=kwargs.get('glyph_cache_mb', 128), cache_dir=kwargs.get('glyph_cache_dir', None))
+        font_pool.set_max_size(kwargs.get('font_pool_size', 512))  # (font path, size) -> FreeTypeFont
         self.init_model(**kwargs)
 
     '''
@@ -49,14 +78,34 @@ class AnyText2Model(TorchModel):
         debug_info: string for debug, only valid if show_debug=True
     '''
     def forward(self, input_tensor, **forward_params):
+        job = self.preprocess(input_tensor, **forward_params)
+        if isinstance(job, tuple):  # error
+            return job
+        return self.sample_jobs([job])[0]
+
+    '''
+    Parse the inputs of one request and run everything that is independent of the
+    unet/text-encoder weights (glyph rendering, positions, font hint, masked_x).
+    return:
+        job: dict consumed by sample_jobs(), or an error tuple in the format of forward()
+    '''
+    def preprocess(self, input_tensor, **forward_params):
+        job = self.prepare(input_tensor, **forward_params)
+        if isinstance(job, tuple):  # error
+            return job
+        return self.upload(job)
+
+    '''
+    CPU half of preprocess(), does not touch the GPU or the torch RNG, so it can run on another
+    thread while the previous request is sampling. text_info arrays are kept in numpy.
+    '''
+    def prepare(self, input_tensor, **forward_params):
         tic = time.time()
         str_warning = ''
         # get inputs
         seed = input_tensor.get('seed', -1)
         if seed == -1:
             seed = random.randint(0, 99999999)
-        from pytorch_lightning import seed_everything
-        seed_everything(seed)
         img_prompt = input_tensor.get('img_prompt')
         text_prompt = input_tensor.get('text_prompt')
         draw_pos = input_tensor.get('draw_pos')
@@ -80,29 +129,14 @@ class AnyText2Model(TorchModel):
         base_model_path = forward_params.get('base_model_path', '')
         lora_path_ratio = forward_params.get('lora_path_ratio', '')
         glyline_font_path = forward_params.get('glyline_font_path', '')
-        font_hint_image = forward_params.get('font_hint_image', None)
-        font_hint_mask = forward_params.get('font_hint_mask', None)
+        font_hint_image = forward_params.get('font_hint_image') or []
+        font_hint_mask = forward_params.get('font_hint_mask') or []
         text_colors = forward_params.get('text_colors', '')
+        progress_callback = forward_params.get('progress_callback', None)  # fn(step, total_steps, previews)
+        preview_every = forward_params.get('preview_every', 5)
+        cancel_token = forward_params.get('cancel_token', None)  # e.g. threading.Event, checked between steps, a batched job is dropped from the batch
 
-        # change base model or merge loras
-        lora_paths = []
-        lora_ratios = []
-        if lora_path_ratio:
-            lora_split = lora_path_ratio.strip().split()
-            assert len(lora_split) % 2 == 0, "Wrong Format of [LoRA Path and Ratio]: /path/of/lora1.pth ratio1 /path/of/lora2.pth ratio2 ..."
-            for idx in range(len(lora_split)//2):
-                lora_paths += [lora_split[idx*2+0]]
-                lora_ratios += [float(lora_split[idx*2+1])]
-        if base_model_path != self.base_model_path or sorted(lora_paths) != sorted(self.lora_paths) or sorted(lora_ratios) != sorted(self.lora_ratios):
-            if base_model_path:
-                self.load_base_model(base_model_path)
-            else:
-                self.load_weights()
-            if len(lora_paths) > 0:
-                self.merge_loras(lora_paths, lora_ratios)
-        self.base_model_path = base_model_path
-        self.lora_paths = lora_paths
-        self.lora_ratios = lora_ratios
+        lora_paths, lora_ratios = self.parse_lora_path_ratio(lora_path_ratio)
 
         img_prompt, _ = self.modify_prompt(img_prompt)
         text_prompt, texts = self.modify_prompt(text_prompt)
@@ -142,29 +176,22 @@ class AnyText2Model(TorchModel):
         pos_imgs = pos_imgs[..., 0:1]
         pos_imgs = cv2.convertScaleAbs(pos_imgs)
         _, pos_imgs = cv2.threshold(pos_imgs, 254, 255, cv2.THRESH_BINARY)
-        # seprate pos_imgs
-        pos_imgs = self.separate_pos_imgs(pos_imgs, sort_priority)
-        if len(pos_imgs) == 0:
-            pos_imgs = [np.zeros((h, w, 1))]
-        if len(pos_imgs) < n_lines:
+        # seprate pos_imgs, polygons and masks of all positions from one labels image
+        pos_regions = self.separate_pos_imgs(pos_imgs, sort_priority)
+        n_pos = max(len(pos_regions), 1)  # no position: one empty position
+        if n_pos < n_lines:
             if n_lines == 1 and texts[0] == ' ':
                 pass  # text-to-image without text
             else:
-                return None, -1, f'Found {len(pos_imgs)} positions that < needed {n_lines} from prompt, check and try again!', ''
-        elif len(pos_imgs) > n_lines:
-            str_warning = f'Warning: found {len(pos_imgs)} positions that > needed {n_lines} from prompt.'
+                return None, -1, f'Found {n_pos} positions that < needed {n_lines} from prompt, check and try again!', ''
+        elif n_pos > n_lines:
+            str_warning = f'Warning: found {n_pos} positions that > needed {n_lines} from prompt.'
         # get pre_pos, poly_list, hint that needed for anytext
-        pre_pos = []
-        poly_list = []
-        for input_pos in pos_imgs:
-            if input_pos.mean() != 0:
-                input_pos = input_pos[..., np.newaxis] if len(input_pos.shape) == 2 else input_pos
-                poly, pos_img = self.find_polygon(input_pos)
-                pre_pos += [pos_img/255.]
-                poly_list += [poly]
-            else:
-                pre_pos += [np.zeros((h, w, 1))]
-                poly_list += [None]
+        pre_pos = [pos_analysis.to_full(r, *pos_imgs.shape[:2])/255. for r in pos_regions]
+        poly_list = [r.polygon for r in pos_regions]
+        if len(pos_regions) == 0:
+            pre_pos = [np.zeros((h, w, 1))]
+            poly_list = [None]
         np_hint = np.sum(pre_pos, axis=0).clip(0, 1)
         # prepare info dict
         info = {}
@@ -173,6 +200,7 @@ class AnyText2Model(TorchModel):
         info['positions'] = []
         info['n_lines'] = [len(texts)]*img_count
         font_hint = []
+        font_hint_rois = None  # boxes of the font_hint lines, default: bbox of the whole font_hint
         font_paths = ['None' for i in range(len(texts))]
         if glyline_font_path:
             glyline_font_path = glyline_font_path[:len(texts)]
@@ -184,16 +212,16 @@ class AnyText2Model(TorchModel):
 
         gly_pos_imgs = []
         font_hint_mimic_imgs = []
+        gly_scale = self.model.control_model.glyph_scale
+        batched_glyphs = not revise_pos  # per-line glyph canvases are only needed to revise positions
+        valid_lines = []
         for i in range(len(texts)):
             text = texts[i]
             if len(text) > max_chars:
                 str_warning = f'"{text}" length > max_chars: {max_chars}, will be cut off...'
                 text = text[:max_chars]
-            gly_scale = self.model.control_model.glyph_scale
             if pre_pos[i].mean() != 0:
                 gly_line = draw_glyph(self.font, text)
-                glyphs = draw_glyph2(self.font, text, poly_list[i], info['colors'][i], scale=gly_scale, width=w, height=h, add_space=True)
-
                 if i < len(font_hint_image) and font_hint_image[i] is not None:
                     hint_poly = font_hint_mask[i]
                     poly, _ = self.find_polygon(hint_poly)
@@ -203,37 +231,85 @@ class AnyText2Model(TorchModel):
                     font_paths[i] = 'None'  # not render
                 else:
                     font_hint_mimic_imgs += [None]
-                font_hint_line = draw_glyph2(font_paths[i], text, poly_list[i], np.array([255, 255, 255]), scale=1, width=w, height=h, add_space=True)
-                gly_pos_img = cv2.drawContours(glyphs*255, [poly_list[i]*gly_scale], 0, (255, 255, 255), 1)
-                if revise_pos:
+                valid_lines += [(i, text)]
+                if not batched_glyphs:
+                    glyphs = draw_glyph2(self.font, text, poly_list[i], info['colors'][i], scale=gly_scale, width=w, height=h, add_space=True)
+                    font_hint_line = draw_glyph2(font_paths[i], text, poly_list[i], np.array([255, 255, 255]), scale=1, width=w, height=h, add_space=True)
+                    gly_pos_img = cv2.drawContours(glyphs*255, [poly_list[i]*gly_scale], 0, (255, 255, 255), 1)
                     resize_gly = cv2.resize(glyphs, (pre_pos[i].shape[1], pre_pos[i].shape[0]))
-                    new_pos = cv2.morphologyEx((resize_gly*255).astype(np.uint8), cv2.MORPH_CLOSE, kernel=np.ones((resize_gly.shape[0]//10, resize_gly.shape[1]//10), dtype=np.uint8), iterations=1)
-                    new_pos = new_pos[..., np.newaxis] if len(new_pos.shape) == 2 else new_pos
-                    contours, _ = cv2.findContours(new_pos[..., 0:1], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+                    kernel = np.ones((resize_gly.shape[0]//10, resize_gly.shape[1]//10), dtype=np.uint8)
+                    closed, x0, y0 = pos_analysis.close_roi((resize_gly*255).astype(np.uint8), kernel)
+                    contours = []
+                    if closed is not None:
+                        closed = closed[..., np.newaxis] if len(closed.shape) == 2 else closed
+                        contours, _ = cv2.findContours(np.ascontiguousarray(closed[..., 0]), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
                     if len(contours) != 1:
                         str_warning = f'Fail to revise position {i} to bounding rect, remain position unchanged...'
                     else:
                         rect = cv2.minAreaRect(contours[0])
                         poly = np.int0(cv2.boxPoints(rect))
+                        new_pos = np.zeros(pre_pos[i].shape[:2] + (1,), np.uint8)
+                        new_pos[y0:y0+closed.shape[0], x0:x0+closed.shape[1]] = closed[..., 0:1]
                         pre_pos[i] = cv2.drawContours(new_pos, [poly], -1, 255, -1) / 255.
                         gly_pos_img = cv2.drawContours(glyphs*255, [poly*gly_scale], 0, (255, 255, 255), 1)
-                gly_pos_imgs += [gly_pos_img]  # for show
+                    gly_pos_imgs += [gly_pos_img]  # for show
             else:
-                glyphs = np.zeros((h*gly_scale, w*gly_scale, 3))
                 gly_line = np.zeros((80, 512, 1))
-                gly_pos_imgs += [np.zeros((h*gly_scale, w*gly_scale, 1))]  # for show
-                font_hint_line = np.zeros((h, w, 3))
+                if not batched_glyphs:
+                    glyphs = np.zeros((h*gly_scale, w*gly_scale, 3))
+                    gly_pos_imgs += [np.zeros((h*gly_scale, w*gly_scale, 1))]  # for show
+                    font_hint_line = np.zeros((h, w, 3))
             pos = pre_pos[i][..., 0:1]
-            info['glyphs'] += [self.arr2tensor(glyphs, img_count)]
-            info['gly_line'] += [self.arr2tensor(gly_line, img_count)]
-            info['positions'] += [self.arr2tensor(pos, img_count)]
-            info['colors'][i] = self.arr2tensor(info['colors'][i], img_count)/255.
-            font_hint += [font_hint_line]
+            if not batched_glyphs:
+                info['glyphs'] += [glyphs]
+                font_hint += [font_hint_line]
+            info['gly_line'] += [gly_line]
+            info['positions'] += [pos]
+        if batched_glyphs:
+            # ControlNet only uses the sum of the glyph canvases, render all lines onto one
+            idxs = [i for i, _ in valid_lines]
+            line_texts = [text for _, text in valid_lines]
+            glyphs = draw_glyphs(self.font, line_texts, [poly_list[i] for i in idxs], [info['colors'][i] for i in idxs],
+                                 scale=gly_scale, width=w, height=h, add_space=True)
+            info['glyphs'] = [glyphs]
+            gly_pos_imgs = [cv2.drawContours(glyphs*255, [poly_list[i]*gly_scale for i in idxs], -1, (255, 255, 255), 1)] if idxs else []  # for show
+            font_hint_canvas, font_hint_lines = draw_glyphs([font_paths[i] for i in idxs], line_texts, [poly_list[i] for i in idxs], [np.array([255, 255, 255])] * len(idxs),
+                                                            scale=1, width=w, height=h, add_space=True, return_lines=True)
+            font_hint = [font_hint_canvas]
+            font_hint_rois = [(r.x, r.y, r.crop.shape[1], r.crop.shape[0]) for r in font_hint_lines]
         font_hint_mimic_imgs = [font_hint_mimic_imgs] * img_count
-        self.model.embedding_manager.font_hint_mimic_imgs = font_hint_mimic_imgs
-        # get masked_x
         masked_img = ((edit_image.astype(np.float32) / 127.5) - 1.0 - np_hint*10).clip(-1, 1)
-        masked_img = np.transpose(masked_img, (2, 0, 1))
+
+        font_hint_fg = np.sum(font_hint, axis=0).clip(0, 1)[..., 0:1]*255
+        if font_hollow and font_hint_fg.mean() > 0:
+            font_hint_bg = hollow_font_hint(font_hint_fg[..., 0], kernel_sizes=(2, 3), rois=font_hint_rois)[..., None]
+        else:
+            font_hint_bg = font_hint_fg
+
+        info['font_hint'] = font_hint_bg/255
+
+        job = dict(tic=tic, seed=seed, str_warning=str_warning, show_debug=show_debug, img_count=img_count, w=w, h=h,
+                   ddim_steps=ddim_steps, strength=strength, attnx_scale=attnx_scale, cfg_scale=cfg_scale, eta=eta,
+                   base_model_path=base_model_path, lora_paths=lora_paths, lora_ratios=lora_ratios,
+                   img_prompt=img_prompt, text_prompt=text_prompt, a_prompt=a_prompt, n_prompt=n_prompt, texts=texts,
+                   info=info, hint=np_hint, masked_img=masked_img, font_hint_mimic_imgs=font_hint_mimic_imgs,
+                   gly_pos_imgs=gly_pos_imgs, font_hint_bg=font_hint_bg, progress_callback=progress_callback,
+                   preview_every=preview_every, cancel_token=cancel_token)
+        return job
+
+    # GPU half of preprocess(): seed, move text_info to device and encode masked_x
+    def upload(self, job):
+        from pytorch_lightning import seed_everything
+        seed_everything(job['seed'])
+        img_count = job['img_count']
+        info = job['info']
+        info['glyphs'] = [self.arr2tensor(arr, img_count) for arr in info['glyphs']]
+        info['gly_line'] = [self.arr2tensor(arr, img_count) for arr in info['gly_line']]
+        info['positions'] = [self.arr2tensor(arr, img_count) for arr in info['positions']]
+        info['colors'] = [(self.arr2tensor(arr, 1)/255.).expand(img_count, -1) for arr in info['colors']]
+        info['font_hint'] = self.arr2tensor(info['font_hint'], img_count)
+        # get masked_x
+        masked_img = np.transpose(job.pop('masked_img'), (2, 0, 1))
         masked_img = torch.from_numpy(masked_img.copy()).float().cuda(0)
         if self.use_fp16:
             masked_img = masked_img.half()
@@ -241,51 +317,147 @@ class AnyText2Model(TorchModel):
         masked_x = self.model.get_first_stage_encoding(encoder_posterior).detach()
         if self.use_fp16:
             masked_x = masked_x.half()
-        info['masked_x'] = torch.cat([masked_x for _ in range(img_count)], dim=0)
-
-        hint = self.arr2tensor(np_hint, img_count)
-
-        font_hint_fg = np.sum(font_hint, axis=0).clip(0, 1)[..., 0:1]*255
-        if font_hollow and font_hint_fg.mean() > 0:
-            img = cv2.imread('font/bg_noise.png')
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            img = cv2.resize(img, (font_hint_fg.shape[1], font_hint_fg.shape[0]))
-            img[img < 230] = 0
-            font_hint_bg = cv2.adaptiveThreshold(img.astype(np.uint8), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-            kernel1 = np.ones((2, 2), dtype=np.uint8)
-            kernel2 = np.ones((3, 3), dtype=np.uint8)
-            dilate_img1 = cv2.dilate(font_hint_fg[..., 0].astype(np.uint8), kernel1, iterations=1)
-            dilate_img2 = cv2.dilate(font_hint_fg[..., 0].astype(np.uint8), kernel2, iterations=1)
-            dilate_text = dilate_img2 - dilate_img1
-            result = (font_hint_fg[..., 0]-font_hint_bg + dilate_text).clip(0, 255)
-            font_hint_bg[font_hint_fg[..., 0] > 0] = 0
-            result = (result + font_hint_bg).clip(0, 255)
-            font_hint_bg = result[..., None]
-        else:
-            font_hint_bg = font_hint_fg
+        info['masked_x'] = masked_x.expand(img_count, -1, -1, -1)
+        job['hint'] = self.arr2tensor(job['hint'], img_count)
+        return job
 
-        info['font_hint'] = self.arr2tensor((font_hint_bg/255), img_count)
-        cond = self.model.get_learned_conditioning(dict(c_concat=[hint], c_crossattn=[[[img_prompt + ', ' + a_prompt] * img_count, [text_prompt] * img_count]], text_info=info))
-        un_cond = self.model.get_learned_conditioning(dict(c_concat=[hint], c_crossattn=[[[n_prompt] * img_count, [""] * img_count]], text_info=info))
+    '''
+    Jobs sampled together must share the same batch_key(), their text_info are merged
+    into one DDIM batch and the results are split back per job.
+    seeded_noise: draw x_T from each job's own seed, always used when len(jobs) > 1
+    return:
+        list of (result, rst_code, str_warning, debug_info), one per job
+    '''
+    def sample_jobs(self, jobs, seeded_noise=False):
+        job0 = jobs[0]
+        assert all(self.batch_key(job) == self.batch_key(job0) for job in jobs), 'Incompatible jobs in one batch!'
+        self.switch_weights(job0['base_model_path'], job0['lora_paths'], job0['lora_ratios'])
+        h, w = job0['h'], job0['w']
+        img_count = sum([job['img_count'] for job in jobs])
+        info = self.collate_text_info([job['info'] for job in jobs])
+        hint = torch.cat([job['hint'] for job in jobs], dim=0)
+        img_prompts, text_prompts = [], []
+        font_hint_mimic_imgs = []
+        for job in jobs:
+            img_prompts += [job['img_prompt'] + ', ' + job['a_prompt']] * job['img_count']
+            text_prompts += [job['text_prompt']] * job['img_count']
+            font_hint_mimic_imgs += job['font_hint_mimic_imgs']
+        self.model.embedding_manager.font_hint_mimic_imgs = font_hint_mimic_imgs
+        cond = self.model.get_learned_conditioning(dict(c_concat=[hint], c_crossattn=[[img_prompts, text_prompts]], text_info=info))
+        un_cond = self.get_uncond_conditioning(jobs, hint, info)
 
         shape = (4, h // 8, w // 8)
-        self.model.control_scales = ([strength] * 13)
-        self.model.attnx_scale = attnx_scale
-        samples, intermediates = self.ddim_sampler.sample(ddim_steps, img_count,
-                                                          shape, cond, verbose=False, eta=eta,
-                                                          unconditional_guidance_scale=cfg_scale,
-                                                          unconditional_conditioning=un_cond)
-        self.model.embedding_manager.font_hint_mimic_imgs = None  # reset mimic imgs
+        x_T = None
+        if seeded_noise or len(jobs) > 1:
+            x_T = torch.cat([torch.randn((job['img_count'],) + shape, device=self.model.device,
+                                         generator=torch.Generator(device=self.model.device).manual_seed(job['seed']))
+                             for job in jobs], dim=0)
+        self.model.control_scales = ([job0['strength']] * 13)
+        self.model.attnx_scale = job0['attnx_scale']
+        cancel_token = BatchCancelToken(jobs)
+        try:
+            samples, intermediates = self.ddim_sampler.sample(job0['ddim_steps'], img_count,
+                                                              shape, cond, verbose=False, eta=job0['eta'], x_T=x_T,
+                                                              unconditional_guidance_scale=job0['cfg_scale'],
+                                                              unconditional_conditioning=un_cond,
+                                                              img_callback=self.get_preview_callback(jobs, cancel_token),
+                                                              cancel_token=cancel_token)
+        except SamplingCancelled as e:
+            print(f'{e}, {len(jobs)} job(s) aborted')
+            return [(None, -1, f'Cancelled at step {e.step}/{job0["ddim_steps"]}', '') for _ in jobs]
+        finally:
+            self.model.embedding_manager.font_hint_mimic_imgs = None  # reset mimic imgs
         if self.use_fp16:
             samples = samples.half()
         x_samples = self.model.decode_first_stage(samples)
         x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
-        results = [x_samples[i] for i in range(img_count)]
+
+        outputs = []
+        n_idx = 0
+        for k, job in enumerate(jobs):
+            if not cancel_token.active[k]:  # dropped from the batch during sampling
+                outputs += [(None, -1, 'Cancelled', '')]
+                continue
+            results = [x_samples[i] for i in range(n_idx, n_idx + job['img_count'])]
+            n_idx += job['img_count']
+            if cancel_token.cancelled(k):  # cancelled after the last step
+                outputs += [(None, -1, 'Cancelled', '')]
+                continue
+            outputs += [self.postprocess(job, results)]
+        return outputs
+
+    '''
+    Cheap preview of pred_x0 with a linear latent->RGB projection instead of decode_first_stage,
+    returns uint8 images at 1/8 of the output size.
+    '''
+    def latent_preview(self, x):
+        factors = torch.tensor(LATENT_RGB_FACTORS, dtype=x.dtype, device=x.device)
+        rgb = torch.einsum('bchw,cr->bhwr', x, factors)
+        return ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+
+    # img_callback for DDIMSampler, sends previews of every job's images to its progress_callback,
+    # pred_x0 only holds the jobs still active in cancel_token
+    def get_preview_callback(self, jobs, cancel_token):
+        if all([job.get('progress_callback') is None for job in jobs]):
+            return None
+
+        def img_callback(pred_x0, i):
+            total_steps = self.ddim_sampler.ddim_timesteps.shape[0]
+            n_idx = 0
+            previews = None
+            for k, job in enumerate(jobs):
+                if not cancel_token.active[k]:
+                    continue
+                idx = n_idx
+                n_idx += job['img_count']
+                fn = job.get('progress_callback')
+                every = max(job.get('preview_every') or 1, 1)
+                if fn is None or ((i + 1) % every != 0 and i + 1 != total_steps):
+                    continue
+                if previews is None:
+                    previews = self.latent_preview(pred_x0)
+                try:
+                    fn(i + 1, total_steps, list(previews[idx:idx+job['img_count']]))
+                except Exception as e:  # a broken client must not kill the batch
+                    print(f'progress_callback failed: {e}')
+        return img_callback
+
+    '''
+    Unconditional CLIP outputs only depend on n_prompt (text_c is always ""), so they are cached
+    per (n_prompt, clip_skip, dtype, device) with batch size 1 and expanded to img_count. clip_skip
+    is set on FrozenCLIPEmbedder by cldm.hack.hack_everything and changes the embedding.
+    The cache is cleared in switch_weights() whenever base model or lora weights change.
+    '''
+    def get_uncond_conditioning(self, jobs, hint, info):
+        img_count = sum([job['img_count'] for job in jobs])
+        n_prompts = sum([[job['n_prompt']] * job['img_count'] for job in jobs], [])
+        if any([PLACE_HOLDER in job['n_prompt'] for job in jobs]):  # filled by embedding_manager, can not cache
+            return self.model.get_learned_conditioning(dict(c_concat=[hint], c_crossattn=[[n_prompts, [""] * img_count]], text_info=info))
+        i_c_list, t_c_list = [], []
+        for job in jobs:
+            key = (job['n_prompt'], getattr(self.model.cond_stage_model, 'clip_skip', 0), self.model.dtype, str(self.model.device))
+            uc = self.uncond_cache.get(key)
+            if uc is None:
+                with torch.no_grad():
+                    uc = self.model.get_learned_conditioning(dict(c_crossattn=[[[job['n_prompt']], [""]]], text_info=None))['c_crossattn'][0]
+                self.uncond_cache.put(key, uc)
+            i_c_list += [uc[0].expand(job['img_count'], -1, -1)]
+            t_c_list += [uc[1].expand(job['img_count'], -1, -1)]
+        if len(set([i_c.shape[1] for i_c in i_c_list])) > 1:  # n_prompts split to different number of chunks
+            return self.model.get_learned_conditioning(dict(c_concat=[hint], c_crossattn=[[n_prompts, [""] * img_count]], text_info=info))
+        i_c = torch.cat(i_c_list, dim=0) if len(i_c_list) > 1 else i_c_list[0]
+        t_c = torch.cat(t_c_list, dim=0) if len(t_c_list) > 1 else t_c_list[0]
+        return dict(c_concat=[hint], c_crossattn=[(i_c, t_c)], text_info=info)
+
+    def postprocess(self, job, results):
+        img_prompt, text_prompt, texts = job['img_prompt'], job['text_prompt'], job['texts']
+        show_debug, str_warning = job['show_debug'], job['str_warning']
+        gly_pos_imgs = job['gly_pos_imgs']
         if len(gly_pos_imgs) > 0 and show_debug:
             glyph_img = np.sum(np.stack(gly_pos_imgs), axis=0).clip(0, 255).astype(np.uint8)
             results += [glyph_img]
             # add font_hint
-            results += [np.repeat(font_hint_bg.astype(np.uint8), 3, axis=2)]
+            results += [np.repeat(job['font_hint_bg'].astype(np.uint8), 3, axis=2)]
         input_prompt = img_prompt + ', ' + text_prompt
         for t in texts:
             input_prompt = input_prompt.replace('*', f'"{t}"', 1)
@@ -295,26 +467,127 @@ class AnyText2Model(TorchModel):
             debug_info = ''
         else:
             debug_info = f'<span style="color:black;font-size:18px">Prompt: </span>{input_prompt}<br> \
-                           <span style="color:black;font-size:18px">Size: </span>{w}x{h}<br> \
-                           <span style="color:black;font-size:18px">Image Count: </span>{img_count}<br> \
-                           <span style="color:black;font-size:18px">Seed: </span>{seed}<br> \
+                           <span style="color:black;font-size:18px">Size: </span>{job["w"]}x{job["h"]}<br> \
+                           <span style="color:black;font-size:18px">Image Count: </span>{job["img_count"]}<br> \
+                           <span style="color:black;font-size:18px">Seed: </span>{job["seed"]}<br> \
                            <span style="color:black;font-size:18px">Use FP16: </span>{self.use_fp16}<br> \
-                           <span style="color:black;font-size:18px">Cost Time: </span>{(time.time()-tic):.2f}s'
+                           <span style="color:black;font-size:18px">Cost Time: </span>{(time.time()-job["tic"]):.2f}s'
         rst_code = 1 if str_warning else 0
         return results, rst_code, str_warning, debug_info
 
+    def batch_key(self, job):
+        return (job['h'], job['w'], job['ddim_steps'], job['cfg_scale'], job['eta'], job['strength'], job['attnx_scale'],
+                job['base_model_path'], tuple(job['lora_paths']), tuple(job['lora_ratios']))
+
+    def collate_text_info(self, info_list):
+        if len(info_list) == 1:
+            return info_list[0]
+        # pad every job to the same number of lines, padded lines are skipped by n_lines
+        info = {}
+        for key in ['glyphs', 'gly_line', 'positions', 'colors']:
+            max_lines = max([len(_info[key]) for _info in info_list])  # glyphs may hold one combined canvas
+            info[key] = []
+            for j in range(max_lines):
+                info[key] += [torch.cat([_info[key][j] if j < len(_info[key]) else torch.zeros_like(_info[key][0]) for _info in info_list], dim=0)]
+        info['n_lines'] = sum([_info['n_lines'] for _info in info_list], [])
+        info['masked_x'] = torch.cat([_info['masked_x'] for _info in info_list], dim=0)
+        info['font_hint'] = torch.cat([_info['font_hint'] for _info in info_list], dim=0)
+        return info
+
+    def parse_lora_path_ratio(self, lora_path_ratio):
+        lora_paths = []
+        lora_ratios = []
+        if lora_path_ratio:
+            lora_split = lora_path_ratio.strip().split()
+            assert len(lora_split) % 2 == 0, "Wrong Format of [LoRA Path and Ratio]: /path/of/lora1.pth ratio1 /path/of/lora2.pth ratio2 ..."
+            for idx in range(len(lora_split)//2):
+                lora_paths += [lora_split[idx*2+0]]
+                lora_ratios += [float(lora_split[idx*2+1])]
+        return lora_paths, lora_ratios
+
+    # change base model or merge loras
+    def switch_weights(self, base_model_path, lora_paths, lora_ratios):
+        lora_key = tuple(sorted(zip(lora_paths, lora_ratios)))
+        if base_model_path != self.base_model_path or lora_key != tuple(sorted(zip(self.lora_paths, self.lora_ratios))):
+            if base_model_path != self.base_model_path or self.lora_base_weights is None:
+                if base_model_path:
+                    self.load_base_model(base_model_path)
+                else:
+                    self.load_weights()
+                self.lora_base_weights = {}
+            else:
+                self.restore_lora_base()  # same base model, only undo the merged tensors
+            self.lora_merged_keys = []
+            if len(lora_paths) > 0:
+                entry = self.lora_cache.get((base_model_path, lora_key))
+                if entry is None:
+                    entry = self.merge_loras_cached(lora_paths, lora_ratios)
+                    self.lora_cache.put((base_model_path, lora_key), entry)
+                else:
+                    self.apply_lora_entry(entry)
+                self.lora_merged_keys = list(entry.keys())
+                print(f'LoRA cache: {self.lora_cache_stats()}')
+            self.uncond_cache.clear()
+        self.base_model_path = base_model_path
+        self.lora_paths = lora_paths
+        self.lora_ratios = lora_ratios
+
+    '''
+    Merged lora weights are kept in host memory as {state_dict key: merged tensor}, only for the
+    unet/text-encoder tensors that lora modules are merged into (merge_loras reports them with
+    their base values), so switching back to a cached mix is an in-place copy.
+    lora_base_weights holds the base values of those tensors to undo a merge.
+    '''
+    def merge_loras_cached(self, lora_paths, lora_ratios):
+        tic = time.time()
+        base = {}
+        self.merge_loras(lora_paths, lora_ratios, base_weights=base)
+        model_state = self.model.state_dict()
+        entry = {}
+        for k, v in base.items():
+            entry[k] = to_host(model_state[k])
+            if k not in self.lora_base_weights:
+                self.lora_base_weights[k] = to_host(v)
+        print(f'Cached {len(entry)} merged lora tensors, cost time={(time.time()-tic)*1000.:.2f}ms')
+        return entry
+
+    @torch.no_grad()
+    def apply_lora_entry(self, entry):
+        tic = time.time()
+        model_state = self.model.state_dict()
+        for k, v in entry.items():
+            if k not in self.lora_base_weights:
+                self.lora_base_weights[k] = to_host(model_state[k])
+            model_state[k].copy_(v, non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print(f'Applied {len(entry)} cached lora tensors, cost time={(time.time()-tic)*1000.:.2f}ms')
+
+    @torch.no_grad()
+    def restore_lora_base(self):
+        model_state = self.model.state_dict()
+        for k in self.lora_merged_keys:
+            model_state[k].copy_(self.lora_base_weights[k], non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def lora_cache_stats(self):
+        stats = self.lora_cache.stats()
+        stats['host_mb'] = sum([v.numel() * v.element_size() for entry in self.lora_cache.data.values() for v in entry.values()]) / 2**20
+        stats['base_mb'] = sum([v.numel() * v.element_size() for v in self.lora_base_weights.values()]) / 2**20
+        return stats
+
     def load_weights(self):
         self.model.load_state_dict(load_state_dict(self.ckpt_path, location='cuda'), strict=False)
         print('Original weights loaded!')
 
     def init_model(self, **kwargs):
-        if self.use_translator:
-            self.trans_pipe = pipeline(task=Tasks.translation, model=os.path.join(self.model_dir, 'nlp_csanmt_translation_zh2en'))
-            print(self.trans_pipe(input='初始化翻译器')['translation'])
-        else:
-            self.trans_pipe = None
+        if self.use_translator and self.translator_mode == 'eager':
+            self.get_trans_pipe()
+        elif self.use_translator and self.translator_mode == 'background':
+            threading.Thread(target=self.get_trans_pipe, name='load_translator', daemon=True).start()
         font_path = kwargs.get('font_path', 'font/Arial_Unicode.ttf')
-        self.font = ImageFont.truetype(font_path, size=60)
+        self.font = get_font(font_path, 60)
         cfg_path = kwargs.get('cfg_path', 'models_yaml/anytext2_sd15.yaml')
         self.ckpt_path = kwargs.get('model_path', os.path.join(self.model_dir, 'anytext_v2.0.ckpt'))
         clip_path = os.path.join(self.model_dir, 'clip-vit-large-patch14')
@@ -324,7 +597,11 @@ class AnyText2Model(TorchModel):
         self.load_weights()
 
         self.model.eval()
-        self.ddim_sampler = DDIMSampler(self.model)
+        # tiled/micro-batched vae for large edits, e.g. vae_tile_size=64 (512px tiles), vae_decode_batch_size=2
+        self.model.first_stage_model.tile_size = kwargs.get('vae_tile_size', None)
+        self.model.first_stage_model.tile_overlap = kwargs.get('vae_tile_overlap', 16)
+        self.model.first_stage_model.decode_batch_size = kwargs.get('vae_decode_batch_size', None)
+        self.ddim_sampler = DDIMSampler(self.model, batched_cfg=kwargs.get('batched_cfg', True))  # set False to save memory at large img_count
 
     def modify_prompt(self, prompt):
         prompt = prompt.replace('“', '"')
@@ -337,14 +614,30 @@ class AnyText2Model(TorchModel):
             for s in strs:
                 prompt = prompt.replace(f'"{s}"', f'{PLACE_HOLDER}', 1)
         if self.is_chinese(prompt):
-            if self.trans_pipe is None:
+            if not self.use_translator:
                 return None, None
             old_prompt = prompt
-            prompt = self.trans_pipe(input=prompt + ' .')['translation'][:-1]
-            prompt = prompt.replace(f'{PLACE_HOLDER}', f' {PLACE_HOLDER} ')
+            key = ' '.join(prompt.split())
+            prompt = self.trans_cache.get(key)
+            if prompt is None:
+                trans_pipe = self.get_trans_pipe()
+                with self.trans_run_lock:
+                    prompt = trans_pipe(input=key + ' .')['translation'][:-1]
+                prompt = prompt.replace(f'{PLACE_HOLDER}', f' {PLACE_HOLDER} ')
+                self.trans_cache.put(key, prompt)
             print(f'Translate: {old_prompt} --> {prompt}')
         return prompt, strs
 
+    # the translator is only built when needed, safe to call from several threads
+    def get_trans_pipe(self):
+        with self.trans_lock:
+            if self.trans_pipe is None:
+                tic = time.time()
+                self.trans_pipe = pipeline(task=Tasks.translation, model=os.path.join(self.model_dir, 'nlp_csanmt_translation_zh2en'))
+                print(self.trans_pipe(input='初始化翻译器')['translation'])
+                print(f'Translator loaded, cost time={(time.time()-tic)*1000.:.2f}ms')
+        return self.trans_pipe
+
     def is_chinese(self, text):
         text = checker._clean_text(text)
         for char in text:
@@ -353,39 +646,12 @@ class AnyText2Model(TorchModel):
                 return True
         return False
 
+    # sorted PosRegion (polygon + bbox mask) of every position, see pos_analysis.py
     def separate_pos_imgs(self, img, sort_priority, gap=102):
-        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(img)
-        components = []
-        for label in range(1, num_labels):
-            area = stats[label, cv2.CC_STAT_AREA]
-            if area < 20:
-                continue
-            component = np.zeros_like(img)
-            component[labels == label] = 255
-            components.append((component, centroids[label]))
-        if sort_priority == '↕':
-            fir, sec = 1, 0  # top-down first
-        elif sort_priority == '↔':
-            fir, sec = 0, 1  # left-right first
-        components.sort(key=lambda c: (c[1][fir]//gap, c[1][sec]//gap))
-        sorted_components = [c[0] for c in components]
-        return sorted_components
+        return pos_analysis.find_regions(img, sort_priority, gap=gap)
 
     def find_polygon(self, image, min_rect=False):
-        contours, hierarchy = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        max_contour = max(contours, key=cv2.contourArea)  # get contour with max area
-        if min_rect:
-            # get minimum enclosing rectangle
-            rect = cv2.minAreaRect(max_contour)
-            poly = np.int0(cv2.boxPoints(rect))
-        else:
-            # get approximate polygon
-            epsilon = 0.01 * cv2.arcLength(max_contour, True)
-            poly = cv2.approxPolyDP(max_contour, epsilon, True)
-            n, _, xy = poly.shape
-            poly = poly.reshape(n, xy)
-        cv2.drawContours(np.ascontiguousarray(image, dtype=np.uint8), [poly], -1, 255, -1)
-        return poly, image
+        return pos_analysis.find_polygon(image, min_rect=min_rect)
 
     def arr2tensor(self, arr, bs):
         if len(arr.shape) == 3:
@@ -393,45 +659,69 @@ class AnyText2Model(TorchModel):
         _arr = torch.from_numpy(arr.copy()).float().cuda(0)
         if self.use_fp16:
             _arr = _arr.half()
-        _arr = torch.stack([_arr for _ in range(bs)], dim=0)
+        _arr = _arr[None].expand(bs, *_arr.shape)  # one copy broadcast to the batch, see is_batch_broadcast()
         return _arr
 
+    '''
+    Swap the unet/text-encoder weights in place. safetensors files are memory mapped and streamed
+    one tensor at a time into the existing parameters, so no second copy of the checkpoint is
+    materialized. Other formats are loaded with mmap when torch supports it.
+    '''
+    @torch.no_grad()
     def load_base_model(self, model_path):
         tic = time.time()
-        unet_te_weights = {}
+        model_state = self.model.state_dict()
+        swap_keys = [k for k in model_state if 'model.diffusion_model' in k or 'cond_stage_model.transformer.text_model' in k]
+        n_bytes = 0
+        n_missing = 0
         if model_path.endswith('safetensors'):
             with safe_open(model_path, framework="pt", device="cpu") as f:
-                for key in f.keys():
-                    unet_te_weights[key] = f.get_tensor(key)
+                ckpt_keys = set(f.keys())
+                for key in swap_keys:
+                    if key not in ckpt_keys:
+                        print(f'key {key} not found!')
+                        n_missing += 1
+                        continue
+                    param = model_state[key]
+                    param.copy_(f.get_tensor(key))
+                    n_bytes += param.numel() * param.element_size()
         else:
-            unet_te_weights = torch.load(model_path)
+            try:
+                unet_te_weights = torch.load(model_path, map_location='cpu', mmap=True)
+            except (TypeError, RuntimeError):  # old torch or legacy (non zipfile) checkpoint
+                unet_te_weights = torch.load(model_path, map_location='cpu')
             if 'state_dict' in unet_te_weights:
                 unet_te_weights = unet_te_weights['state_dict']
-        unet_te_keys = [i for i in unet_te_weights.keys()]
-        model_state = self.model.state_dict()
-        for key in model_state:
-            if 'model.diffusion_model' in key or 'cond_stage_model.transformer.text_model' in key:
-                new_key = key
-                if new_key not in unet_te_weights:
-                    print(f'key {new_key} not found!')
+            for key in swap_keys:
+                if key not in unet_te_weights:
+                    print(f'key {key} not found!')
+                    n_missing += 1
                     continue
-                else:
-                    unet_te_keys.remove(new_key)
-                model_state[key] = unet_te_weights[new_key]
-        info = self.model.load_state_dict(model_state)
-        print(f'Loaded a new [base model] from {model_path}: {info}, cost time={(time.time()-tic)*1000.:.2f}ms')
+                param = model_state[key]
+                param.copy_(unet_te_weights.pop(key))
+                n_bytes += param.numel() * param.element_size()
+            del unet_te_weights
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        cost = time.time() - tic
+        print(f'Loaded a new [base model] from {model_path}: {len(swap_keys)-n_missing} tensors, {n_missing} missing, '
+              f'{n_bytes/1024**2:.1f}MB copied, cost time={cost*1000.:.2f}ms ({n_bytes/1024**3/max(cost, 1e-6):.2f}GB/s)')
+        return dict(tensors=len(swap_keys)-n_missing, missing=n_missing, bytes=n_bytes, time_ms=cost*1000.)
     '''
     Borrowed and modified from sd-scripts, publicly available at
     https://github.com/kohya-ss/sd-scripts/blob/main/networks/merge_lora.py
     '''
-    def merge_loras(self, lora_paths, lora_ratios):
+    # base_weights: filled with {state_dict key: weight before the merge} of every merged tensor
+    def merge_loras(self, lora_paths, lora_ratios, base_weights=None):
         tic = time.time()
         assert lora_paths is not None and len(lora_paths) == len(lora_ratios)
         unet = get_diffusers_unet(unet=self.unet, state_dict=self.model.state_dict()).cuda(0)
         text_encoder = self.model.cond_stage_model.transformer.cuda(0)
+        hf_to_sd = {v: k for k, v in convert_unet_state_dict_to_sd({k: k for k in unet.state_dict().keys()}).items()}
 
         # create module map
         name_to_module = {}
+        name_to_key = {}  # lora name -> state_dict key of the merged weight in self.model
         for i, root_module in enumerate([text_encoder, unet]):
             if i == 0:
                 prefix = "lora_te"
@@ -447,6 +737,11 @@ class AnyText2Model(TorchModel):
                             lora_name = prefix + "." + name + "." + child_name
                             lora_name = lora_name.replace(".", "_")
                             name_to_module[lora_name] = child_module
+                            param_name = '.'.join([n for n in [name, child_name, 'weight'] if n])
+                            if i == 0:
+                                name_to_key[lora_name] = 'cond_stage_model.transformer.' + param_name
+                            elif param_name in hf_to_sd:
+                                name_to_key[lora_name] = 'model.diffusion_model.' + hf_to_sd[param_name]
         for model, ratio in zip(lora_paths, lora_ratios):
             print(f"loading lora: {model}")
             lora_sd = load_state_dict(model, location='cuda')
@@ -474,6 +769,9 @@ class AnyText2Model(TorchModel):
 
                     # W <- W + U * D
                     weight = module.weight
+                    key = name_to_key.get(module_name)
+                    if base_weights is not None and key is not None and key not in base_weights:
+                        base_weights[key] = weight.detach()  # replaced by a new Parameter below, not changed in place
                     dtype = weight.dtype
                     if len(weight.size()) == 2:
                         # linear
@@ -495,3 +793,36 @@ class AnyText2Model(TorchModel):
         sd_from_diffuser = convert_unet_state_dict_to_sd(unet.state_dict())
         info_unet = self.model.model.diffusion_model.load_state_dict(sd_from_diffuser)
         print(f'Merge lora model(s) done! text_encoder:{info_te}, unet:{info_unet}, cost time={(time.time()-tic)*1000.:.2f}ms')
+
+
+# cancel_token of a DDIM batch: the whole batch stops when every job in it is cancelled, a job
+# cancelled on its own is dropped from the batch at the next step (keep_rows), so the other
+# jobs sample with a smaller batch. active: jobs still in the batch
+class BatchCancelToken(object):
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.active = [True] * len(jobs)
+
+    def cancelled(self, k):
+        token = self.jobs[k].get('cancel_token')
+        return token is not None and token.is_set()
+
+    def is_set(self):
+        return all([self.cancelled(k) for k in range(len(self.jobs))])
+
+    # rows of the current batch to keep, None if no job left since the last call
+    def keep_rows(self):
+        drop = [k for k in range(len(self.jobs)) if self.active[k] and self.cancelled(k)]
+        if not drop:
+            return None
+        rows, n_idx = [], 0
+        for k, job in enumerate(self.jobs):
+            if not self.active[k]:
+                continue
+            if k not in drop:
+                rows += list(range(n_idx, n_idx + job['img_count']))
+            n_idx += job['img_count']
+        for k in drop:
+            self.active[k] = False
+        print(f'{len(drop)} cancelled job(s) dropped from the DDIM batch')
+        return torch.tensor(rows, dtype=torch.long)
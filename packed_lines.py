@@ -0,0 +1,42 @@
+'''
+Packed text lines: instead of [line][sample] lists padded to max_lines, a batch carries only the real
+lines of all samples, concatenated along dim 0 in sample order, plus line_index (L, 2) with the
+(sample, line) of every row. Made by T3DataSet(packed_lines=True) and t3_packed_collate, read by
+ControlLDM.get_input, EmbeddingManager.encode_text, ControlNet.forward and LatentDiffusion.p_losses.
+Inference still builds [line][sample] lists, the consumers accept both layouts.
+'''
+import torch
+
+
+def is_packed(info):
+    return isinstance(info, dict) and 'line_index' in info
+
+
+# lines per sample -> (L, 2) int64 (sample, line) of the concatenated lines
+def make_line_index(n_lines):
+    n_lines = torch.as_tensor(n_lines, dtype=torch.long).reshape(-1)
+    sample = torch.repeat_interleave(torch.arange(len(n_lines)), n_lines)
+    starts = torch.cumsum(n_lines, dim=0) - n_lines
+    line = torch.arange(len(sample)) - starts[sample]
+    return torch.stack([sample, line], dim=1)
+
+
+# row of the first line of every sample, plus the total number of lines
+def line_offsets(n_lines):
+    offsets = [0]
+    for n in n_lines:
+        offsets += [offsets[-1] + int(n)]
+    return offsets
+
+
+# line j of sample i of a text_info/batch key, in either layout
+def get_line(info, key, i, j, offsets=None):
+    if is_packed(info):
+        return info[key][offsets[i] + j]
+    return info[key][j][i]
+
+
+# (L, ...) per-line tensors -> (n_samples, ...) sums over the lines of every sample
+def sum_lines(lines, line_index, n_samples):
+    out = torch.zeros((n_samples,) + tuple(lines.shape[1:]), device=lines.device, dtype=lines.dtype)
+    return out.index_add_(0, line_index[:, 0].to(lines.device), lines)
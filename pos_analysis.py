@@ -0,0 +1,101 @@
+'''
+Position analysis for AnyText2Model on the labels image of cv2.connectedComponentsWithStats.
+Each text position is traced, approximated and filled inside its own bounding box (plus a 1 pixel
+border) instead of on a full-size copy per component, so the cost grows with the area of the
+positions rather than with lines x image size. Contours are found with an offset, polygons are in
+full-image coordinates and the results equal the full-image findContours/approxPolyDP/drawContours.
+Usage:
+    from pos_analysis import find_regions, to_full
+    regions = find_regions(pos_img, sort_priority='↕')  # pos_img: hw uint8, white positions on black
+    pos = to_full(regions[0], *pos_img.shape[:2])  # hw1 uint8, component + filled polygon
+'''
+from collections import namedtuple
+import numpy as np
+import cv2
+
+# x, y, width, height: box of crop in the full image, crop: hw uint8 of component + filled polygon
+PosRegion = namedtuple('PosRegion', ['x', 'y', 'width', 'height', 'centroid', 'polygon', 'crop'])
+
+
+def _box(x, y, w, h, height, width, margin):
+    x0, y0 = max(x - margin, 0), max(y - margin, 0)
+    return x0, y0, min(x + w + margin, width) - x0, min(y + h + margin, height) - y0
+
+
+def _polygon(contours, min_rect):
+    max_contour = max(contours, key=cv2.contourArea)  # get contour with max area
+    if min_rect:
+        # get minimum enclosing rectangle
+        rect = cv2.minAreaRect(max_contour)
+        return np.int0(cv2.boxPoints(rect))
+    # get approximate polygon
+    epsilon = 0.01 * cv2.arcLength(max_contour, True)
+    poly = cv2.approxPolyDP(max_contour, epsilon, True)
+    n, _, xy = poly.shape
+    return poly.reshape(n, xy)
+
+
+'''
+Separate a binary position image into its connected components (area >= min_area), with one polygon
+and one mask per component, sorted into reading order by centroids quantised to gap pixels.
+sort_priority: '↕' top-down first, '↔' left-right first
+'''
+def find_regions(img, sort_priority='↕', gap=102, min_area=20, min_rect=False):
+    img = np.ascontiguousarray(img.reshape(img.shape[:2]), dtype=np.uint8)
+    height, width = img.shape
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(img)
+    regions = []
+    for label in range(1, num_labels):
+        x, y, w, h, area = stats[label]
+        if area < min_area:
+            continue
+        x0, y0, cw, ch = _box(x, y, w, h, height, width, 1)
+        crop = (labels[y0:y0+ch, x0:x0+cw] == label).astype(np.uint8) * 255
+        contours, _ = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
+        poly = _polygon(contours, min_rect)
+        cv2.drawContours(crop, [poly], -1, 255, -1, offset=(-x0, -y0))
+        regions.append(PosRegion(x0, y0, cw, ch, centroids[label], poly, crop))
+    if sort_priority == '↕':
+        fir, sec = 1, 0  # top-down first
+    elif sort_priority == '↔':
+        fir, sec = 0, 1  # left-right first
+    regions.sort(key=lambda r: (r.centroid[fir]//gap, r.centroid[sec]//gap))
+    return regions
+
+
+def to_full(region, height, width):
+    img = np.zeros((height, width, 1), np.uint8)
+    img[region.y:region.y+region.height, region.x:region.x+region.width, 0] = region.crop
+    return img
+
+
+'''
+Polygon of the largest external contour of image, fills it into image in place like
+cv2.drawContours on the full image. image: hw or hw1 uint8
+return: poly, image
+'''
+def find_polygon(image, min_rect=False):
+    mask = image.reshape(image.shape[:2])
+    x, y, w, h = cv2.boundingRect(mask)
+    x0, y0, cw, ch = _box(x, y, w, h, mask.shape[0], mask.shape[1], 1)
+    crop = np.ascontiguousarray(mask[y0:y0+ch, x0:x0+cw], dtype=np.uint8)
+    contours, _ = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
+    poly = _polygon(contours, min_rect)
+    cv2.drawContours(crop, [poly], -1, 255, -1, offset=(-x0, -y0))
+    mask[y0:y0+ch, x0:x0+cw] = crop
+    return poly, image
+
+
+'''
+cv2.morphologyEx(img, MORPH_CLOSE, kernel) on the bbox of the non-zero pixels plus twice the kernel size,
+outside of it the full-image result is 0. img: hw or hwc uint8
+return: closed crop, x0, y0 (None if img is empty)
+'''
+def close_roi(img, kernel):
+    x, y, w, h = cv2.boundingRect(np.ascontiguousarray(img.reshape(img.shape[:2] + (-1,)).max(axis=2)))
+    if w == 0 or h == 0:
+        return None, 0, 0
+    margin = 2 * max(kernel.shape)
+    x0, y0, cw, ch = _box(x, y, w, h, img.shape[0], img.shape[1], margin)
+    closed = cv2.morphologyEx(np.ascontiguousarray(img[y0:y0+ch, x0:x0+cw]), cv2.MORPH_CLOSE, kernel=kernel, iterations=1)
+    return closed, x0, y0
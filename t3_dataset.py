@@ -10,11 +10,24 @@ import cv2
 import random
 import math
 import time
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+import torch
 from torch.utils.data import Dataset, DataLoader
-from dataset_util import load, show_bbox_on_image
+from torch.utils.data.dataloader import default_collate
+from dataset_util import show_bbox_on_image
+from manifest import Manifest, expand_manifest_paths
+import glyph_cache
+from glyph_cache import cached_glyph
+from glyph_metrics import metrics as glyph_metrics
+from font_pool import get_font
+from glyph_roi import GlyphROI, to_roi, empty_roi, is_roi_batch
+from t3_shards import ShardReader, unpack_gly_line
+from annotation_store import AnnotationStore
+from image_io import ImageLoader
+from packed_lines import make_line_index
 from opencc import OpenCC
 SHOW_GLYPH = False
+FAST_GLYPH_METRICS = True  # closed-form font size/spacing from glyph_metrics, False for the original search
 
 cc = OpenCC('t2s')
 
@@ -89,29 +102,45 @@ def random_scale(image, scale_range):
 
 
 def random_augment(image, rot=(-10, 10), trans=(-5, 5), scale=(0.9, 1.1)):
-    image = random_rotate(image, rot)
-    image = random_translate(image, trans)
-    image = random_scale(image, scale)
-    return image
+    '''
+    random_rotate + random_translate + random_scale composed into one warpAffine (replicated border),
+    draws the same random numbers in the same order
+    '''
+    h, w = image.shape[:2]
+    angle = random.uniform(rot[0], rot[1])
+    tx = random.uniform(trans[0], trans[1])
+    ty = random.uniform(trans[0], trans[1])
+    s = random.uniform(scale[0], scale[1])
+    rotate = np.vstack([cv2.getRotationMatrix2D((w/2, h/2), angle, 1), [0, 0, 1]])
+    translate = np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]])
+    # resize to (sw, sh), then center crop (s >= 1) or pad back to (w, h)
+    sw, sh = max(1, int(w*s)), max(1, int(h*s))
+    fx, fy = sw / w, sh / h
+    ox = -((sw - w) // 2) if s >= 1 else (w - sw) // 2
+    oy = -((sh - h) // 2) if s >= 1 else (h - sh) // 2
+    resize = np.array([[fx, 0, 0.5*fx - 0.5 + ox], [0, fy, 0.5*fy - 0.5 + oy], [0, 0, 1]])
+    M = (resize @ translate @ rotate)[:2]
+    return cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
 
 
 def insert_spaces(text, num_spaces):
     return (' ' * num_spaces).join(text)
 
 
+@cached_glyph(binary=True)
 def draw_glyph(font, text):
     if isinstance(font, str):
-        font = ImageFont.truetype(font, size=60)
+        font = get_font(font, 60)
     g_size = 50
     W, H = (512, 80)
-    new_font = font.font_variant(size=g_size)
+    new_font = get_font(font, g_size)
     img = Image.new(mode='1', size=(W, H), color=0)
     draw = ImageDraw.Draw(img)
     left, top, right, bottom = new_font.getbbox(text)
     text_width = max(right-left, 5)
     text_height = max(bottom - top, 5)
     ratio = min(W*0.9/text_width, H*0.9/text_height)
-    new_font = font.font_variant(size=int(g_size*ratio))
+    new_font = get_font(font, int(g_size*ratio))
     text_width, text_height = new_font.getsize(text)
     offset_x, offset_y = new_font.getoffset(text)
     x = (img.width - text_width) // 2
@@ -128,6 +157,161 @@ def draw_glyph(font, text):
     return img
 
 
+def _layout_glyph_line(font, text, polygon, vertAng=10, scale=1, add_space=True):
+    '''
+    Font size, spacing and draw calls of one line on the unrotated canvas.
+    return: new_font, [(xy, text)] draw calls, rotation angle and center
+    '''
+    enlarge_polygon = np.array(polygon) * scale
+    rect = cv2.minAreaRect(enlarge_polygon)
+    box = cv2.boxPoints(rect)
+    box = np.int0(box)
+    w, h = rect[1]
+    angle = rect[2]
+
+    if angle < -45:
+        angle += 90
+    angle = -angle
+    if w < h:
+        angle += 90
+
+    vert = False
+    if (abs(angle) % 90 < vertAng or abs(90 - abs(angle) % 90) % 90 < vertAng):
+        _w = max(box[:, 0]) - min(box[:, 0])
+        _h = max(box[:, 1]) - min(box[:, 1])
+        if _h >= _w:
+            vert = True
+            angle = 0
+
+    draw = glyph_metrics.draw  # textbbox only depends on the font and the font mode
+    min_dim = min(w, h)
+    max_dim = max(w, h)
+
+    # Binary search for optimal font size
+    def adjust_font_size(min_size, max_size, text):
+        while min_size < max_size:
+            mid_size = (min_size + max_size) // 2
+            new_font = get_font(font, int(mid_size))
+            bbox = draw.textbbox((0, 0), text=text, font=new_font)
+            text_w = bbox[2] - bbox[0]
+            text_h = bbox[3] - bbox[1]
+            if text_w <= max_dim and text_h <= min_dim:
+                min_size = mid_size + 1
+            else:
+                max_size = mid_size
+        return max_size - 1
+
+    optimal_font_size = glyph_metrics.fit_font_size(font, text, max_dim, min_dim) if FAST_GLYPH_METRICS else None
+    if optimal_font_size is None:
+        optimal_font_size = adjust_font_size(1, min_dim, text)
+    fast_metrics = FAST_GLYPH_METRICS and int(optimal_font_size) >= 1
+    new_font = get_font(font, int(optimal_font_size))
+
+    extra_space = 0
+    if add_space:
+        if vert:
+            # Calculate total height with added space
+            if fast_metrics:
+                total_height = sum(glyph_metrics.char_height(font, int(optimal_font_size), char) for char in text)
+            else:
+                total_height = sum(draw.textbbox((0, 0), text=char, font=new_font)[3] -
+                                   draw.textbbox((0, 0), text=char, font=new_font)[1]
+                                   for char in text)
+            if total_height < max_dim and len(text) > 1:
+                extra_space = (max_dim - total_height) // (len(text) - 1)
+        elif fast_metrics:
+            text = glyph_metrics.fit_spacing(font, int(optimal_font_size), text, max_dim, min_dim, insert_spaces)
+        else:
+            # Handle horizontal text space addition
+            for i in range(1, 100):
+                text_space = insert_spaces(text, i)
+                bbox2 = draw.textbbox((0, 0), text=text_space, font=new_font)
+                text_w, text_h = bbox2[2] - bbox2[0], bbox2[3] - bbox2[1]
+                if text_w > max_dim or text_h > min_dim:
+                    text = insert_spaces(text, i - 1)
+                    break
+
+    left, top, right, bottom = draw.textbbox((0, 0), text=text, font=new_font)
+    text_width = right - left
+    text_height = bottom - top
+
+    draws = []
+    if not vert:
+        text_y_center = rect[0][1] - (text_height / 2)
+        draws += [((rect[0][0] - text_width / 2, text_y_center - top), text)]
+    else:
+        x_s = min(box[:, 0]) + _w // 2 - text_height // 2
+        y_s = min(box[:, 1])
+        for c in text:
+            draws += [((x_s, y_s), c)]
+            if fast_metrics:
+                char_height = glyph_metrics.char_height(font, int(optimal_font_size), c)
+            else:
+                _, _t, _, _b = draw.textbbox((0, 0), text=c, font=new_font)
+                char_height = _b - _t
+            y_s += char_height + extra_space
+    return new_font, draws, angle, (rect[0][0], rect[0][1])
+
+
+def _glyph_line_layer(W, H, new_font, draws, color, angle, center):
+    '''
+    RGBA layer of one line as a GlyphROI, cropped to its part that is visible on a W x H canvas.
+    Alpha-pasting it (_paste_glyph_layer) gives the same pixels as drawing on a full-canvas layer,
+    Image.rotate(expand=1) and pasting it centered. Unrotated lines (horizontal and vertical) only
+    draw a layer that covers their ink, O(line bbox) instead of O(canvas). Angled lines keep the
+    full-canvas Image.rotate, whose resampling grid depends on the canvas size.
+    '''
+    fill = tuple(color)+(255,)
+    if angle % 360.0 != 0:
+        layer = Image.new('RGBA', (W, H), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        for xy, t in draws:
+            draw.text(xy, t, font=new_font, fill=fill)
+        rotated = layer.rotate(angle, expand=1, center=center)
+        x_offset = int((W - rotated.width) / 2)
+        y_offset = int((H - rotated.height) / 2)
+        bbox = rotated.getbbox()
+        if bbox is None:
+            return empty_roi(H, W, 4)
+        x0, y0 = max(bbox[0] + x_offset, 0), max(bbox[1] + y_offset, 0)
+        x1, y1 = min(bbox[2] + x_offset, W), min(bbox[3] + y_offset, H)
+        if x1 <= x0 or y1 <= y0:
+            return empty_roi(H, W, 4)
+        crop = rotated.crop((x0 - x_offset, y0 - y_offset, x1 - x_offset, y1 - y_offset))
+        return GlyphROI(y0, x0, np.array(crop), H, W)
+    boxes = [glyph_metrics.draw.textbbox(xy, text=t, font=new_font) for xy, t in draws]
+    lx0 = max(min([min(math.floor(xy[0]), math.floor(b[0])) for (xy, _), b in zip(draws, boxes)]) - 2, 0)
+    ly0 = max(min([min(math.floor(xy[1]), math.floor(b[1])) for (xy, _), b in zip(draws, boxes)]) - 2, 0)
+    lx1 = min(max([math.ceil(b[2]) for b in boxes]) + 2, W)
+    ly1 = min(max([math.ceil(b[3]) for b in boxes]) + 2, H)
+    if lx1 <= lx0 or ly1 <= ly0:
+        return empty_roi(H, W, 4)
+    # drawing is clipped to the canvas as on a full-size layer, offsets are integers so the sub-pixel
+    # start of every draw call is unchanged
+    layer = Image.new('RGBA', (lx1 - lx0, ly1 - ly0), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for (x, y), t in draws:
+        draw.text((x - lx0, y - ly0), t, font=new_font, fill=fill)
+    return GlyphROI(ly0, lx0, np.array(layer), H, W)
+
+
+def _paste_glyph_layer(img, roi):
+    if roi.crop.size > 0:
+        layer = Image.fromarray(roi.crop)
+        img.paste(layer, (int(roi.x), int(roi.y)), layer)
+
+
+@cached_glyph(layer=True)
+def draw_glyph_layer(font, text, polygon, color, vertAng=10, scale=1, width=512, height=512, add_space=True):
+    '''
+    One line of draw_glyphs as the GlyphROI of its RGBA layer, cached per line, so samples and requests
+    that share lines only rasterise the new ones. font: FreeTypeFont, color: clipped RGB
+    '''
+    new_font, draws, angle, center = _layout_glyph_line(font, text, polygon, vertAng, scale, add_space)
+    return _glyph_line_layer(width * scale, height * scale, new_font, draws, color, angle, center)
+
+
+@cached_glyph()
 def draw_glyph2(font, text, polygon, color, vertAng=10, scale=1, width=512, height=512, add_space=True):
     def initialize_img(width, height, scale):
         img = np.zeros((height * scale, width * scale, 3), np.uint8)
@@ -142,97 +326,13 @@ def draw_glyph2(font, text, polygon, color, vertAng=10, scale=1, width=512, heig
         color = np.clip(color, 10, 255)  # RGB >= 10
         if isinstance(font, str):
             if os.path.exists(font):
-                font = ImageFont.truetype(font, size=60)
+                font = get_font(font, 60)
             else:
                 img = initialize_img(width, height, scale)
                 return prepare_image(img)
-        enlarge_polygon = np.array(polygon) * scale
-        rect = cv2.minAreaRect(enlarge_polygon)
-        box = cv2.boxPoints(rect)
-        box = np.int0(box)
-        w, h = rect[1]
-        angle = rect[2]
-
-        if angle < -45:
-            angle += 90
-        angle = -angle
-        if w < h:
-            angle += 90
-
-        vert = False
-        if (abs(angle) % 90 < vertAng or abs(90 - abs(angle) % 90) % 90 < vertAng):
-            _w = max(box[:, 0]) - min(box[:, 0])
-            _h = max(box[:, 1]) - min(box[:, 1])
-            if _h >= _w:
-                vert = True
-                angle = 0
-
         img = initialize_img(width, height, scale)
-        image4ratio = Image.new("RGB", img.size, "white")
-        draw = ImageDraw.Draw(image4ratio)
-        min_dim = min(w, h)
-        max_dim = max(w, h)
-
-        # Binary search for optimal font size
-        def adjust_font_size(min_size, max_size, text):
-            while min_size < max_size:
-                mid_size = (min_size + max_size) // 2
-                new_font = font.font_variant(size=int(mid_size))
-                bbox = draw.textbbox((0, 0), text=text, font=new_font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-                if text_w <= max_dim and text_h <= min_dim:
-                    min_size = mid_size + 1
-                else:
-                    max_size = mid_size
-            return max_size - 1
-
-        optimal_font_size = adjust_font_size(1, min_dim, text)
-        new_font = font.font_variant(size=int(optimal_font_size))
-
-        extra_space = 0
-        if add_space:
-            if vert:
-                # Calculate total height with added space
-                total_height = sum(draw.textbbox((0, 0), text=char, font=new_font)[3] -
-                                   draw.textbbox((0, 0), text=char, font=new_font)[1]
-                                   for char in text)
-                if total_height < max_dim and len(text) > 1:
-                    extra_space = (max_dim - total_height) // (len(text) - 1)
-            else:
-                # Handle horizontal text space addition
-                for i in range(1, 100):
-                    text_space = insert_spaces(text, i)
-                    bbox2 = draw.textbbox((0, 0), text=text_space, font=new_font)
-                    text_w, text_h = bbox2[2] - bbox2[0], bbox2[3] - bbox2[1]
-                    if text_w > max_dim or text_h > min_dim:
-                        text = insert_spaces(text, i - 1)
-                        break
-
-        left, top, right, bottom = draw.textbbox((0, 0), text=text, font=new_font)
-        text_width = right - left
-        text_height = bottom - top
-
-        layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(layer)
-
-        if not vert:
-            text_y_center = rect[0][1] - (text_height / 2)
-            draw.text((rect[0][0] - text_width / 2, text_y_center - top), text, font=new_font, fill=tuple(color)+(255,))
-        else:
-            x_s = min(box[:, 0]) + _w // 2 - text_height // 2
-            y_s = min(box[:, 1])
-            for c in text:
-                draw.text((x_s, y_s), c, font=new_font, fill=tuple(color)+(255,))
-                _, _t, _, _b = draw.textbbox((0, 0), text=c, font=new_font)
-                char_height = _b - _t
-                y_s += char_height + extra_space
-
-        rotated_layer = layer.rotate(angle, expand=1, center=(rect[0][0], rect[0][1]))
-        x_offset = int((img.width - rotated_layer.width) / 2)
-        y_offset = int((img.height - rotated_layer.height) / 2)
-        img.paste(rotated_layer, (x_offset, y_offset), rotated_layer)
-
+        new_font, draws, angle, center = _layout_glyph_line(font, text, polygon, vertAng, scale, add_space)
+        _paste_glyph_layer(img, _glyph_line_layer(img.width, img.height, new_font, draws, color, angle, center))
         return prepare_image(img)
 
     except Exception as e:
@@ -241,6 +341,51 @@ def draw_glyph2(font, text, polygon, color, vertAng=10, scale=1, width=512, heig
         return prepare_image(img)
 
 
+def draw_glyphs(fonts, texts, polygons, colors, vertAng=10, scale=1, width=512, height=512, add_space=True, return_lines=False, dtype=np.float64):
+    '''
+    Rasterise all lines of a sample onto one canvas in a single pass, each line keeps its own colour
+    and rotated layout. Where lines do not overlap this equals the sum of draw_glyph2 of every line,
+    which is all ControlNet (and the debug view) uses. Line layers come from the glyph cache
+    (draw_glyph_layer) when it is enabled.
+    fonts: one font/path for all lines or one per line, lines with a missing font path are skipped
+    dtype: np.uint8 returns the raw canvas in [0, 255] instead of a float canvas in [0, 1]
+    return: canvas (height*scale, width*scale, 3) float64 in [0, 1],
+            plus one GlyphROI per line (per-line masks) if return_lines
+    '''
+    img = Image.new('RGB', (width * scale, height * scale))
+    if not isinstance(fonts, (list, tuple)):
+        fonts = [fonts] * len(texts)
+    lines = []
+    for font, text, polygon, color in zip(fonts, texts, polygons, colors):
+        line = None
+        try:
+            color = np.array([255, 255, 255]) if color.mean() < 0 else color
+            color = np.clip(color, 10, 255)  # RGB >= 10
+            if isinstance(font, str):
+                font = get_font(font, 60) if os.path.exists(font) else None
+            if font is not None:
+                line = draw_glyph_layer(font, text, polygon, color, vertAng, scale, width, height, add_space)
+                _paste_glyph_layer(img, line)
+        except Exception as e:
+            print(f"An error occurred in draw_glyphs: {e}")
+        lines += [line]
+    canvas = np.array(img)
+    if dtype != np.uint8:
+        canvas = canvas.astype(dtype) / 255.0
+    if not return_lines:
+        return canvas
+    rois = []
+    for line in lines:
+        if line is None or line.crop.size == 0:
+            rois += [empty_roi(height * scale, width * scale)]
+            continue
+        layer = Image.fromarray(line.crop)
+        crop = Image.new('RGB', layer.size)
+        crop.paste(layer, (0, 0), layer)
+        rois += [GlyphROI(line.y, line.x, np.array(crop), height * scale, width * scale)]
+    return canvas, rois
+
+
 '''
 target_img: (-1,1), hwc
 return font_hint: (0,1), hw1
@@ -262,7 +407,6 @@ def draw_font_hint(target_img, polygon, target_area_range=[1.0, 1.0], prob=1.0,
     cv2.fillPoly(img, [pts], color=255)
     rect = cv2.minAreaRect(pts)
     center, size, angle = rect
-    rect_width, rect_height = size
     x, y, w, h = cv2.boundingRect(np.clip(polygon, 0, None))
     #print(w,y,w,h)
     target_img_scaled = (target_img + 1.0) / 2.0
@@ -278,6 +422,18 @@ def draw_font_hint(target_img, polygon, target_area_range=[1.0, 1.0], prob=1.0,
     thresholded_resized[y:y+h, x:x+w] = (1 - thresholded / 255.0)
 
     # gen a random mask
+    mask_corners = _font_hint_erase_box(center, size, angle, target_area_range)
+    cv2.fillPoly(img, [mask_corners], color=0)
+    img = img[..., None] / 255.0
+
+    # Compute font hint
+    font_hint = img.squeeze() * thresholded_resized
+    return font_hint[..., None], img
+
+
+# random part of a font_hint line that is left empty, corners of the erased box
+def _font_hint_erase_box(center, size, angle, target_area_range):
+    rect_width, rect_height = size
     area_ratio = random.uniform(target_area_range[0], target_area_range[1])
     long_side, short_side = max(rect_width, rect_height), min(rect_width, rect_height)
     long_axis_mask_length = long_side * (1 - area_ratio)
@@ -290,18 +446,38 @@ def draw_font_hint(target_img, polygon, target_area_range=[1.0, 1.0], prob=1.0,
     mask_center = start_point + rect_vector * (long_axis_mask_length / 2)
     mask_vector = rect_vector * (long_axis_mask_length / 2)
     short_axis_vector = np.array([-rect_vector[1], rect_vector[0]]) * (short_side / 2)
-    mask_corners = np.array([
+    return np.array([
         mask_center - mask_vector - short_axis_vector,
         mask_center + mask_vector - short_axis_vector,
         mask_center + mask_vector + short_axis_vector,
         mask_center - mask_vector + short_axis_vector
     ], dtype=np.int32)
-    cv2.fillPoly(img, [mask_corners], color=0)
-    img = img[..., None] / 255.0
 
-    # Compute font hint
-    font_hint = img.squeeze() * thresholded_resized
-    return font_hint[..., None], img
+
+'''
+draw_font_hint of one line OR-ed into canvas (hw bool, shared by all lines of a sample), same result
+and random draws as get_hint() over draw_font_hint of every line. The target is converted, thresholded
+and masked only inside the bounding box of the line.
+'''
+def draw_font_hint_line(canvas, target_img, polygon, target_area_range=[1.0, 1.0], prob=1.0, randaug=False):
+    height, width = canvas.shape
+    if random.random() < (1 - prob):  # Empty font hint
+        return canvas
+    polygon[:, 0] = np.clip(polygon[:, 0], 0, width - 1)
+    polygon[:, 1] = np.clip(polygon[:, 1], 0, height - 1)
+    pts = polygon.reshape((-1, 1, 2)).astype(np.int32)
+    center, size, angle = cv2.minAreaRect(pts)
+    x, y, w, h = cv2.boundingRect(np.clip(polygon, 0, None))
+    cropped_ori_img = (target_img[y:y+h, x:x+w] + 1.0) / 2.0
+    if randaug:
+        cropped_ori_img = random_augment(cropped_ori_img, rot=(-10, 10), trans=(-10, 10), scale=(0.9, 1.1))
+    cropped_gray = cv2.cvtColor((cropped_ori_img * 255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
+    thresholded = cv2.adaptiveThreshold(cropped_gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    mask = np.zeros(thresholded.shape, np.uint8)
+    cv2.fillPoly(mask, [pts], color=255, offset=(-x, -y))
+    cv2.fillPoly(mask, [_font_hint_erase_box(center, size, angle, target_area_range)], color=0, offset=(-x, -y))
+    canvas[y:y+mask.shape[0], x:x+mask.shape[1]] |= (mask > 0) & (thresholded == 0)
+    return canvas
 
 
 def get_text_caption(n_line, ori_caption, place_holder='*'):
@@ -369,6 +545,35 @@ def truncate_string(input_string, max_words=45):
     return truncated_string
 
 
+# default_collate for T3DataSet items, sparse glyph records are kept as [line][sample] lists of GlyphROI
+def t3_collate(batch):
+    sparse = {}
+    for key in ['glyphs']:
+        if key in batch[0] and is_roi_batch(batch[0][key]):
+            sparse[key] = [item.pop(key) for item in batch]
+    out = default_collate(batch)
+    for key, records in sparse.items():
+        out[key] = [[records[b][i] for b in range(len(batch))] for i in range(len(records[0]))]
+    return out
+
+
+# collate for T3DataSet(packed_lines=True) items: the (n_lines, ...) line arrays of all samples are concatenated,
+# texts/language flattened and line_index holds the (sample, line) of every row, see packed_lines.py.
+# glyphs (one canvas per sample) is a one-line list, [b h w c] tensor or list of GlyphROI
+def t3_packed_collate(batch):
+    lines = {}
+    for key in ['gly_line', 'positions', 'color']:
+        lines[key] = torch.from_numpy(np.concatenate([item.pop(key) for item in batch]))
+    for key in ['texts', 'language']:
+        lines[key] = sum([item.pop(key) for item in batch], [])
+    glyphs = [item.pop('glyphs') for item in batch]
+    out = default_collate(batch)
+    out.update(lines)
+    out['glyphs'] = [glyphs] if is_roi_batch(glyphs) else [default_collate(glyphs)]
+    out['line_index'] = make_line_index(out['n_lines'])
+    return out
+
+
 class T3DataSet(Dataset):
     def __init__(
             self,
@@ -395,19 +600,27 @@ class T3DataSet(Dataset):
             font_hint_randaug=False,
             cap_watermark=True,
             img_wh=512,
+            glyph_cache_dir=None,  # on-disk glyph render cache shared by workers, see glyph_cache.py
+            glyph_cache_mb=64,  # memory cap of the glyph render cache in every worker, used with glyph_cache_dir
+            sparse_glyphs=False,  # glyphs as uint8 bbox crops (GlyphROI), needs collate_fn=t3_collate
+            compact_dtypes=False,  # glyphs as uint8, masks/positions/hints as bool, ControlLDM.get_input converts on device
+            shard_dir=None,  # read samples from tools/pack_shards.py shards instead of json_path, see t3_shards.py
+            columnar=True,  # keep annotations in flat numpy columns (AnnotationStore), items are built in __getitem__
+            fast_decode=False,  # JPEG draft decoding at reduced resolution (not bit-identical to a full decode), see image_io.py
+            image_cache_dir=None,  # on-disk cache of images resized to img_wh, shared by workers
+            packed_lines=False,  # only the real lines as (n_lines, ...) arrays, no max_lines padding, needs collate_fn=t3_packed_collate
 ###修改1####################################################################
             training_stage=2
 ###修改1结束####################################################################
             ):
-        assert isinstance(json_path, (str, list))
-        if isinstance(json_path, str):
-            json_path = [json_path]
+        assert isinstance(json_path, (str, list)) or shard_dir
+        json_path = expand_manifest_paths(json_path) if json_path else []  # glob patterns / dirs of sharded manifests
         data_list = []
         self.using_dlc = using_dlc
         self.max_lines = max_lines
         self.max_chars = max_chars
         self.place_holder = place_holder
-        self.font = ImageFont.truetype(font_path, size=60)
+        self.font = get_font(font_path, 60)
         self.mask_pos_prob = mask_pos_prob
         self.mask_img_prob = mask_img_prob
         self.for_show = for_show
@@ -422,6 +635,14 @@ class T3DataSet(Dataset):
         self.font_hint_randaug = font_hint_randaug
         self.cap_watermark = cap_watermark
         self.img_wh = img_wh
+        if glyph_cache_dir:
+            glyph_cache.enable(max_mb=glyph_cache_mb, cache_dir=glyph_cache_dir)
+        self.sparse_glyphs = sparse_glyphs
+        self.packed_lines = packed_lines and not for_show
+        self.image_loader = ImageLoader(img_wh, cache_dir=image_cache_dir, fast_decode=fast_decode)
+        self.compact_dtypes = compact_dtypes and not for_show  # for_show items are plotted as float in __main__
+        self.mask_dtype = bool if self.compact_dtypes else np.float64
+        self.glyph_dtype = np.uint8 if self.compact_dtypes else np.float64
 ###修改2####################################################################
         self.training_stage = training_stage # <--- 保存参数
 ###修改2结束####################################################################
@@ -430,30 +651,45 @@ class T3DataSet(Dataset):
             lang_font_dict = np.load(lang_font_path, allow_pickle=True)[()]
             self.lang_font = copy_and_rename_dict_keys(lang_font_dict, key_mapping)
             for lang in self.lang_font:
-                self.lang_font[lang] = [ImageFont.truetype(p, size=60) for p in self.lang_font[lang]['fonts']]
+                self.lang_font[lang] = [get_font(p, 60) for p in self.lang_font[lang]['fonts']]
             print('rand_font=True, all fonts are loaded!')
-        for jp in json_path:
-            data_list += self.load_data(jp, percent)
-        self.data_list = data_list
+        self.shard_glyphs = False
+        if shard_dir:
+            self.data_list = self.load_shards(shard_dir, font_path)
+        else:
+            if columnar:  # items go straight from the manifest stream into the columns, no list of dicts in between
+                self.data_list = AnnotationStore(info for jp in json_path for info in self.iter_data(jp, percent))
+            else:
+                for jp in json_path:
+                    data_list += self.load_data(jp, percent)
+                self.data_list = data_list
         print(f'All dataset loaded, imgs={len(self.data_list)}')
         self.debug = debug
         if self.debug:
             self.tmp_items = [i for i in range(100)]
 
     def load_data(self, json_path, percent):
+        return list(self.iter_data(json_path, percent))
+
+    # parsed and filtered manifest items, one dict at a time
+    def iter_data(self, json_path, percent):
         tic = time.time()
-        content = load(json_path)
-        d = []
+        manifest = Manifest(json_path)  # streamed, stops at the percent cut-off
+        n = 0
         count = 0
         wm_skip = 0
-        max_img = len(content['data_list']) * percent
-        for gt in content['data_list']:
-            if len(d) > max_img:
+        max_img = float('inf')
+        if percent < 1:  # needs the record count: without a sidecar index the whole manifest is parsed once here (index written)
+            if manifest.offsets is None:
+                print(f'{json_path}: no index yet, parsing the whole manifest once to count records for percent={percent}')
+            max_img = len(manifest) * percent
+        for gt in manifest.records():
+            if n > max_img:
                 break
             if 'wm_score' in gt and gt['wm_score'] > self.wm_thresh:  # wm_score > thresh will be skiped as an img with watermark
                 wm_skip += 1
                 continue
-            data_root = content['data_root']
+            data_root = manifest.get_meta('data_root')
             if self.using_dlc:
                 data_root = data_root.replace('/data/vdb', '/mnt/data', 1)
             img_path = os.path.join(data_root, gt['img_name'])
@@ -501,20 +737,39 @@ class T3DataSet(Dataset):
                 info['pos'] = pos
                 info['color'] = [np.array(i) for i in color]
                 info['polygons'] = np.array(info['polygons'], dtype=np.int32)
-            d.append(info)
-        print(f'{json_path} loaded, imgs={len(d)}, wm_skip={wm_skip}, time={(time.time()-tic):.2f}s')
+            yield info
+            n += 1
+        print(f'{json_path} loaded, imgs={n}, wm_skip={wm_skip}, time={(time.time()-tic):.2f}s')
         if count > 0:
             print(f"Found {count} image's caption contain placeholder: {self.place_holder}, change to ' '...")
-        return d
+
+    def load_shards(self, shard_dir, font_path):
+        reader = ShardReader(shard_dir)
+        args = reader.meta['args']
+        # gly_line renders are only valid for the same font and text truncation
+        self.shard_glyphs = args['render_glyph'] and not self.rand_font and args['max_chars'] == self.max_chars and \
+            args['font_path'] == os.path.abspath(font_path)
+        reader.load_renders = self.shard_glyphs
+        if args['img_wh'] != self.img_wh:
+            print(f'Warning: shards in {shard_dir} are packed at {args["img_wh"]}px, resized to {self.img_wh}px on load')
+        print(f'{shard_dir} loaded, imgs={len(reader)}, prerendered gly_line={self.shard_glyphs}')
+        return reader
+
+    # target image in (-1, 1), hwc float32. Shard items carry the decoded, resized image
+    def load_image(self, cur_item):
+        if 'img' in cur_item:
+            target = cur_item['img']
+        else:
+            target = self.image_loader.load(cur_item['img_path'])
+        if target.shape[0] != self.img_wh or target.shape[1] != self.img_wh:
+            target = cv2.resize(target, (self.img_wh, self.img_wh))
+        return (target.astype(np.float32) / 127.5) - 1.0
 
     def __getitem__(self, item):
 ###修改3####################################################################
         item_dict = {}
         cur_item = self.data_list[item]
-        target = np.array(Image.open(cur_item['img_path']).convert('RGB'))
-        if target.shape[0] != self.img_wh or target.shape[1] != self.img_wh:
-            target = cv2.resize(target, (self.img_wh, self.img_wh))
-        target = (target.astype(np.float32) / 127.5) - 1.0
+        target = self.load_image(cur_item)
         item_dict['img'] = target
         item_dict['img_caption'] = cur_item.get('caption', '')
         # --- 阶段一的特殊处理 ---
@@ -523,16 +778,21 @@ class T3DataSet(Dataset):
             item_dict['text_caption'] = ''
             item_dict['n_lines'] = 0
             # 使用np.zeros创建空的占位符
-            item_dict['glyphs'] = [np.zeros((self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale, 3))] * self.max_lines
-            item_dict['gly_line'] = [np.zeros((80, 512, 1))] * self.max_lines
-            item_dict['positions'] = [np.zeros((self.img_wh, self.img_wh, 1))] * self.max_lines
+            if self.sparse_glyphs:
+                item_dict['glyphs'] = [empty_roi(self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale)] * self.max_lines
+            else:
+                item_dict['glyphs'] = [np.zeros((self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale, 3), self.glyph_dtype)] * self.max_lines
+            item_dict['gly_line'] = [np.zeros((80, 512, 1), self.mask_dtype)] * self.max_lines
+            item_dict['positions'] = [np.zeros((self.img_wh, self.img_wh, 1), self.mask_dtype)] * self.max_lines
             item_dict['texts'] = [' '] * self.max_lines
             item_dict['language'] = [' '] * self.max_lines
             item_dict['color'] = [np.array(default_color)] * self.max_lines
-            item_dict['hint'] = np.zeros((self.img_wh, self.img_wh, 1))
-            item_dict['font_hint'] = np.zeros((self.img_wh, self.img_wh, 1))
+            item_dict['hint'] = np.zeros((self.img_wh, self.img_wh, 1), self.mask_dtype)
+            item_dict['font_hint'] = np.zeros((self.img_wh, self.img_wh, 1), self.mask_dtype)
             item_dict['masked_img'] = np.zeros_like(target) - 1
-            item_dict['inv_mask'] = np.zeros((self.img_wh, self.img_wh, 1))
+            item_dict['inv_mask'] = np.zeros((self.img_wh, self.img_wh, 1), self.mask_dtype)
+            if self.packed_lines:
+                return self.pack_lines(item_dict)
             return item_dict
 ###修改3结束####################################################################
 # --- 以下是阶段二的逻辑 (原始逻辑) ---
@@ -543,12 +803,9 @@ class T3DataSet(Dataset):
         if self.debug:  # sample fixed items
             item = self.tmp_items.pop()
             print(f'item = {item}')
-        cur_item = self.data_list[item]
-        # img
-        target = np.array(Image.open(cur_item['img_path']).convert('RGB'))
-        if target.shape[0] != self.img_wh or target.shape[1] != self.img_wh:
-            target = cv2.resize(target, (self.img_wh, self.img_wh))
-        target = (target.astype(np.float32) / 127.5) - 1.0
+            cur_item = self.data_list[item]
+            target = self.load_image(cur_item)
+        # img, decoded once above
         item_dict['img'] = target
         # caption
         if self.trunc_cap > 0:
@@ -558,8 +815,7 @@ class T3DataSet(Dataset):
         item_dict['glyphs'] = []
         item_dict['gly_line'] = []
         item_dict['positions'] = []
-        font_hints = []
-        font_hints_mask = []
+        font_hint = np.zeros((self.img_wh, self.img_wh), bool)  # all lines, see draw_font_hint_line
 
         item_dict['texts'] = []
         item_dict['language'] = []
@@ -590,6 +846,7 @@ class T3DataSet(Dataset):
         item_dict['texts'] = [cur_item['texts'][i][:self.max_chars] for i in sel_idxs]
         item_dict['language'] = [cur_item['language'][i] for i in sel_idxs]
         # glyphs
+        use_fonts = []
         for idx, text in enumerate(item_dict['texts']):
             if self.rand_font:
                 lang = item_dict['language'][idx]
@@ -597,21 +854,28 @@ class T3DataSet(Dataset):
                 use_font = random.choice(self.lang_font[lang])  # random font
             else:
                 use_font = self.font  # arial unicode
-            gly_line = draw_glyph(use_font, text)
-            if self.render_glyph:
-                glyphs = draw_glyph2(use_font, text, item_dict['polygons'][idx], item_dict['color'][idx], scale=self.glyph_scale, width=self.img_wh, height=self.img_wh)
+            use_fonts += [use_font]
+            if self.shard_glyphs and 'gly_lines' in cur_item:  # rendered with self.font by tools/pack_shards.py
+                gly_line = unpack_gly_line(cur_item['gly_lines'][sel_idxs[idx]])
             else:
-                glyphs = np.zeros((self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale, 3), np.float64)
-            item_dict['glyphs'] += [glyphs]
-            item_dict['gly_line'] += [gly_line]
+                gly_line = draw_glyph(use_font, text)
+            item_dict['gly_line'] += [gly_line.astype(self.mask_dtype)]
+        # all lines on one canvas (ControlNet only uses their sum), the other line slots stay empty
+        blank = np.zeros((self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale, 3), self.glyph_dtype)
+        if self.render_glyph and self.for_show:  # per-line glyphs for inspection
+            item_dict['glyphs'] = [draw_glyph2(f, t, p, c, scale=self.glyph_scale, width=self.img_wh, height=self.img_wh)
+                                   for f, t, p, c in zip(use_fonts, item_dict['texts'], item_dict['polygons'], item_dict['color'])]
+        elif self.render_glyph and len(use_fonts) > 0:
+            glyphs = draw_glyphs(use_fonts, item_dict['texts'], item_dict['polygons'], item_dict['color'], scale=self.glyph_scale, width=self.img_wh, height=self.img_wh, dtype=self.glyph_dtype)
+            item_dict['glyphs'] = [glyphs] + [blank] * (len(use_fonts) - 1)
+        else:
+            item_dict['glyphs'] = [blank] * len(use_fonts)
         # mask_pos
         for polygon in item_dict['polygons']:
             target_area_ratio_pos = [1.0, 1.0]  # 0.6--0.9
             item_dict['positions'] += [self.draw_pos(polygon, self.mask_pos_prob, target_area_ratio_pos)]
             if self.font_hint_prob > 0:
-                font_hint, font_hint_mask = draw_font_hint(target, polygon, target_area_range=self.font_hint_area, prob=self.font_hint_prob, randaug=self.font_hint_randaug)
-                font_hints += [font_hint]
-                font_hints_mask += [font_hint_mask]
+                draw_font_hint_line(font_hint, target, polygon, target_area_range=self.font_hint_area, prob=self.font_hint_prob, randaug=self.font_hint_randaug)
 
         # inv_mask
         invalid_polygons = cur_item['invalid_polygons'] if 'invalid_polygons' in cur_item else []
@@ -626,7 +890,7 @@ class T3DataSet(Dataset):
             for i in range(box_num):
                 pos_list += [self.draw_pos(boxes[i], self.mask_pos_prob)]
             invalid_polygons = []  # clear invalid_polygons for editing mode
-            mask = self.get_hint(pos_list)
+            mask = self.get_hint(pos_list).astype(np.float64)
             if fix_masked_img_bug:
                 masked_img = (target-mask*10).clip(-1, 1)
             else:
@@ -639,7 +903,7 @@ class T3DataSet(Dataset):
         item_dict['masked_img'] = masked_img
         item_dict['inv_mask'] = self.draw_inv_mask(invalid_polygons)
         item_dict['hint'] = self.get_hint(item_dict['positions'])
-        item_dict['font_hint'] = self.get_hint(font_hints)
+        item_dict['font_hint'] = font_hint[..., None].astype(self.mask_dtype, copy=False)
 
         if self.for_show:
             item_dict['img_name'] = os.path.split(cur_item['img_path'])[-1]
@@ -649,11 +913,18 @@ class T3DataSet(Dataset):
         # padding
         n_lines = min(len(texts), self.max_lines)
         item_dict['n_lines'] = n_lines
+        if self.packed_lines:
+            return self.pack_lines(item_dict)
         n_pad = self.max_lines - n_lines
+        if self.sparse_glyphs:
+            item_dict['glyphs'] = [to_roi(g) if i == 0 else empty_roi(*g.shape) for i, g in enumerate(item_dict['glyphs'])]
         if n_pad > 0:
-            item_dict['glyphs'] += [np.zeros((self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale, 3))] * n_pad
-            item_dict['gly_line'] += [np.zeros((80, 512, 1))] * n_pad
-            item_dict['positions'] += [np.zeros((self.img_wh, self.img_wh, 1))] * n_pad
+            if self.sparse_glyphs:
+                item_dict['glyphs'] += [empty_roi(self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale)] * n_pad
+            else:
+                item_dict['glyphs'] += [np.zeros((self.img_wh*self.glyph_scale, self.img_wh*self.glyph_scale, 3), self.glyph_dtype)] * n_pad
+            item_dict['gly_line'] += [np.zeros((80, 512, 1), self.mask_dtype)] * n_pad
+            item_dict['positions'] += [np.zeros((self.img_wh, self.img_wh, 1), self.mask_dtype)] * n_pad
             item_dict['texts'] += [' '] * n_pad
             item_dict['language'] += [' '] * n_pad
             item_dict['color'] += [np.array(default_color)] * n_pad
@@ -663,16 +934,31 @@ class T3DataSet(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    # keep the first n_lines lines as (n_lines, ...) arrays and one glyph canvas (all lines are drawn on glyphs[0])
+    def pack_lines(self, item_dict):
+        n = item_dict['n_lines']
+        size = self.img_wh*self.glyph_scale
+        if n == 0:
+            glyphs = empty_roi(size, size) if self.sparse_glyphs else np.zeros((size, size, 3), self.glyph_dtype)
+        else:
+            glyphs = to_roi(item_dict['glyphs'][0]) if self.sparse_glyphs else item_dict['glyphs'][0]
+        item_dict['glyphs'] = glyphs
+        item_dict['gly_line'] = np.stack(item_dict['gly_line'][:n]) if n > 0 else np.zeros((0, 80, 512, 1), self.mask_dtype)
+        item_dict['positions'] = np.stack(item_dict['positions'][:n]) if n > 0 else np.zeros((0, self.img_wh, self.img_wh, 1), self.mask_dtype)
+        item_dict['color'] = np.stack(item_dict['color'][:n]) if n > 0 else np.zeros((0, 3), np.int64)
+        item_dict['texts'] = item_dict['texts'][:n]
+        item_dict['language'] = item_dict['language'][:n]
+        return item_dict
+
     def draw_inv_mask(self, polygons):
-        img = np.zeros((self.img_wh, self.img_wh))
+        img = np.zeros((self.img_wh, self.img_wh), np.uint8)
         for p in polygons:
             pts = p.reshape((-1, 1, 2))
             cv2.fillPoly(img, [pts], color=255)
-        img = img[..., None]
-        return img/255.
+        return self.to_mask(img[..., None])
 
     def draw_pos(self, ploygon, prob=1.0, target_area_range=[1.0, 1.0]):
-        img = np.zeros((self.img_wh, self.img_wh))
+        img = np.zeros((self.img_wh, self.img_wh), np.uint8)
         rect = cv2.minAreaRect(np.array(ploygon,dtype=int))
         center, size, angle = rect
         w, h = size
@@ -717,14 +1003,21 @@ class T3DataSet(Dataset):
                     mask_center - mask_vector + short_axis_vector
                 ], dtype=np.int32)
                 cv2.fillPoly(img, [mask_corners], color=0)
-        img = img[..., None]
-        return img/255.
+        return self.to_mask(img[..., None])
 
     def get_hint(self, positions):
         if len(positions) == 0:
-            return np.zeros((self.img_wh, self.img_wh, 1))
+            return np.zeros((self.img_wh, self.img_wh, 1), self.mask_dtype)
+        if self.compact_dtypes:
+            return np.any(positions, axis=0)
         return np.sum(positions, axis=0).clip(0, 1)
 
+    # uint8 {0, 255} -> bool, or float64 {0, 1} as before
+    def to_mask(self, img):
+        if self.compact_dtypes:
+            return img > 0
+        return img / 255.
+
 
 if __name__ == '__main__':
     '''
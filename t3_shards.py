@@ -0,0 +1,112 @@
+'''
+Preprocessed training shards for T3DataSet, written by tools/pack_shards.py.
+Every sample is one npz record (deflate compressed per member) holding the image already decoded
+and resized to img_wh, the annotations of load_data() and optionally the gly_line render of every
+text (bitpacked, deterministic for a fixed font). Records are stored back to back, so a sample is
+read from a memory-mapped shard with one slice, the random augmentations stay in __getitem__.
+Layout of a shard directory:
+    meta.json               packing args, shard names and sizes
+    shard_00000.bin         npz records
+    shard_00000.idx.npy     (n, 2) int64 offset/length of every record, written when the shard is complete
+Usage:
+    dataset = T3DataSet(None, shard_dir='./shards/train', ...)
+'''
+import os
+import io
+import json
+import bisect
+import numpy as np
+
+META_NAME = 'meta.json'
+GLY_LINE_SHAPE = (80, 512, 1)
+
+
+def shard_name(i):
+    return f'shard_{i:05d}'
+
+
+def shard_paths(shard_dir, name):
+    return os.path.join(shard_dir, name + '.bin'), os.path.join(shard_dir, name + '.idx.npy')
+
+
+def read_meta(shard_dir):
+    with open(os.path.join(shard_dir, META_NAME), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_meta(shard_dir, meta):
+    path = os.path.join(shard_dir, META_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+# one load_data() item (+ 'img' uint8 hwc, optional gly_lines) -> npz bytes
+def encode_sample(info, img, gly_lines=None):
+    meta = {}
+    for k, v in info.items():
+        if k in ['polygons', 'invalid_polygons', 'color']:
+            meta[k] = [np.asarray(p).tolist() for p in v]
+        else:
+            meta[k] = v
+    arrays = {'img': img, 'meta': np.array(json.dumps(meta, ensure_ascii=False))}
+    if gly_lines is not None and len(gly_lines) > 0:
+        arrays['gly_lines'] = np.stack([np.packbits(g.astype(bool).ravel()) for g in gly_lines])
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def decode_sample(data, load_renders=True):
+    with np.load(io.BytesIO(data)) as f:
+        info = json.loads(str(f['meta']))
+        info['img'] = f['img']
+        if load_renders and 'gly_lines' in f.files:
+            info['gly_lines'] = f['gly_lines']
+    if 'polygons' in info:
+        info['polygons'] = np.array(info['polygons'], dtype=np.int32)  # as load_data()
+    if 'invalid_polygons' in info:
+        info['invalid_polygons'] = [np.array(p) for p in info['invalid_polygons']]
+    if 'color' in info:
+        info['color'] = [np.array(c) for c in info['color']]
+    return info
+
+
+def unpack_gly_line(packed):
+    return np.unpackbits(packed, count=int(np.prod(GLY_LINE_SHAPE))).reshape(GLY_LINE_SHAPE)
+
+
+class ShardReader(object):
+    def __init__(self, shard_dir, load_renders=True):
+        self.shard_dir = shard_dir
+        self.meta = read_meta(shard_dir)
+        self.load_renders = load_renders
+        self.names = [s['name'] for s in self.meta['shards']]
+        self.index = []
+        for name in self.names:
+            idx_path = shard_paths(shard_dir, name)[1]
+            assert os.path.exists(idx_path), f'Shard {name} in {shard_dir} is incomplete, run tools/pack_shards.py again to resume'
+            self.index += [np.load(idx_path)]
+        self.starts = np.cumsum([0] + [len(i) for i in self.index]).tolist()
+        self._maps = {}
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, item):
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError(item)
+        s = bisect.bisect_right(self.starts, item) - 1
+        offset, length = self.index[s][item - self.starts[s]]
+        mm = self._maps.get(s)
+        if mm is None:  # opened lazily, so every dataloader worker maps its own view
+            mm = np.memmap(shard_paths(self.shard_dir, self.names[s])[0], dtype=np.uint8, mode='r')
+            self._maps[s] = mm
+        return decode_sample(mm[offset:offset+length].tobytes(), self.load_renders)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
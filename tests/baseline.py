@@ -0,0 +1,194 @@
+'''
+Reference code paths of the original implementation, copied from the first commit of this tree.
+The equivalence tests compare the optimised modules against them.
+'''
+import os
+import numpy as np
+import cv2
+from PIL import Image, ImageDraw, ImageFont
+
+
+def insert_spaces(text, num_spaces):
+    return (' ' * num_spaces).join(text)
+
+
+# textbbox binary search of draw_glyph2 for the font size of a max_dim x min_dim box
+def adjust_font_size(font, text, max_dim, min_dim):
+    draw = ImageDraw.Draw(Image.new('RGB', (512, 512), 'white'))
+    min_size, max_size = 1, min_dim
+    while min_size < max_size:
+        mid_size = (min_size + max_size) // 2
+        new_font = font.font_variant(size=int(mid_size))
+        bbox = draw.textbbox((0, 0), text=text, font=new_font)
+        text_w = bbox[2] - bbox[0]
+        text_h = bbox[3] - bbox[1]
+        if text_w <= max_dim and text_h <= min_dim:
+            min_size = mid_size + 1
+        else:
+            max_size = mid_size
+    return max_size - 1
+
+
+# insert_spaces probe loop of draw_glyph2 for horizontal lines
+def add_spaces(new_font, text, max_dim, min_dim):
+    draw = ImageDraw.Draw(Image.new('RGB', (512, 512), 'white'))
+    for i in range(1, 100):
+        text_space = insert_spaces(text, i)
+        bbox2 = draw.textbbox((0, 0), text=text_space, font=new_font)
+        text_w, text_h = bbox2[2] - bbox2[0], bbox2[3] - bbox2[1]
+        if text_w > max_dim or text_h > min_dim:
+            text = insert_spaces(text, i - 1)
+            break
+    return text
+
+
+# original draw_glyph2: full-canvas layer, textbbox search, Image.rotate(expand=1)
+def draw_glyph2(font, text, polygon, color, vertAng=10, scale=1, width=512, height=512, add_space=True):
+    def initialize_img(width, height, scale):
+        img = np.zeros((height * scale, width * scale, 3), np.uint8)
+        return Image.fromarray(img)
+
+    def prepare_image(img):
+        return np.array(img.convert('RGB')).astype(np.float64) / 255.0
+
+    try:
+        if color.mean() < 0:
+            color = np.array([255, 255, 255])
+        color = np.clip(color, 10, 255)  # RGB >= 10
+        if isinstance(font, str):
+            if os.path.exists(font):
+                font = ImageFont.truetype(font, size=60)
+            else:
+                img = initialize_img(width, height, scale)
+                return prepare_image(img)
+        enlarge_polygon = np.array(polygon) * scale
+        rect = cv2.minAreaRect(enlarge_polygon)
+        box = cv2.boxPoints(rect)
+        box = np.int0(box)
+        w, h = rect[1]
+        angle = rect[2]
+
+        if angle < -45:
+            angle += 90
+        angle = -angle
+        if w < h:
+            angle += 90
+
+        vert = False
+        if (abs(angle) % 90 < vertAng or abs(90 - abs(angle) % 90) % 90 < vertAng):
+            _w = max(box[:, 0]) - min(box[:, 0])
+            _h = max(box[:, 1]) - min(box[:, 1])
+            if _h >= _w:
+                vert = True
+                angle = 0
+
+        img = initialize_img(width, height, scale)
+        image4ratio = Image.new("RGB", img.size, "white")
+        draw = ImageDraw.Draw(image4ratio)
+        min_dim = min(w, h)
+        max_dim = max(w, h)
+
+        # Binary search for optimal font size
+        def adjust_font_size(min_size, max_size, text):
+            while min_size < max_size:
+                mid_size = (min_size + max_size) // 2
+                new_font = font.font_variant(size=int(mid_size))
+                bbox = draw.textbbox((0, 0), text=text, font=new_font)
+                text_w = bbox[2] - bbox[0]
+                text_h = bbox[3] - bbox[1]
+                if text_w <= max_dim and text_h <= min_dim:
+                    min_size = mid_size + 1
+                else:
+                    max_size = mid_size
+            return max_size - 1
+
+        optimal_font_size = adjust_font_size(1, min_dim, text)
+        new_font = font.font_variant(size=int(optimal_font_size))
+
+        extra_space = 0
+        if add_space:
+            if vert:
+                # Calculate total height with added space
+                total_height = sum(draw.textbbox((0, 0), text=char, font=new_font)[3] -
+                                   draw.textbbox((0, 0), text=char, font=new_font)[1]
+                                   for char in text)
+                if total_height < max_dim and len(text) > 1:
+                    extra_space = (max_dim - total_height) // (len(text) - 1)
+            else:
+                # Handle horizontal text space addition
+                for i in range(1, 100):
+                    text_space = insert_spaces(text, i)
+                    bbox2 = draw.textbbox((0, 0), text=text_space, font=new_font)
+                    text_w, text_h = bbox2[2] - bbox2[0], bbox2[3] - bbox2[1]
+                    if text_w > max_dim or text_h > min_dim:
+                        text = insert_spaces(text, i - 1)
+                        break
+
+        left, top, right, bottom = draw.textbbox((0, 0), text=text, font=new_font)
+        text_width = right - left
+        text_height = bottom - top
+
+        layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+
+        if not vert:
+            text_y_center = rect[0][1] - (text_height / 2)
+            draw.text((rect[0][0] - text_width / 2, text_y_center - top), text, font=new_font, fill=tuple(color)+(255,))
+        else:
+            x_s = min(box[:, 0]) + _w // 2 - text_height // 2
+            y_s = min(box[:, 1])
+            for c in text:
+                draw.text((x_s, y_s), c, font=new_font, fill=tuple(color)+(255,))
+                _, _t, _, _b = draw.textbbox((0, 0), text=c, font=new_font)
+                char_height = _b - _t
+                y_s += char_height + extra_space
+
+        rotated_layer = layer.rotate(angle, expand=1, center=(rect[0][0], rect[0][1]))
+        x_offset = int((img.width - rotated_layer.width) / 2)
+        y_offset = int((img.height - rotated_layer.height) / 2)
+        img.paste(rotated_layer, (x_offset, y_offset), rotated_layer)
+
+        return prepare_image(img)
+
+    except Exception as e:
+        print(f"An error occurred in draw_glyph2: {e}")
+        img = initialize_img(width, height, scale)
+        return prepare_image(img)
+
+
+# AnyText2Model.separate_pos_imgs: one full-size image per connected component, in reading order
+def separate_pos_imgs(img, sort_priority, gap=102):
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(img)
+    components = []
+    for label in range(1, num_labels):
+        area = stats[label, cv2.CC_STAT_AREA]
+        if area < 20:
+            continue
+        component = np.zeros_like(img)
+        component[labels == label] = 255
+        components.append((component, centroids[label]))
+    if sort_priority == '↕':
+        fir, sec = 1, 0  # top-down first
+    elif sort_priority == '↔':
+        fir, sec = 0, 1  # left-right first
+    components.sort(key=lambda c: (c[1][fir]//gap, c[1][sec]//gap))
+    sorted_components = [c[0] for c in components]
+    return sorted_components
+
+
+# AnyText2Model.find_polygon
+def find_polygon(image, min_rect=False):
+    contours, hierarchy = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    max_contour = max(contours, key=cv2.contourArea)  # get contour with max area
+    if min_rect:
+        # get minimum enclosing rectangle
+        rect = cv2.minAreaRect(max_contour)
+        poly = np.int0(cv2.boxPoints(rect))
+    else:
+        # get approximate polygon
+        epsilon = 0.01 * cv2.arcLength(max_contour, True)
+        poly = cv2.approxPolyDP(max_contour, epsilon, True)
+        n, _, xy = poly.shape
+        poly = poly.reshape(n, xy)
+    cv2.drawContours(np.ascontiguousarray(image, dtype=np.uint8), [poly], -1, 255, -1)
+    return poly, image
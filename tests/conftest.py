@@ -0,0 +1,27 @@
+'''
+Shared fixtures of the equivalence tests. Tests that render glyphs need a TrueType font, by default
+the ./font/Arial_Unicode.ttf used for training (or $ANYTEXT_TEST_FONT), and are skipped without one.
+'''
+import os
+import sys
+import json
+import pytest
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+
+@pytest.fixture(scope='session')
+def font_path():
+    path = os.environ.get('ANYTEXT_TEST_FONT', os.path.join(ROOT, 'font', 'Arial_Unicode.ttf'))
+    if not os.path.exists(path):
+        pytest.skip(f'font {path} not found')
+    return path
+
+
+# (text, int32 polygon) of the annotations in poem_data, as T3DataSet.load_data reads them
+@pytest.fixture(scope='session')
+def poem_lines():
+    np = pytest.importorskip('numpy')
+    with open(os.path.join(ROOT, 'poem_data', 'poem_data.json'), 'r', encoding='utf-8') as f:
+        data_list = json.load(f)['data_list']
+    return [(a['text'], np.array(a['polygon'], dtype=np.int32)) for d in data_list for a in d.get('annotations', []) if len(a['polygon']) > 0]
@@ -0,0 +1,82 @@
+'''
+AnnotationStore must give back exactly the items of T3DataSet.load_data: same keys, values, numpy
+dtypes and shapes, for poem_data and for manifests with the corner cases load_data handles.
+    python -m pytest tests/test_annotation_store.py
+'''
+import os
+import json
+import shutil
+import pytest
+np = pytest.importorskip('numpy')
+t3_dataset = pytest.importorskip('t3_dataset')
+from annotation_store import AnnotationStore
+from conftest import ROOT
+
+
+def dataset():
+    ds = t3_dataset.T3DataSet.__new__(t3_dataset.T3DataSet)
+    ds.using_dlc = False
+    ds.wm_thresh = 1.0
+    ds.cap_watermark = True
+    ds.place_holder = '*'
+    return ds
+
+
+def box(x, y, w=80, h=20):
+    return [[x, y], [x + w, y + 0.5], [x + w - 0.25, y + h], [x, y + h]]
+
+
+def write_manifest(path):
+    data_list = [
+        {'img_name': 'a.jpg', 'caption': 'a sign with "*" on it', 'wm_score': 0.2, 'annotations': [
+            {'polygon': box(10.7, 20.2), 'text': 'OPEN', 'language': 'Latin', 'color': [250, 20, 30]},
+            {'polygon': box(100, 200, 30, 120), 'text': '山有木兮', 'language': 'Chinese', 'pos': [1, 2]},
+            {'polygon': box(5, 5), 'text': '雲', 'language': 'Chinese', 'valid': False},
+            {'polygon': [], 'text': 'empty', 'language': 'Latin'},
+            {'polygon': box(300, 50, 120, 40), 'text': '漢字', 'language': 'Chinese', 'color': [0, 0, 0], 'pos': {'x': 1}},
+        ]},
+        {'img_name': 'b.jpg'},  # no caption, no annotations
+        {'img_name': 'c.jpg', 'caption': 'only invalid', 'wm_score': 0.9, 'annotations': [
+            {'polygon': box(1, 1), 'text': 'x', 'language': 'Latin', 'valid': False},
+            {'polygon': box(50, 60), 'text': 'y', 'language': 'Latin', 'valid': False},
+        ]},
+        {'img_name': 'd.jpg', 'caption': 'watermarked', 'wm_score': 1.5, 'annotations': []},  # skipped
+        {'img_name': 'e.jpg', 'caption': '', 'annotations': []},
+        {'img_name': 'f.jpg', 'caption': 'many *** lines', 'annotations': [
+            {'polygon': box(10 * k, 20 * k), 'text': f'line {k}', 'language': 'Korean', 'color': [k, 2 * k, 3 * k]} for k in range(12)]},
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'data_root': '/data/vdb/imgs', 'data_list': data_list}, f, ensure_ascii=False)
+
+
+def assert_same(out, ref):
+    assert sorted(out.keys()) == sorted(ref.keys())
+    for key, value in ref.items():
+        if isinstance(value, np.ndarray):
+            assert out[key].dtype == value.dtype and np.array_equal(out[key], value), key
+        elif key in ('invalid_polygons', 'color'):
+            assert len(out[key]) == len(value), key
+            for a, b in zip(out[key], value):
+                assert a.dtype == b.dtype and np.array_equal(a, b), key
+        else:
+            assert out[key] == value, key
+
+
+@pytest.mark.parametrize('name', ['poem_data', 'synthetic'])
+def test_matches_load_data(tmp_path, name):
+    path = str(tmp_path / 'manifest.json')  # the manifest index is written next to it
+    if name == 'poem_data':
+        shutil.copy(os.path.join(ROOT, 'poem_data', 'poem_data.json'), path)
+    else:
+        write_manifest(path)
+    ds = dataset()
+    ref = ds.load_data(path, 1.0)
+    store = AnnotationStore(ds.iter_data(path, 1.0))
+    assert len(store) == len(ref) > 0
+    for i in range(len(ref)):
+        assert_same(store[i], ref[i])
+    assert_same(store[-1], ref[-1])
+    for out, r in zip(store[1:5:2], ref[1:5:2]):
+        assert_same(out, r)
+    with pytest.raises(IndexError):
+        store[len(ref)]
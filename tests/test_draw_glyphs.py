@@ -0,0 +1,92 @@
+'''
+draw_glyph2 and draw_glyphs must render exactly the canvas of the original draw_glyph2
+(tests/baseline.py): horizontal, vertical and rotated lines, lines partly outside the canvas, and
+several lines on one canvas.
+    python -m pytest tests/test_draw_glyphs.py
+'''
+import pytest
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+ImageFont = pytest.importorskip('PIL.ImageFont')
+t3_dataset = pytest.importorskip('t3_dataset')
+import baseline
+import glyph_cache
+
+TEXTS = ['Hello World', '山有木兮木有枝', 'AnyText2', 'gjpqy', '心悦君兮君不知']
+BOXES = [(256, 256, 300, 40), (100, 400, 120, 30), (480, 30, 200, 50), (256, 256, 60, 200), (20, 500, 90, 24)]
+
+
+def rotated_box(cx, cy, w, h, angle):
+    return cv2.boxPoints(((cx, cy), (w, h), angle)).astype(np.int32)
+
+
+def rotated_lines():
+    lines = []
+    for angle in range(-85, 90, 7):
+        for k, (cx, cy, w, h) in enumerate(BOXES):
+            lines += [(TEXTS[(angle + k) % len(TEXTS)], rotated_box(cx, cy, w, h, angle))]
+    return lines
+
+
+def roi_to_full(roi):
+    img = np.zeros((roi.height, roi.width, roi.crop.shape[2]), np.uint8)
+    img[roi.y:roi.y+roi.crop.shape[0], roi.x:roi.x+roi.crop.shape[1]] = roi.crop
+    return img
+
+
+@pytest.fixture
+def font(font_path):
+    glyph_cache.disable()
+    return ImageFont.truetype(font_path, size=60)
+
+
+def test_draw_glyph2_matches_baseline(font, poem_lines):
+    color = np.array([230, 120, 30])
+    diff = []
+    for text, polygon in poem_lines + rotated_lines():
+        ref = baseline.draw_glyph2(font, text, polygon, color)
+        out = t3_dataset.draw_glyph2(font, text, polygon, color)
+        if not np.array_equal(out, ref):
+            diff += [(text, polygon.tolist())]
+    assert diff == []
+
+
+def test_draw_glyph2_scale(font, poem_lines):
+    color = np.array([255, 255, 255])
+    for text, polygon in poem_lines[:20] + rotated_lines()[:20]:
+        ref = baseline.draw_glyph2(font, text, polygon, color, scale=2)
+        assert np.array_equal(t3_dataset.draw_glyph2(font, text, polygon, color, scale=2), ref), text
+
+
+def test_draw_glyphs_lines(font):
+    # 3 lines per canvas, side by side and far enough apart not to overlap at any angle
+    for angle in range(-90, 91, 15):
+        texts = TEXTS[:3]
+        polygons = [rotated_box(90 + 166 * k, 256, 140, 30, angle / (k + 1)) for k in range(3)]
+        colors = [np.array([255, 255, 255]), np.array([40, 200, 90]), np.array([-1, -1, -1])]
+        refs = [baseline.draw_glyph2(font, t, p, c) for t, p, c in zip(texts, polygons, colors)]
+        canvas, rois = t3_dataset.draw_glyphs(font, texts, polygons, colors, return_lines=True)
+        assert np.array_equal(canvas, np.sum(refs, axis=0).clip(0, 1))
+        for roi, ref in zip(rois, refs):
+            assert np.array_equal(roi_to_full(roi), np.round(ref * 255).astype(np.uint8))
+        canvas_u8 = t3_dataset.draw_glyphs(font, texts, polygons, colors, dtype=np.uint8)
+        assert np.array_equal(canvas_u8, np.round(np.sum(refs, axis=0).clip(0, 1) * 255).astype(np.uint8))
+
+
+def test_draw_glyphs_cached(font, poem_lines, tmp_path):
+    texts = [t for t, _ in poem_lines[:8]] + [t for t, _ in rotated_lines()[:8]]
+    polygons = [p for _, p in poem_lines[:8]] + [p for _, p in rotated_lines()[:8]]
+    colors = [np.array([200, 100, 50])] * len(texts)
+    ref, ref_rois = t3_dataset.draw_glyphs(font, texts, polygons, colors, return_lines=True)
+    cache = glyph_cache.enable(max_mb=64, cache_dir=str(tmp_path))
+    try:
+        for k in range(3):  # render, memory hits, disk hits
+            if k == 2:
+                cache.clear()
+            canvas, rois = t3_dataset.draw_glyphs(font, texts, polygons, colors, return_lines=True)
+            assert np.array_equal(canvas, ref)
+            for roi, ref_roi in zip(rois, ref_rois):
+                assert np.array_equal(roi_to_full(roi), roi_to_full(ref_roi))
+        assert cache.renders == len(texts) and cache.disk_hits == len(texts)
+    finally:
+        glyph_cache.disable()
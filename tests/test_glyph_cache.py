@@ -0,0 +1,75 @@
+'''
+glyph_cache must return exactly the uncached render, from memory and from disk, and keep the memory
+LRU under max_mb.
+    python -m pytest tests/test_glyph_cache.py
+'''
+import pytest
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+import glyph_cache
+from glyph_cache import GlyphCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    yield glyph_cache.enable(max_mb=64, cache_dir=str(tmp_path / 'glyphs'))
+    glyph_cache.disable()
+
+
+def random_canvas(seed, binary):
+    rng = np.random.RandomState(seed)
+    img = np.zeros((64, 96, 1 if binary else 3))
+    y, x = rng.randint(0, 48), rng.randint(0, 80)
+    patch = rng.randint(0, 2, (16, 16, img.shape[2])) if binary else rng.randint(0, 256, (16, 16, 3)) / 255.0
+    img[y:y+16, x:x+16] = patch
+    return img
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_roundtrip(tmp_path, binary):
+    cache = GlyphCache(max_mb=1, cache_dir=str(tmp_path))
+    for seed in range(20):
+        img = random_canvas(seed, binary)
+        for _ in range(2):  # render, memory hit
+            out = cache.fetch(f'k{seed}', lambda: img, binary)
+            assert out.dtype == img.dtype and np.array_equal(out, img)
+    cache.clear()
+    for seed in range(20):  # disk hits
+        out = cache.fetch(f'k{seed}', lambda: None, binary)
+        assert np.array_equal(out, random_canvas(seed, binary))
+    assert cache.renders == 20 and cache.disk_hits == 20
+
+
+def test_not_lossless_is_not_cached():
+    cache = GlyphCache(max_mb=1)
+    img = np.full((8, 8, 3), 0.3)  # not a multiple of 1/255
+    assert cache.fetch('k', lambda: img, False) is img
+    assert len(cache.mem) == 0
+
+
+def test_byte_cap():
+    cache = GlyphCache(max_mb=0.01)
+    for seed in range(100):
+        cache.fetch(f'k{seed}', lambda: random_canvas(seed, False), False)
+        assert cache.mem.nbytes <= 0.01 * 2**20
+    assert 0 < len(cache.mem) < 100
+
+
+def test_cached_glyph_renders(cache, font_path, poem_lines):
+    t3_dataset = pytest.importorskip('t3_dataset')
+    color = np.array([200, 120, 40])
+    for text, polygon in poem_lines[:20]:
+        glyph_cache.disable()
+        ref_line = t3_dataset.draw_glyph(font_path, text)
+        ref = t3_dataset.draw_glyph2(font_path, text, polygon, color)
+        glyph_cache._cache = cache
+        for _ in range(2):
+            assert np.array_equal(t3_dataset.draw_glyph(font_path, text), ref_line)
+            assert np.array_equal(t3_dataset.draw_glyph2(font_path, text, polygon, color), ref)
+    cache.clear()
+    text, polygon = poem_lines[0]
+    glyph_cache.disable()
+    ref = t3_dataset.draw_glyph2(font_path, text, polygon, color)
+    glyph_cache._cache = cache
+    assert np.array_equal(t3_dataset.draw_glyph2(font_path, text, polygon, color), ref)
+    assert cache.disk_hits > 0
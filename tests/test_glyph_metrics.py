@@ -0,0 +1,71 @@
+'''
+GlyphMetrics.fit_font_size/fit_spacing must give the same font size and spacing as the textbbox
+search of the original draw_glyph2 (tests/baseline.py), and draw_glyph2 the same canvas with
+FAST_GLYPH_METRICS on and off.
+    python -m pytest tests/test_glyph_metrics.py
+'''
+import pytest
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+ImageFont = pytest.importorskip('PIL.ImageFont')
+import baseline
+from glyph_metrics import GlyphMetrics
+
+TEXTS = ['Hello World', 'AnyText2', 'ij', 'W', '山有木兮木有枝', 'gjpqy Ég', '1,234.5!']
+BOXES = [(30, 10), (200, 20), (512, 40), (100, 100), (13.5, 7.2), (300.7, 55.3), (64, 3), (2, 2)]
+
+
+def cases(poem_lines):
+    out = [(t, max_dim, min_dim) for t in TEXTS for max_dim, min_dim in BOXES]
+    for text, polygon in poem_lines[:150]:
+        w, h = cv2.minAreaRect(polygon)[1]
+        out += [(text, max(w, h), min(w, h))]
+    return out
+
+
+def test_fit_font_size(font_path, poem_lines):
+    font = ImageFont.truetype(font_path, size=60)
+    metrics = GlyphMetrics()
+    for text, max_dim, min_dim in cases(poem_lines):
+        size = metrics.fit_font_size(font, text, max_dim, min_dim)
+        if size is None:  # min_dim < 2, draw_glyph2 falls back to the search
+            assert int(min_dim - 1) < 1
+            continue
+        assert size == int(baseline.adjust_font_size(font, text, max_dim, min_dim)), (text, max_dim, min_dim)
+
+
+def test_fit_spacing(font_path, poem_lines):
+    font = ImageFont.truetype(font_path, size=60)
+    metrics = GlyphMetrics()
+    for text, max_dim, min_dim in cases(poem_lines):
+        size = metrics.fit_font_size(font, text, max_dim, min_dim)
+        if size is None or size < 1:
+            continue
+        ref = baseline.add_spaces(font.font_variant(size=size), text, max_dim, min_dim)
+        assert metrics.fit_spacing(font, size, text, max_dim, min_dim, baseline.insert_spaces) == ref, (text, max_dim, min_dim)
+
+
+def test_char_height(font_path):
+    font = ImageFont.truetype(font_path, size=60)
+    metrics = GlyphMetrics()
+    draw = baseline.ImageDraw.Draw(baseline.Image.new('RGB', (512, 512), 'white'))
+    for size in [5, 17, 32, 60]:
+        for c in '山Agjy.':
+            _, top, _, bottom = draw.textbbox((0, 0), text=c, font=font.font_variant(size=size))
+            assert metrics.char_height(font, size, c) == bottom - top
+
+
+def test_draw_glyph2_fast_metrics(font_path, poem_lines):
+    t3_dataset = pytest.importorskip('t3_dataset')
+    import glyph_cache
+    glyph_cache.disable()
+    font = ImageFont.truetype(font_path, size=60)
+    color = np.array([255, 255, 255])
+    try:
+        for text, polygon in poem_lines[:100]:
+            t3_dataset.FAST_GLYPH_METRICS = False
+            ref = t3_dataset.draw_glyph2(font, text, polygon, color)
+            t3_dataset.FAST_GLYPH_METRICS = True
+            assert np.array_equal(t3_dataset.draw_glyph2(font, text, polygon, color), ref), text
+    finally:
+        t3_dataset.FAST_GLYPH_METRICS = True
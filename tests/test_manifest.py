@@ -0,0 +1,56 @@
+'''
+scan_manifest must return the same records and meta as json.load for any chunk size, including
+numbers, strings and escapes cut by a chunk boundary, and byte offsets that point at each record.
+    python -m pytest tests/test_manifest.py
+'''
+import os
+import sys
+import json
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from manifest import scan_manifest
+
+RECORDS = [
+    {'img_name': 'a.jpg', 'caption': 'plain', 'wm_score': 0.25},
+    {'img_name': '中文.jpg', 'caption': '山有木兮 "quoted" \\ back\nslash', 'annotations': [
+        {'polygon': [[1, 2], [30, 2], [30, 40], [1, 40]], 'text': '木兮', 'language': 'Chinese', 'valid': True}]},
+    {'img_name': 'b.jpg', 'caption': 'numbers', 'wm_score': -1.5e-3, 'big': 12345678901234, 'neg': -7, 'exp': 2E+10},
+    {'img_name': 'c.jpg', 'caption': 'éè emoji \U0001f600', 'flags': [True, False, None], 'nested': {'x': [1.0, [2.5]]}},
+]
+
+
+def write_manifest(path, records, tail):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"data_root": "/data/imgs", "data_list": [\n')
+        f.write(',\n'.join(['  ' + json.dumps(r, ensure_ascii=False) for r in records]))
+        f.write('\n], ' + tail + '}')
+
+
+@pytest.mark.parametrize('tail', ['"tail": 1.5', '"tail": -12', '"tail": 3e-7', '"tail": [1, 2.25]', '"tail": "end"'])
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 11, 64, 1 << 20])
+def test_scan_matches_json_load(tmp_path, tail, chunk_size):
+    path = str(tmp_path / 'manifest.json')
+    write_manifest(path, RECORDS * 3, tail)
+    with open(path, 'r', encoding='utf-8') as f:
+        ref = json.load(f)
+    with open(path, 'rb') as f:
+        raw = f.read()
+    meta, records = {}, []
+    for item in scan_manifest(path, chunk_size=chunk_size):
+        if item[0] == 'meta':
+            meta[item[1]] = item[2]
+        else:
+            obj, offset, length = item[1:]
+            assert json.loads(raw[offset:offset+length].decode('utf-8')) == obj
+            records += [obj]
+    assert records == ref['data_list']
+    assert meta == {k: v for k, v in ref.items() if k != 'data_list'}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 1 << 20])
+def test_empty_data_list(tmp_path, chunk_size):
+    path = str(tmp_path / 'manifest.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"data_list": [], "data_root": "r", "n": 10.0}')
+    items = list(scan_manifest(path, chunk_size=chunk_size))
+    assert items == [('meta', 'data_root', 'r'), ('meta', 'n', 10.0)]
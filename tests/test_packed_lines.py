@@ -0,0 +1,112 @@
+'''
+t3_packed_collate batches must carry the same lines as t3_collate batches of the max_lines padded
+items: row offsets[i] + j of every line key equals [key][j][i], line_index holds (i, j), and the
+glyph canvas and the other keys are unchanged. Also checks the packed_lines helpers against loops.
+    python -m pytest tests/test_packed_lines.py
+'''
+import copy
+import pytest
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+t3_dataset = pytest.importorskip('t3_dataset')
+from glyph_roi import to_roi, empty_roi, is_roi_batch, densify
+from packed_lines import make_line_index, line_offsets, sum_lines, get_line
+
+IMG_WH = 64
+MAX_LINES = 5
+N_LINES = [[2, 0, 5, 1], [3], [0, 0], [5, 5, 1]]
+
+
+def test_line_helpers():
+    for n_lines in N_LINES:
+        ref_index, ref_offsets = [], [0]
+        for i, n in enumerate(n_lines):
+            ref_index += [[i, j] for j in range(n)]
+            ref_offsets += [ref_offsets[-1] + n]
+        assert make_line_index(n_lines).tolist() == ref_index
+        assert make_line_index(torch.tensor(n_lines)).tolist() == ref_index
+        assert line_offsets(torch.tensor(n_lines)) == ref_offsets
+        lines = torch.randn(sum(n_lines), 3, 2)
+        ref = torch.zeros(len(n_lines), 3, 2)
+        for k, (i, _) in enumerate(ref_index):
+            ref[i] += lines[k]
+        assert torch.allclose(sum_lines(lines, make_line_index(n_lines), len(n_lines)), ref)
+
+
+def dataset(sparse_glyphs, compact_dtypes):
+    ds = t3_dataset.T3DataSet.__new__(t3_dataset.T3DataSet)
+    ds.img_wh = IMG_WH
+    ds.glyph_scale = 1
+    ds.max_lines = MAX_LINES
+    ds.sparse_glyphs = sparse_glyphs
+    ds.mask_dtype = bool if compact_dtypes else np.float64
+    ds.glyph_dtype = np.uint8 if compact_dtypes else np.float64
+    return ds
+
+
+# __getitem__ item before padding: n_lines lines, all of them drawn on glyphs[0]
+def raw_item(ds, n, seed):
+    rng = np.random.RandomState(seed)
+    glyphs = [np.zeros((IMG_WH, IMG_WH, 3), ds.glyph_dtype) for _ in range(max(n, 1))]
+    y, x = rng.randint(0, IMG_WH - 8, 2)
+    glyphs[0][y:y+8, x:x+8] = rng.randint(1, 256, (8, 8, 3)) if ds.glyph_dtype == np.uint8 else rng.randint(1, 256, (8, 8, 3)) / 255.
+    return {
+        'img': rng.uniform(-1, 1, (IMG_WH, IMG_WH, 3)).astype(np.float32),
+        'hint': rng.randint(0, 2, (IMG_WH, IMG_WH, 1)).astype(ds.mask_dtype),
+        'img_caption': f'caption {seed}',
+        'text_caption': f'text caption {seed}',
+        'glyphs': glyphs if n > 0 else [],
+        'gly_line': [rng.randint(0, 2, (80, 512, 1)).astype(ds.mask_dtype) for _ in range(n)],
+        'positions': [rng.randint(0, 2, (IMG_WH, IMG_WH, 1)).astype(ds.mask_dtype) for _ in range(n)],
+        'color': [rng.randint(0, 256, 3) for _ in range(n)],
+        'texts': [f'line {seed} {j}' for j in range(n)],
+        'language': ['Latin'] * n,
+        'n_lines': n,
+    }
+
+
+# max_lines padding of T3DataSet.__getitem__
+def pad_item(ds, item):
+    n_pad = MAX_LINES - item['n_lines']
+    if ds.sparse_glyphs:
+        item['glyphs'] = [to_roi(g) if i == 0 else empty_roi(*g.shape) for i, g in enumerate(item['glyphs'])]
+    if n_pad > 0:
+        if ds.sparse_glyphs:
+            item['glyphs'] += [empty_roi(IMG_WH, IMG_WH)] * n_pad
+        else:
+            item['glyphs'] += [np.zeros((IMG_WH, IMG_WH, 3), ds.glyph_dtype)] * n_pad
+        item['gly_line'] += [np.zeros((80, 512, 1), ds.mask_dtype)] * n_pad
+        item['positions'] += [np.zeros((IMG_WH, IMG_WH, 1), ds.mask_dtype)] * n_pad
+        item['texts'] += [' '] * n_pad
+        item['language'] += [' '] * n_pad
+        item['color'] += [np.array(t3_dataset.default_color)] * n_pad
+    return item
+
+
+def glyph_sum(glyphs):
+    glyphs = [densify(g) if is_roi_batch(g) else g.double() for g in glyphs]
+    return torch.stack(glyphs).sum(dim=0)
+
+
+@pytest.mark.parametrize('compact_dtypes', [False, True])
+@pytest.mark.parametrize('sparse_glyphs', [False, True])
+def test_packed_collate(sparse_glyphs, compact_dtypes):
+    ds = dataset(sparse_glyphs, compact_dtypes)
+    for b, n_lines in enumerate(N_LINES):
+        items = [raw_item(ds, n, 10 * b + i) for i, n in enumerate(n_lines)]
+        ref = t3_dataset.t3_collate([pad_item(ds, copy.deepcopy(item)) for item in items])
+        packed = t3_dataset.t3_packed_collate([ds.pack_lines(copy.deepcopy(item)) for item in items])
+        offsets = line_offsets(packed['n_lines'])
+        assert packed['line_index'].tolist() == [[i, j] for i, n in enumerate(n_lines) for j in range(n)]
+        assert offsets[-1] == len(packed['texts']) == len(packed['gly_line']) == len(packed['positions']) == len(packed['color'])
+        for i, n in enumerate(n_lines):
+            for j in range(n):
+                for key in ['gly_line', 'positions', 'color']:
+                    assert torch.equal(get_line(packed, key, i, j, offsets), get_line(ref, key, i, j)), key
+                for key in ['texts', 'language']:
+                    assert get_line(packed, key, i, j, offsets) == get_line(ref, key, i, j), key
+        for key in ['img', 'hint', 'n_lines']:
+            assert torch.equal(packed[key], ref[key]), key
+        assert packed['img_caption'] == ref['img_caption'] and packed['text_caption'] == ref['text_caption']
+        assert len(packed['glyphs']) == 1
+        assert torch.equal(glyph_sum(packed['glyphs']), glyph_sum(ref['glyphs']))
@@ -0,0 +1,67 @@
+'''
+pos_analysis must give the same polygons and position masks as the full-image separate_pos_imgs +
+find_polygon of the original AnyText2Model (tests/baseline.py), and close_roi the same pixels as
+cv2.morphologyEx on the full image.
+    python -m pytest tests/test_pos_analysis.py
+'''
+import pytest
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+import baseline
+import pos_analysis
+
+
+# rotated boxes, ellipses and specks below min_area, some cut by the image border
+def make_pos_img(seed, height=384, width=512):
+    rng = np.random.RandomState(seed)
+    img = np.zeros((height, width), np.uint8)
+    for _ in range(rng.randint(1, 8)):
+        kind = rng.randint(3)
+        cx, cy = rng.randint(-20, width + 20), rng.randint(-20, height + 20)
+        if kind == 0:
+            box = cv2.boxPoints(((cx, cy), (rng.randint(5, 220), rng.randint(5, 80)), rng.uniform(-90, 90)))
+            cv2.fillPoly(img, [box.astype(np.int32)], 255)
+        elif kind == 1:
+            cv2.ellipse(img, (cx, cy), (rng.randint(3, 60), rng.randint(3, 40)), rng.uniform(0, 180), 0, 360, 255, -1)
+        else:
+            img[max(cy, 0):max(cy, 0)+3, max(cx, 0):max(cx, 0)+3] = 255
+    return img
+
+
+@pytest.mark.parametrize('min_rect', [False, True])
+@pytest.mark.parametrize('sort_priority', ['↕', '↔'])
+def test_find_regions(sort_priority, min_rect):
+    for seed in range(60):
+        img = make_pos_img(seed)
+        regions = pos_analysis.find_regions(img, sort_priority, min_rect=min_rect)
+        components = baseline.separate_pos_imgs(img.copy(), sort_priority)
+        assert len(regions) == len(components), seed
+        for region, component in zip(regions, components):
+            poly, pos_img = baseline.find_polygon(component[..., np.newaxis].copy(), min_rect=min_rect)
+            assert np.array_equal(region.polygon, poly), seed
+            assert np.array_equal(pos_analysis.to_full(region, *img.shape), pos_img), seed
+
+
+@pytest.mark.parametrize('min_rect', [False, True])
+def test_find_polygon(min_rect):
+    for seed in range(60):
+        img = make_pos_img(seed)
+        if img.max() == 0:
+            continue
+        img = (img // 255 * np.random.RandomState(seed).randint(1, 256, img.shape)).astype(np.uint8)[..., np.newaxis]  # e.g. an alpha mask
+        ref_poly, ref_img = baseline.find_polygon(img.copy(), min_rect=min_rect)
+        poly, out = pos_analysis.find_polygon(img.copy(), min_rect=min_rect)
+        assert np.array_equal(poly, ref_poly), seed
+        assert np.array_equal(out, ref_img), seed
+
+
+def test_close_roi():
+    for seed in range(30):
+        img = np.repeat(make_pos_img(seed)[..., np.newaxis], 3, axis=2)
+        kernel = np.ones((img.shape[0]//10, img.shape[1]//10), dtype=np.uint8)
+        ref = cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel=kernel, iterations=1)
+        closed, x0, y0 = pos_analysis.close_roi(img, kernel)
+        out = np.zeros_like(ref)
+        if closed is not None:
+            out[y0:y0+closed.shape[0], x0:x0+closed.shape[1]] = closed
+        assert np.array_equal(out, ref), seed
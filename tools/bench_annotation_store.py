@@ -0,0 +1,108 @@
+'''
+Compare T3DataSet annotation storage: list of dicts (columnar=False) vs AnnotationStore (columnar=True).
+For each mode a fresh process loads the manifests and reports load time, peak RSS during loading and RSS, then forks dataloader
+like workers that read every item for a few epochs and reports their copy-on-write growth
+(Private_Dirty from /proc, linux only). Images are not decoded.
+    python tools/bench_annotation_store.py --json poem_data/poem_data.json --workers 8 --epochs 2
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import gc
+import json
+import time
+import queue
+import multiprocessing as mp
+
+
+def proc_kb(field, path='/proc/self/status'):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def private_dirty_kb():
+    if os.path.exists('/proc/self/smaps_rollup'):
+        return proc_kb('Private_Dirty', '/proc/self/smaps_rollup')
+    total = 0
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+    return total
+
+
+def worker(data_list, epochs, queue):
+    before = private_dirty_kb()
+    tic = time.time()
+    n_lines = 0
+    for _ in range(epochs):
+        for i in range(len(data_list)):
+            info = data_list[i]
+            n_lines += len(info.get('texts', []))
+    queue.put({'cow_kb': private_dirty_kb() - before, 'items_per_s': epochs * len(data_list) / max(time.time() - tic, 1e-6)})
+
+
+def run_mode(args, columnar, queue):
+    from t3_dataset import T3DataSet
+    gc.collect()
+    rss0 = proc_kb('VmRSS')
+    tic = time.time()
+    dataset = T3DataSet(args.json, font_path=args.font_path, columnar=columnar)
+    load_s = time.time() - tic
+    gc.collect()
+    rss1 = proc_kb('VmRSS')
+    peak = proc_kb('VmHWM')
+    ctx = mp.get_context('fork')
+    wq = ctx.Queue()
+    workers = [ctx.Process(target=worker, args=(dataset.data_list, args.epochs, wq)) for _ in range(args.workers)]
+    for w in workers:
+        w.start()
+    results = [wq.get() for _ in workers]
+    for w in workers:
+        w.join()
+    queue.put({'columnar': columnar, 'items': len(dataset.data_list), 'load_s': load_s, 'peak_load_mb': (peak - rss0) / 1024, 'data_rss_mb': (rss1 - rss0) / 1024,
+               'worker_cow_mb': sum([r['cow_kb'] for r in results]) / 1024 / max(len(results), 1),
+               'items_per_s': sum([r['items_per_s'] for r in results]) / max(len(results), 1)})
+
+
+# result of a benchmark process, stop if it died (e.g. import error) instead of waiting forever
+def get_result(q, p):
+    while True:
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            if not p.is_alive():
+                sys.exit(f'{p.name} exited with code {p.exitcode}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark columnar vs dict annotation storage of T3DataSet.')
+    parser.add_argument('--json', type=str, nargs='+', default=['poem_data/poem_data.json'])
+    parser.add_argument('--font_path', type=str, default='./font/Arial_Unicode.ttf')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--out', type=str, default=None, help='write results as JSON')
+    args = parser.parse_args()
+
+    ctx = mp.get_context('fork')
+    results = []
+    for columnar in [False, True]:
+        q = ctx.Queue()
+        p = ctx.Process(target=run_mode, args=(args, columnar, q))
+        p.start()
+        results += [get_result(q, p)]
+        p.join()
+        r = results[-1]
+        print(f'{"columnar" if columnar else "dicts":8s} items {r["items"]} | load {r["load_s"]:.2f}s | peak {r["peak_load_mb"]:.1f}MB | data RSS {r["data_rss_mb"]:.1f}MB | '
+              f'COW per worker {r["worker_cow_mb"]:.1f}MB | {r["items_per_s"]:.0f} items/s per worker')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
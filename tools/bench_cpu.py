@@ -0,0 +1,219 @@
+'''
+CPU micro-benchmarks of glyph rendering and preprocessing: draw_glyph, draw_glyph2 (horizontal,
+vertical, rotated, long text), draw_font_hint and draw_font_hint_line (with/without randaug), image decoding (full PIL decode
+vs ImageLoader draft decoding), T3DataSet.__getitem__ for both training stages and AnyText2Model.prepare (CPU half of forward,
+only with --model_dir).
+Reports p50/p95/mean time and python/numpy allocations (tracemalloc) per op and writes JSON,
+so results can be compared across commits.
+    python tools/bench_cpu.py --json poem_data/poem_data.json --out bench_cpu.json
+    python tools/bench_cpu.py --only draw_glyph2 --repeat 200
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import json
+import time
+import random
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import cv2
+import t3_dataset
+import glyph_cache
+from t3_dataset import T3DataSet, draw_glyph, draw_glyph2, draw_font_hint, draw_font_hint_line
+from font_pool import get_font
+from manifest import Manifest, iter_data_list
+from image_io import ImageLoader
+from PIL import Image
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+'''
+Time fn(i) for i in range(repeat) after warmup calls, allocations are measured in a second pass
+because tracemalloc slows down every allocation.
+'''
+def measure(fn, repeat, warmup=3):
+    for i in range(warmup):
+        fn(i)
+    times = []
+    for i in range(repeat):
+        tic = time.perf_counter()
+        fn(i)
+        times += [(time.perf_counter() - tic) * 1000.]
+    n_alloc = min(repeat, 20)
+    tracemalloc.start()
+    allocated, peak = 0, 0
+    for i in range(n_alloc):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn(i)
+        current, p = tracemalloc.get_traced_memory()
+        allocated += max(current - before, 0)
+        peak = max(peak, p - before)
+    tracemalloc.stop()
+    return {'n': repeat, 'p50_ms': percentile(times, 50), 'p95_ms': percentile(times, 95), 'mean_ms': float(np.mean(times)),
+            'retained_kb': allocated / n_alloc / 1024, 'peak_kb': peak / 1024}
+
+
+def load_texts(json_path, max_texts=200):
+    texts = []
+    if os.path.exists(json_path):
+        for gt in iter_data_list(json_path):
+            for ann in gt.get('annotations', []):
+                if ann.get('valid', ann.get('vaild', True)) and ann['text'].strip():
+                    texts += [ann['text']]
+            if len(texts) >= max_texts:
+                break
+    if not texts:
+        texts = ['山有木兮木有枝', 'Hello World', 'AnyText2']
+    return texts[:max_texts]
+
+
+def rect_polygon(cx, cy, w, h, angle=0):
+    return np.int32(cv2.boxPoints(((cx, cy), (w, h), angle)))
+
+
+def glyph_cases(font, texts, size):
+    s = size / 512
+    shapes = {
+        'horizontal': rect_polygon(256*s, 256*s, 400*s, 60*s),
+        'vertical': rect_polygon(256*s, 256*s, 50*s, 420*s),
+        'rotated': rect_polygon(256*s, 256*s, 380*s, 70*s, angle=30),
+    }
+    color = np.array([200, 60, 30])
+    cases = {'draw_glyph': lambda i: draw_glyph(font, texts[i % len(texts)][:20])}
+    for name, poly in shapes.items():
+        cases[f'draw_glyph2_{name}'] = (lambda p: lambda i: draw_glyph2(font, texts[i % len(texts)][:20], p, color, width=size, height=size))(poly)
+    long_text = ''.join(texts)[:80]
+    cases['draw_glyph2_long'] = lambda i: draw_glyph2(font, long_text[i % 10:], shapes['horizontal'], color, width=size, height=size)
+    return cases
+
+
+def font_hint_cases(size):
+    rng = np.random.RandomState(0)
+    target = (rng.rand(size, size, 3).astype(np.float32) * 2 - 1)
+    poly = rect_polygon(256*size/512, 256*size/512, 400*size/512, 60*size/512)
+    return {
+        'draw_font_hint': lambda i: draw_font_hint(target, poly.copy(), target_area_range=[0.7, 1.0]),
+        'draw_font_hint_randaug': lambda i: draw_font_hint(target, poly.copy(), target_area_range=[0.7, 1.0], randaug=True),
+        'draw_font_hint_line': lambda i: draw_font_hint_line(np.zeros((size, size), bool), target, poly.copy(), target_area_range=[0.7, 1.0]),
+        'draw_font_hint_line_randaug': lambda i: draw_font_hint_line(np.zeros((size, size), bool), target, poly.copy(), target_area_range=[0.7, 1.0], randaug=True),
+    }
+
+
+def image_cases(json_path, size, max_images=50):
+    paths = []
+    if os.path.exists(json_path):
+        manifest = Manifest(json_path)
+        for gt in manifest.records(max_images):
+            paths += [os.path.join(manifest.get_meta('data_root', ''), gt['img_name'])]
+    paths = [p for p in paths if os.path.exists(p)]
+    if not paths:
+        print('Skip image decoding, no images found')
+        return {}
+
+    def full_decode(i):
+        img = np.array(Image.open(paths[i % len(paths)]).convert('RGB'))
+        return cv2.resize(img, (size, size))
+    loader = ImageLoader(size, fast_decode=True)
+    return {'image_decode_full': full_decode, 'image_decode_draft': lambda i: loader.load(paths[i % len(paths)])}
+
+
+def dataset_cases(json_path, font_path):
+    cases = {}
+    for stage in [1, 2]:
+        try:
+            dataset = T3DataSet(json_path, max_lines=5, max_chars=20, font_path=font_path, mask_img_prob=0.5, font_hint_prob=0.8,
+                                font_hint_area=[0.7, 1], training_stage=stage)
+        except Exception as e:
+            print(f'Skip T3DataSet stage {stage}: {e}')
+            continue
+        cases[f'dataset_getitem_stage{stage}'] = (lambda d: lambda i: d[i % len(d)])(dataset)
+    return cases
+
+
+def prepare_case(model_dir, texts, size):
+    from ms_wrapper import AnyText2Model
+    model = AnyText2Model(model_dir=model_dir, use_fp16=True, use_translator=False)
+    pos = np.zeros((size, size, 3), np.uint8)
+    n_lines = 3
+    for k in range(n_lines):
+        cv2.fillPoly(pos, [rect_polygon(size/2, size*(k+1)/(n_lines+1), size*0.7, size*0.1)], (255, 255, 255))
+    params = dict(mode='gen', image_count=4, image_width=size, image_height=size, show_debug=False)
+
+    def fn(i):
+        lines = [texts[(i + k) % len(texts)][:20].replace('"', '') for k in range(n_lines)]
+        input_tensor = {'img_prompt': 'a poster with text', 'text_prompt': ', '.join([f'"{t}"' for t in lines]),
+                        'seed': 100, 'draw_pos': pos}
+        job = model.prepare(input_tensor, **params)
+        if isinstance(job, tuple):  # (results, rtn_code, rtn_warning, debug_info) error, not a timing
+            raise RuntimeError(f'prepare failed: {job[2]}')
+        return job
+    return {'prepare': fn}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU micro-benchmarks of glyph rendering and preprocessing.')
+    parser.add_argument('--json', type=str, default='poem_data/poem_data.json')
+    parser.add_argument('--font', type=str, default='./font/Arial_Unicode.ttf')
+    parser.add_argument('--size', type=int, default=512, help='canvas size of draw_glyph2/draw_font_hint/prepare')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--model_dir', type=str, default=None, help='also benchmark AnyText2Model.prepare (loads the model)')
+    parser.add_argument('--glyph_cache', action='store_true', help='keep the glyph render cache enabled')
+    parser.add_argument('--only', type=str, nargs='*', default=None, help='run ops whose name starts with one of these')
+    parser.add_argument('--out', type=str, default=None, help='write results as JSON, default: print to stdout')
+    args = parser.parse_args()
+
+    random.seed(0)
+    np.random.seed(0)
+    t3_dataset.SHOW_GLYPH = False
+    texts = load_texts(args.json)
+    font = get_font(args.font, 60)
+    cases = {}
+    cases.update(glyph_cases(font, texts, args.size))
+    cases.update(font_hint_cases(args.size))
+    cases.update(image_cases(args.json, args.size))
+    cases.update(dataset_cases(args.json, args.font))
+    if args.model_dir:
+        cases.update(prepare_case(args.model_dir, texts, args.size))
+    if not args.glyph_cache:  # measure rendering, not cache lookups
+        glyph_cache.disable()
+    if args.only:
+        cases = {k: v for k, v in cases.items() if any([k.startswith(o) for o in args.only])}
+
+    results = {}
+    for name, fn in cases.items():
+        try:
+            results[name] = measure(fn, args.repeat)
+        except Exception as e:  # e.g. dataset images not on this machine
+            results[name] = {'error': f'{type(e).__name__}: {e}'}
+        r = results[name]
+        if 'error' in r:
+            print(f'{name:32s} {r["error"]}')
+        else:
+            print(f'{name:32s} p50 {r["p50_ms"]:8.2f}ms | p95 {r["p95_ms"]:8.2f}ms | '
+                  f'retained {r["retained_kb"]:9.1f}KB | peak {r["peak_kb"]:9.1f}KB')
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'opencv': cv2.__version__, 'args': vars(args), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved to {args.out}')
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
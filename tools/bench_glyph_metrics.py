@@ -0,0 +1,71 @@
+'''
+Micro-benchmark of draw_glyph2 font sizing: original binary search + insert_spaces probe loop vs
+the closed-form glyph_metrics engine, on the texts/polygons of a poem_data manifest.
+Reports per-line time, speedup and the number of lines whose render differs.
+    python tools/bench_glyph_metrics.py --json poem_data/poem_data.json --fonts font/lang_font_dict.npy
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import time
+import numpy as np
+from PIL import ImageFont
+import t3_dataset
+import glyph_cache
+from glyph_metrics import metrics
+from manifest import iter_data_list
+
+
+def load_fonts(paths):
+    fonts = []
+    for p in paths:
+        if p.endswith('.npy'):  # lang_font_dict: {lang: {'fonts': [paths]}}
+            lang_font_dict = np.load(p, allow_pickle=True)[()]
+            fonts += sum([v['fonts'] for v in lang_font_dict.values()], [])
+        else:
+            fonts += [p]
+    fonts = [f for f in dict.fromkeys(fonts) if os.path.exists(f)]
+    return [ImageFont.truetype(f, size=60) for f in fonts]
+
+
+def run(lines, fast):
+    t3_dataset.FAST_GLYPH_METRICS = fast
+    imgs = []
+    tic = time.time()
+    for font, text, polygon in lines:
+        imgs += [t3_dataset.draw_glyph2(font, text, polygon, np.array([255, 255, 255]), scale=1, width=512, height=512)]
+    return imgs, (time.time() - tic) * 1000. / max(len(lines), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark closed-form glyph sizing in draw_glyph2.')
+    parser.add_argument('--json', type=str, default='poem_data/poem_data.json')
+    parser.add_argument('--fonts', type=str, nargs='+', default=['font/lang_font_dict.npy'])
+    parser.add_argument('--max_lines', type=int, default=500)
+    args = parser.parse_args()
+
+    glyph_cache.disable()
+    fonts = load_fonts(args.fonts)
+    assert len(fonts) > 0, f'No font file found in {args.fonts}'
+    lines = []
+    for gt in iter_data_list(args.json):
+        for ann in gt.get('annotations', []):
+            if ann.get('valid', ann.get('vaild', True)) and ann['text']:
+                lines += [(fonts[len(lines) % len(fonts)], ann['text'], np.array(ann['polygon']))]
+        if len(lines) >= args.max_lines:
+            break
+    lines = lines[:args.max_lines]
+    print(f'{len(lines)} lines, {len(fonts)} fonts')
+
+    ref_imgs, ref_ms = run(lines, fast=False)
+    _, cold_ms = run(lines, fast=True)  # fills the per-(font, char) reference metrics
+    fast_imgs, warm_ms = run(lines, fast=True)
+    n_diff = sum([not np.array_equal(a, b) for a, b in zip(ref_imgs, fast_imgs)])
+    print(f'search: {ref_ms:.2f}ms/line | metrics cold: {cold_ms:.2f}ms/line ({ref_ms/cold_ms:.2f}x) | '
+          f'metrics warm: {warm_ms:.2f}ms/line ({ref_ms/warm_ms:.2f}x) | different renders: {n_diff}/{len(lines)}')
+    print(metrics.stats())
+
+
+if __name__ == '__main__':
+    main()
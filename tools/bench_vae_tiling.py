@@ -0,0 +1,85 @@
+'''
+Compare full vs tiled / micro-batched VAE encode+decode: peak cuda memory, time and seams.
+Seam error is the mean abs difference to the full decode on the pixel rows/cols around tile
+borders, divided by the same error everywhere else (close to 1.0 means no visible seams).
+    python tools/bench_vae_tiling.py --size 1024 --batch 8 --tile_size 64 --decode_batch_size 2
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import time
+import torch
+from cldm.model import create_model, load_state_dict
+
+
+def run(vae, fn, *args):
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    tic = time.time()
+    try:
+        out = fn(*args)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return None, float('nan'), float('nan')
+    torch.cuda.synchronize()
+    return out, (time.time() - tic) * 1000., (torch.cuda.max_memory_allocated() - base) / 1024**2
+
+
+def seam_error(ref, out, tile_px, overlap_px):
+    err = (ref - out).abs().mean(dim=(0, 1))
+    border = torch.zeros_like(err, dtype=torch.bool)
+    stride = tile_px - overlap_px
+    for p in range(stride, err.shape[0], stride):
+        border[max(p-4, 0):p+overlap_px+4, :] = True
+    for p in range(stride, err.shape[1], stride):
+        border[:, max(p-4, 0):p+overlap_px+4] = True
+    if border.all() or not border.any():
+        return float('nan')
+    return (err[border].mean() / err[~border].mean().clamp(min=1e-8)).item()
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tiled VAE encode/decode.')
+    parser.add_argument('--cfg_path', type=str, default='models_yaml/anytext2_sd15.yaml')
+    parser.add_argument('--ckpt_path', type=str, default='models/anytext_v2.0.ckpt')
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--tile_size', type=int, default=64, help='latent pixels')
+    parser.add_argument('--tile_overlap', type=int, default=16, help='latent pixels')
+    parser.add_argument('--decode_batch_size', type=int, default=2)
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+
+    model = create_model(args.cfg_path, use_fp16=args.fp16)
+    model.load_state_dict(load_state_dict(args.ckpt_path, location='cpu'), strict=False)
+    vae = model.first_stage_model.cuda().eval()
+    dtype = torch.float16 if args.fp16 else torch.float32
+    if args.fp16:
+        vae = vae.half()
+    x = torch.rand((1, 3, args.size, args.size), device='cuda', dtype=dtype) * 2 - 1
+    z = torch.randn((args.batch, 4, args.size // 8, args.size // 8), device='cuda', dtype=dtype)
+
+    configs = [('full', None, None),
+               ('micro-batch', None, args.decode_batch_size),
+               ('tiled', args.tile_size, None),
+               ('tiled+micro-batch', args.tile_size, args.decode_batch_size)]
+    ref_enc, ref_dec = None, None
+    for name, tile_size, decode_batch_size in configs:
+        vae.tile_size, vae.tile_overlap, vae.decode_batch_size = tile_size, args.tile_overlap, decode_batch_size
+        enc, enc_ms, enc_mb = run(vae, lambda t: vae.encode(t).mode(), x)
+        dec, dec_ms, dec_mb = run(vae, vae.decode, z)
+        if name == 'full':
+            ref_enc, ref_dec = enc, dec
+        seam = ''
+        if tile_size and ref_dec is not None and dec is not None:
+            seam = f', decode seam ratio={seam_error(ref_dec.float(), dec.float(), tile_size*8, args.tile_overlap*8):.2f}'
+            if ref_enc is not None and enc is not None:
+                seam += f', encode max diff={(ref_enc - enc).abs().max().item():.4f}'
+        print(f'[{name:>18}] encode {enc_ms:8.1f}ms {enc_mb:8.1f}MB | decode x{args.batch} {dec_ms:8.1f}ms {dec_mb:8.1f}MB{seam}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Check that T3DataSet(compact_dtypes=True) batches (uint8 glyphs, bool masks) are numerically identical
+to the float64 batches after the on-device conversion done by ControlLDM.get_input, and report the
+bytes per batch of both. Both datasets draw the same items with the same random seeds.
+    python tools/check_compact_batches.py --json poem_data/poem_data.json --batches 20
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import random
+import numpy as np
+import torch
+from t3_dataset import T3DataSet, t3_collate
+from glyph_roi import is_roi_batch, densify
+from cldm.cldm import decompact
+
+KEYS = ['hint', 'inv_mask', 'font_hint', 'masked_img', 'img', 'glyphs', 'gly_line', 'positions']
+
+
+def load_batch(dataset, idxs, seed):
+    items = []
+    for i, item in enumerate(idxs):
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+        items += [dataset[item]]
+    return t3_collate(items)
+
+
+def to_model(value, device):
+    if isinstance(value, list):
+        if is_roi_batch(value[0]):
+            return [densify(v, device=device) for v in value]
+        return [to_model(v, device) for v in value]
+    return decompact(value.to(device))
+
+
+def nbytes(value):
+    if isinstance(value, list):
+        return sum([nbytes(v) for v in value])
+    if hasattr(value, 'crop'):  # GlyphROI
+        return value.crop.nbytes
+    return value.numel() * value.element_size()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare compact and float64 T3DataSet batches.')
+    parser.add_argument('--json', type=str, default='poem_data/poem_data.json')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--sparse_glyphs', action='store_true')
+    parser.add_argument('--font_hint_prob', type=float, default=0.8)
+    parser.add_argument('--mask_img_prob', type=float, default=0.5)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    kwargs = dict(max_lines=5, max_chars=20, mask_img_prob=args.mask_img_prob, font_hint_prob=args.font_hint_prob,
+                  font_hint_area=[0.7, 1], sparse_glyphs=args.sparse_glyphs)
+    ref_set = T3DataSet(args.json, compact_dtypes=False, **kwargs)
+    compact_set = T3DataSet(args.json, compact_dtypes=True, **kwargs)
+    n_items = min(len(ref_set), args.batches * args.batch_size)
+    mismatch = {}
+    ref_bytes, compact_bytes = 0, 0
+    for b in range(0, n_items, args.batch_size):
+        idxs = list(range(b, min(b + args.batch_size, n_items)))
+        ref = load_batch(ref_set, idxs, seed=b)
+        compact = load_batch(compact_set, idxs, seed=b)
+        for k in KEYS:
+            ref_bytes += nbytes(ref[k])
+            compact_bytes += nbytes(compact[k])
+            x, y = to_model(ref[k], device), to_model(compact[k], device)
+            if isinstance(x, list):
+                same = all([torch.equal(i, j) for i, j in zip(x, y)])
+            else:
+                same = torch.equal(x, y)
+            if not same:
+                mismatch[k] = mismatch.get(k, 0) + 1
+    n_batches = (n_items + args.batch_size - 1) // args.batch_size
+    print(f'{n_batches} batches | float64: {ref_bytes/n_batches/2**20:.1f}MB/batch | '
+          f'compact: {compact_bytes/n_batches/2**20:.1f}MB/batch ({ref_bytes/max(compact_bytes, 1):.1f}x smaller)')
+    if mismatch:
+        print(f'MISMATCH (batches per key): {mismatch}')
+        sys.exit(1)
+    print('All batches identical after conversion.')
+
+
+if __name__ == '__main__':
+    main()
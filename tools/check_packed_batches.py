@@ -0,0 +1,105 @@
+'''
+Check that T3DataSet(packed_lines=True) batches carry the same lines as the max_lines padded batches:
+per (sample, line) gly_line/position/color/text, the summed positions and glyphs that ControlNet sees,
+and report the bytes per batch of both. Both datasets draw the same items with the same random seeds.
+    python tools/check_packed_batches.py --json poem_data/poem_data.json --batches 20
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import random
+import numpy as np
+import torch
+from t3_dataset import T3DataSet, t3_collate, t3_packed_collate
+from glyph_roi import is_roi_batch, densify
+from packed_lines import line_offsets, sum_lines
+from cldm.cldm import decompact
+
+
+def load_batch(dataset, idxs, seed, collate_fn):
+    items = []
+    for i, item in enumerate(idxs):
+        random.seed(seed + i)
+        np.random.seed(seed + i)
+        items += [dataset[item]]
+    return collate_fn(items)
+
+
+def glyph_sum(glyphs):
+    glyphs = [densify(g) if is_roi_batch(g) else decompact(g) for g in glyphs]
+    return torch.stack(glyphs).sum(dim=0)
+
+
+def nbytes(value):
+    if isinstance(value, (list, tuple)) and not hasattr(value, 'crop'):
+        return sum([nbytes(v) for v in value])
+    if hasattr(value, 'crop'):  # GlyphROI
+        return value.crop.nbytes
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    return 0
+
+
+def compare(ref, packed):
+    errors = []
+    offsets = line_offsets(packed['n_lines'])
+    if not torch.equal(ref['n_lines'], packed['n_lines']):
+        return ['n_lines']
+    for i, n in enumerate(packed['n_lines'].tolist()):
+        for j in range(n):
+            k = offsets[i] + j
+            if packed['line_index'][k].tolist() != [i, j]:
+                errors += ['line_index']
+            for key in ['gly_line', 'positions', 'color']:
+                if not torch.equal(ref[key][j][i], packed[key][k]):
+                    errors += [key]
+            for key in ['texts', 'language']:
+                if ref[key][j][i] != packed[key][k]:
+                    errors += [key]
+    bs = len(packed['n_lines'])
+    ref_pos = torch.stack([decompact(p) for p in ref['positions']]).sum(dim=0)
+    if not torch.equal(ref_pos, sum_lines(decompact(packed['positions']), packed['line_index'], bs)):
+        errors += ['positions_sum']
+    if not torch.equal(glyph_sum(ref['glyphs']), glyph_sum(packed['glyphs'])):
+        errors += ['glyphs_sum']
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare packed and max_lines padded T3DataSet batches.')
+    parser.add_argument('--json', type=str, default='poem_data/poem_data.json')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--sparse_glyphs', action='store_true')
+    parser.add_argument('--training_stage', type=int, default=2)
+    args = parser.parse_args()
+
+    kwargs = dict(max_lines=5, max_chars=20, mask_img_prob=0.5, font_hint_prob=0.8, font_hint_area=[0.7, 1],
+                  sparse_glyphs=args.sparse_glyphs, compact_dtypes=True, training_stage=args.training_stage)
+    ref_set = T3DataSet(args.json, packed_lines=False, **kwargs)
+    packed_set = T3DataSet(args.json, packed_lines=True, **kwargs)
+    n_items = min(len(ref_set), args.batches * args.batch_size)
+    mismatch = {}
+    ref_bytes, packed_bytes, n_lines = 0, 0, 0
+    for b in range(0, n_items, args.batch_size):
+        idxs = list(range(b, min(b + args.batch_size, n_items)))
+        ref = load_batch(ref_set, idxs, b, t3_collate)
+        packed = load_batch(packed_set, idxs, b, t3_packed_collate)
+        for k in ['glyphs', 'gly_line', 'positions', 'color']:
+            ref_bytes += nbytes(ref[k])
+            packed_bytes += nbytes(packed[k])
+        n_lines += len(packed['line_index'])
+        for e in set(compare(ref, packed)):
+            mismatch[e] = mismatch.get(e, 0) + 1
+    n_batches = (n_items + args.batch_size - 1) // args.batch_size
+    print(f'{n_batches} batches, {n_lines/max(n_items, 1):.2f} lines/sample | padded: {ref_bytes/n_batches/2**20:.1f}MB/batch | '
+          f'packed: {packed_bytes/n_batches/2**20:.1f}MB/batch ({ref_bytes/max(packed_bytes, 1):.1f}x smaller)')
+    if mismatch:
+        print(f'MISMATCH (batches per key): {mismatch}')
+        sys.exit(1)
+    print('All lines identical.')
+
+
+if __name__ == '__main__':
+    main()
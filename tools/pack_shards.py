@@ -0,0 +1,101 @@
+'''
+Pack T3DataSet json manifests into preprocessed shards (see t3_shards.py): images are decoded and
+resized once, annotations are parsed with the same filters as T3DataSet.load_data, and with
+--render_glyph the gly_line of every text is rendered with --font_path. Shards are packed in
+parallel, one process per shard, and finished shards are skipped, so an interrupted run resumes.
+    python tools/pack_shards.py --json_paths a.json b.json --out_dir ./shards/train --render_glyph --workers 16
+'''
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import time
+from multiprocessing import Pool
+import numpy as np
+import cv2
+from PIL import Image
+import glyph_cache
+import t3_dataset
+from t3_dataset import T3DataSet, draw_glyph
+from font_pool import get_font
+from t3_shards import shard_name, shard_paths, read_meta, write_meta, encode_sample, META_NAME
+
+# packing args that change the content of the shards, must match when resuming
+PACK_KEYS = ['json_paths', 'img_wh', 'shard_size', 'percent', 'wm_thresh', 'cap_watermark', 'using_dlc', 'render_glyph', 'font_path', 'max_chars']
+
+
+def pack_shard(task):
+    shard_dir, name, infos, args = task
+    bin_path, idx_path = shard_paths(shard_dir, name)
+    if os.path.exists(idx_path):
+        return name, 0, 0.
+    tic = time.time()
+    glyph_cache.disable()
+    t3_dataset.SHOW_GLYPH = False
+    font = get_font(args['font_path'], 60) if args['render_glyph'] else None
+    offsets = []
+    offset = 0
+    with open(bin_path + '.tmp', 'wb') as f:
+        for info in infos:
+            img = np.array(Image.open(info['img_path']).convert('RGB'))
+            if img.shape[0] != args['img_wh'] or img.shape[1] != args['img_wh']:
+                img = cv2.resize(img, (args['img_wh'], args['img_wh']))
+            gly_lines = None
+            if font is not None:
+                gly_lines = [draw_glyph(font, text[:args['max_chars']]) for text in info.get('texts', [])]
+            data = encode_sample(info, img, gly_lines)
+            f.write(data)
+            offsets += [(offset, len(data))]
+            offset += len(data)
+    os.replace(bin_path + '.tmp', bin_path)
+    np.save(idx_path + '.tmp.npy', np.array(offsets, dtype=np.int64).reshape(-1, 2))
+    os.replace(idx_path + '.tmp.npy', idx_path)  # marks the shard as complete
+    return name, len(infos), time.time() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack T3DataSet json manifests into preprocessed shards.')
+    parser.add_argument('--json_paths', type=str, nargs='+', required=True)
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--img_wh', type=int, default=512)
+    parser.add_argument('--shard_size', type=int, default=1000, help='samples per shard')
+    parser.add_argument('--percent', type=float, default=1.0)
+    parser.add_argument('--wm_thresh', type=float, default=1.0)
+    parser.add_argument('--no_cap_watermark', dest='cap_watermark', action='store_false')
+    parser.add_argument('--using_dlc', action='store_true')
+    parser.add_argument('--render_glyph', action='store_true', help='store the gly_line of every text, used when rand_font=False')
+    parser.add_argument('--font_path', type=str, default='./font/Arial_Unicode.ttf')
+    parser.add_argument('--max_chars', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    pack_args = {k: getattr(args, k) for k in PACK_KEYS}
+    pack_args['font_path'] = os.path.abspath(args.font_path)
+    os.makedirs(args.out_dir, exist_ok=True)
+    if os.path.exists(os.path.join(args.out_dir, META_NAME)):
+        old_args = read_meta(args.out_dir)['args']
+        assert old_args == pack_args, f'{args.out_dir} was packed with different args {old_args}, use another out_dir'
+        print(f'Resuming {args.out_dir}')
+
+    # same parsing and filters as training
+    dataset = T3DataSet(args.json_paths, max_chars=args.max_chars, font_path=args.font_path, percent=args.percent,
+                        wm_thresh=args.wm_thresh, cap_watermark=args.cap_watermark, using_dlc=args.using_dlc, img_wh=args.img_wh)
+    data_list = dataset.data_list
+    names = [shard_name(i) for i in range((len(data_list) + args.shard_size - 1) // args.shard_size)]
+    shards = [{'name': n, 'size': len(data_list[i*args.shard_size:(i+1)*args.shard_size])} for i, n in enumerate(names)]
+    write_meta(args.out_dir, {'version': 1, 'args': pack_args, 'num_samples': len(data_list), 'shards': shards})
+
+    tasks = [(args.out_dir, n, data_list[i*args.shard_size:(i+1)*args.shard_size], pack_args) for i, n in enumerate(names)]
+    tasks = [t for t in tasks if not os.path.exists(shard_paths(args.out_dir, t[1])[1])]
+    print(f'{len(data_list)} samples in {len(names)} shards, {len(names) - len(tasks)} already packed')
+    tic = time.time()
+    done = 0
+    with Pool(max(1, min(args.workers, len(tasks)))) as pool:
+        for name, n, t in pool.imap_unordered(pack_shard, tasks):
+            done += n
+            print(f'{name}: {n} samples in {t:.1f}s | {done} samples, {done/max(time.time()-tic, 1e-6):.1f} samples/s')
+    print(f'Done, {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import os
 
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader
-from t3_dataset import T3DataSet
+from t3_dataset import T3DataSet, t3_collate, t3_packed_collate
 from cldm.logger import ImageLogger
 from cldm.model import create_model, load_state_dict
 from pytorch_lightning.callbacks import ModelCheckpoint
@@ -41,6 +41,10 @@ save_ckpt_top = 20
 
 root_dir = './checkpoints'  # path for save checkpoints
 dataset_percent = 1
+shard_dir = None  # shards from tools/pack_shards.py, used instead of json_paths if set
+image_cache_dir = None  # e.g. './cache/images', images resized to 512 are kept on disk across epochs
+fast_decode = True  # JPEG draft decoding at reduced resolution, pixels differ slightly from a full decode + resize
+packed_lines = True  # batches carry only the real text lines instead of max_lines padding, see packed_lines.py
 save_steps = None  # step frequency of saving checkpoints
 save_epochs = 5  # epoch frequency of saving checkpoints
 max_epochs = 60  # default 60
@@ -101,8 +105,11 @@ if __name__ == '__main__':
     dataset = T3DataSet(json_paths, max_lines=5, max_chars=20, mask_pos_prob=1.0, mask_img_prob=mask_ratio, glyph_scale=glyph_scale,
                         percent=dataset_percent, debug=False, using_dlc=USING_DLC, wm_thresh=wm_thresh, render_glyph=True,
                         trunc_cap=128, rand_font=rand_font, font_hint_prob=font_hint_prob, font_hint_area=font_hint_area,
-                        font_hint_randaug=font_hint_randaug, color_prob=color_prob)
-    dataloader = DataLoader(dataset, num_workers=8, persistent_workers=True, batch_size=batch_size, shuffle=True)
+                        font_hint_randaug=font_hint_randaug, color_prob=color_prob, sparse_glyphs=True, compact_dtypes=True,
+                        shard_dir=shard_dir, image_cache_dir=image_cache_dir, fast_decode=fast_decode,
+                        packed_lines=packed_lines)
+    dataloader = DataLoader(dataset, num_workers=8, persistent_workers=True, batch_size=batch_size, shuffle=True,
+                            collate_fn=t3_packed_collate if packed_lines else t3_collate)
     logger = ImageLogger(batch_frequency=logger_freq)
     # trainer = pl.Trainer(gpus=-1, precision=32, max_epochs=max_epochs, num_nodes=NUM_NODES, accumulate_grad_batches=grad_accum, callbacks=[logger, checkpoint_callback], default_root_dir=root_dir, strategy='ddp')
     trainer = pl.Trainer(accelerator='cuda', precision=32, max_epochs=30, num_nodes=NUM_NODES, accumulate_grad_batches=grad_accum, callbacks=[logger, checkpoint_callback], default_root_dir=root_dir, enable_progress_bar=True,devices=1)
@@ -1,6 +1,10 @@
 import datetime
 import os
+import json
+import threading
+import atexit
 import cv2
+from collections import OrderedDict
 
 
 def save_images(img_list, folder, id=None):
@@ -46,3 +50,121 @@ def resize_image(img, max_length=768):
     height, width = img.shape[:2]
     img = cv2.resize(img, (width-(width % 64), height-(height % 64)))
     return img
+
+
+# max_bytes: also evict while the sum of sizeof(value) is above it
+class LRUCache(object):
+    def __init__(self, max_size=16, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        if self.sizeof is not None:
+            if key in self.data:
+                self.nbytes -= self.sizeof(self.data[key])
+            self.nbytes += self.sizeof(value)
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size or (self.max_bytes is not None and self.nbytes > self.max_bytes and self.data):
+            _, old = self.data.popitem(last=False)
+            if self.sizeof is not None:
+                self.nbytes -= self.sizeof(old)
+
+    def clear(self):
+        self.data.clear()
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        total = max(self.hits + self.misses, 1)
+        return {'size': len(self.data), 'nbytes': self.nbytes, 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total}
+
+
+# LRUCache backed by a json file, so str -> str entries (e.g. prompt translations) survive restarts.
+# Puts only mark the cache dirty, the file is written flush_delay seconds later (one write for a burst
+# of puts) and on close()/exit
+class PersistentLRUCache(LRUCache):
+    def __init__(self, path, max_size=1024, flush_delay=5.0):
+        super().__init__(max_size=max_size)
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.timer = None
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for key, value in json.load(f):
+                        self.data[key] = value
+                while len(self.data) > self.max_size:
+                    self.data.popitem(last=False)
+            except (OSError, ValueError) as e:
+                print(f'Failed to load cache from {path}: {e}')
+        if path:
+            atexit.register(self.flush)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return super().get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            super().put(key, value)
+            self.dirty = True
+            if self.path and self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # write the cache file if anything changed since the last flush
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+            self.dirty = False
+            items = list(self.data.items())
+        with self.save_lock:
+            self.save(items)
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush()
+
+    def save(self, items=None):
+        if not self.path:
+            return
+        if items is None:
+            with self.lock:
+                items = list(self.data.items())
+        try:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)  # atomic, never leaves a half written cache
+        except OSError as e:
+            print(f'Failed to save cache to {self.path}: {e}')